@@ -15,12 +15,23 @@ import email
 import imaplib
 import smtplib
 import threading
+import queue
 import secrets
 import hashlib
 import hmac
+import heapq
+import zipfile
+import sqlite3
+import csv
+import cProfile
+import pstats
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-from functools import wraps
+from collections import deque
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from functools import wraps, lru_cache
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -28,19 +39,12 @@ from email import encoders
 from datetime import datetime, timedelta
 from pathlib import Path
 
-import requests
 from flask import (
     Flask, request, jsonify, render_template, send_file,
-    session, redirect, url_for, abort, make_response,
-    after_this_request
+    session, redirect, url_for, abort, Response
 )
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.colors import red, black
-from reportlab.lib.pagesizes import A4
-import fitz  # PyMuPDF
+# requests, openpyxl, PyPDF2, reportlab et PyMuPDF (fitz) sont importes dans les
+# fonctions qui les utilisent : l'import du module reste rapide (demarrage a froid)
 
 app = Flask(__name__)
 
@@ -51,14 +55,99 @@ app = Flask(__name__)
 
 Path('logs').mkdir(exist_ok=True)
 
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Ecritures disque/console dans un thread dedie : les threads de traitement ne font qu'un put()
+LOG_ASYNC = os.environ.get('LOG_ASYNC', 'true').lower() == 'true'
+LOG_RETRY_SAMPLE = int(os.environ.get('LOG_RETRY_SAMPLE', '10'))  # 1 message de retry sur N...
+LOG_SAMPLE_WINDOW = 60  # ...et au moins un par minute et par cle
+LOG_FIELDS = ('batch_id', 'page', 'provider', 'latency')
+
+# Lot / page en cours dans le thread (renseigne par process_tickets)
+log_context = threading.local()
+
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON valide par enregistrement, avec les champs structures"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'msg': record.getMessage()
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = round(value, 3) if field == 'latency' else value
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogContextFilter(logging.Filter):
+    """Complete batch_id / page a partir du contexte du thread appelant"""
+
+    def filter(self, record):
+        for field in ('batch_id', 'page'):
+            if getattr(record, field, None) is None:
+                setattr(record, field, getattr(log_context, field, None))
+        return True
+
+
+class RetrySampler(logging.Filter):
+    """Echantillonne les messages marques extra={'sample': cle} (retries, attentes)"""
+
+    def __init__(self, every, window):
+        super().__init__()
+        self.every = every
+        self.window = window
+        self.state = {}  # cle -> [messages ignores, dernier passage]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.every <= 1:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            state = self.state.setdefault(key, [0, 0.0])
+            if state[0] + 1 < self.every and now - state[1] < self.window:
+                state[0] += 1
+                return False
+            record.suppressed = state[0]
+            self.state[key] = [0, now]
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Met l'enregistrement en file tel quel : le formatage se fait dans le listener"""
+
+    def prepare(self, record):
+        return record
+
+
 logger = logging.getLogger('enop')
+logger.setLevel(LOG_LEVEL)
+logger.addFilter(LogContextFilter())
+logger.addFilter(RetrySampler(LOG_RETRY_SAMPLE, LOG_SAMPLE_WINDOW))
 
 handler = RotatingFileHandler('logs/enop.log', maxBytes=5*1024*1024, backupCount=3)
-handler.setFormatter(logging.Formatter(
-    '{"time": "%(asctime)s", "level": "%(levelname)s", "msg": "%(message)s"}'
-))
-logger.addHandler(handler)
+handler.setFormatter(JsonFormatter())
+
+if LOG_ASYNC:
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.propagate = False
+else:
+    logging.basicConfig(level=LOG_LEVEL)
+    logger.addHandler(handler)
 
 
 # ===================================================================
@@ -81,15 +170,106 @@ APP_PASSWORD_PLAIN = os.environ.get('APP_PASSWORD', 'changeme')
 # --- API Keys ---
 ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY', '')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+# URLs de base surchargeables (proxy d'entreprise, mock de test de charge)
+ANTHROPIC_BASE_URL = os.environ.get('ANTHROPIC_BASE_URL', 'https://api.anthropic.com').rstrip('/')
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com').rstrip('/')
 OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
 OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'qwen3-vl')
 
+# --- Pool Ollama (plusieurs serveurs locaux, separes par des virgules) ---
+OLLAMA_URLS = [u.strip().rstrip('/') for u in os.environ.get('OLLAMA_URLS', OLLAMA_URL).split(',') if u.strip()]
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_PING_INTERVAL = int(os.environ.get('OLLAMA_PING_INTERVAL', '240'))  # < keep_alive
+OLLAMA_FAILURE_COOLDOWN = 30
+
+# --- Sonde de sante des providers (arriere-plan, resultat en cache) ---
+HEALTH_CHECK_INTERVAL = int(os.environ.get('HEALTH_CHECK_INTERVAL', '30'))
+HEALTH_CHECK_TIMEOUT = 3
+
+# --- Modeles par niveau : rapide/economique d'abord, escalade si doute ---
+ANTHROPIC_MODEL = os.environ.get('ANTHROPIC_MODEL', 'claude-sonnet-4-20250514')
+ANTHROPIC_FAST_MODEL = os.environ.get('ANTHROPIC_FAST_MODEL', 'claude-3-5-haiku-20241022')
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o')
+OPENAI_FAST_MODEL = os.environ.get('OPENAI_FAST_MODEL', 'gpt-4o-mini')
+MODEL_TIERING = os.environ.get('MODEL_TIERING', 'true').lower() == 'true'
+TIER_EASY_MAX_CHARS = int(os.environ.get('TIER_EASY_MAX_CHARS', '1500'))
+TIER_EASY_VENDORS = re.compile(os.environ.get(
+    'TIER_EASY_VENDORS',
+    r'parking|indigo|effia|p[eé]age|autoroute|vinci|sanef|aprr|sncf|ouigo|uber|taxi|'
+    r'total ?energies|esso|shell|avia|intermarche|leclerc|carrefour'
+), re.IGNORECASE)
+TIER_MIN_CONFIDENCE = 0.7
+# Prix USD par million de tokens (entree, sortie) pour le suivi de cout par niveau
+MODEL_PRICES = {
+    'claude-sonnet-4-20250514': (3.0, 15.0),
+    'claude-3-5-haiku-20241022': (0.8, 4.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+}
+
+# --- Sortie structuree (schema JSON impose au modele) ---
+STRUCTURED_OUTPUT = os.environ.get('STRUCTURED_OUTPUT', 'true').lower() == 'true'
+# Reference du mode texte pour estimer les retries evites : compteurs persistes
+# des periodes en mode texte, sinon taux fourni (ex. mesure sur un autre deploiement)
+JSON_BASELINE_FILE = Path('json_baseline.json')
+JSON_TEXT_RETRY_RATE = float(os.environ['JSON_TEXT_RETRY_RATE']) if os.environ.get('JSON_TEXT_RETRY_RATE') else None
+JSON_BASELINE_MIN_RESPONSES = 20  # en dessous, le taux mesure n'est pas une reference
+JSON_BASELINE_SAVE_EVERY = 25     # reponses en mode texte entre deux sauvegardes
+
+# Schema des ecritures (cf. prompts/comptable.md) : compatible mode strict OpenAI
+ECRITURE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'date': {'type': 'string', 'description': 'JJ/MM/AAAA'},
+        'reference': {'type': 'string'},
+        'journal': {'type': 'string'},
+        'compte': {'type': 'string', 'description': 'Compte general sur 8 caracteres'},
+        'libelle': {'type': 'string'},
+        'debit': {'type': 'number'},
+        'credit': {'type': 'number'}
+    },
+    'required': ['date', 'reference', 'journal', 'compte', 'libelle', 'debit', 'credit'],
+    'additionalProperties': False
+}
+TICKET_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'exploitable': {'type': 'boolean'},
+        'raison_non_exploitable': {'type': 'string'},
+        'ecritures': {'type': 'array', 'items': ECRITURE_SCHEMA},
+        'confidence': {'type': 'number'}
+    },
+    'required': ['exploitable', 'raison_non_exploitable', 'ecritures', 'confidence'],
+    'additionalProperties': False
+}
+
 # --- Retry & Rate Limiting ---
 MAX_RETRIES = 3
 RETRY_BASE_DELAY = 2
 RATE_LIMIT_DELAY = 1.5
 RATE_LIMIT_429_WAIT = 30
 
+# --- Ordonnanceur : creneaux providers partages entre web, webhook et email ---
+PROVIDER_SLOTS = int(os.environ.get('PROVIDER_SLOTS', '2'))
+JOB_CLASSES = ('interactive', 'webhook', 'email')  # ordre de priorite
+# Poids par source, ex. "email:compta@client.fr=2,webhook:openclaw=1" (defaut 1)
+SCHEDULER_SOURCE_WEIGHTS = {
+    k.strip(): float(v) for k, _, v in (
+        item.rpartition('=') for item in os.environ.get('SCHEDULER_SOURCE_WEIGHTS', '').split(',') if '=' in item
+    )
+}
+
+# --- Budget de temps par lot (secondes, 0 = illimite), reparti sur les tentatives ---
+BATCH_BUDGET_SECONDS = {
+    'interactive': int(os.environ.get('INTERACTIVE_BUDGET_SECONDS', '300')),
+    'webhook': int(os.environ.get('WEBHOOK_BUDGET_SECONDS', '600')),
+    'email': int(os.environ.get('EMAIL_BUDGET_SECONDS', '1800'))
+}
+MIN_ATTEMPT_SECONDS = 5  # en dessous, une tentative n'a aucune chance d'aboutir
+
+# --- Pipeline analyse -> tampon -> ecriture (files bornees entre etages) ---
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '4'))
+
 # --- Brute-force protection ---
 LOGIN_ATTEMPTS_FILE = Path('login_attempts.json')
 MAX_LOGIN_ATTEMPTS = 5
@@ -100,6 +280,12 @@ PROCESS_RATE_LIMIT = {}
 
 # --- Webhook ---
 WEBHOOK_TOKEN = os.environ.get('WEBHOOK_TOKEN', '')
+# Resultats rejoues pour une meme Idempotency-Key (borne par la retention des fichiers)
+IDEMPOTENCY_TTL_MINUTES = int(os.environ.get('IDEMPOTENCY_TTL_MINUTES', '10'))
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'^[\w.:-]{1,128}$')
+# Attente maximale du resultat dans la requete ; au-dela : 202 + batch_id, le lot
+# continue et un nouvel envoi (meme cle ou meme corps) recupere le resultat
+WEBHOOK_WAIT_SECONDS = int(os.environ.get('WEBHOOK_WAIT_SECONDS', '120'))
 
 # --- Dossiers (temporaires, nettoyes apres usage) ---
 OUTPUT_FOLDER = Path('outputs')
@@ -108,16 +294,124 @@ OUTPUT_FOLDER.mkdir(exist_ok=True)
 # --- Auto-delete : supprimer les fichiers de plus de X minutes ---
 FILE_RETENTION_MINUTES = int(os.environ.get('FILE_RETENTION_MINUTES', '10'))
 
+# --- Telechargements ---
+# X-Sendfile : le reverse proxy sert le fichier (suppression laissee a l'expiration)
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'false').lower() == 'true'
+# Corps servi en zero-copy (wsgi.file_wrapper / sendfile) : aucun octet ne passe
+# par Python, l'envoi complet n'est pas observable. true : suppression a la
+# fermeture (ZDR ; une coupure pendant l'envoi n'est pas reprenable) ; false :
+# fichier conserve jusqu'a FILE_RETENTION_MINUTES (reprise Range possible).
+ZDR_DELETE_ZERO_COPY = os.environ.get('ZDR_DELETE_ZERO_COPY', 'true').lower() == 'true'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+BATCH_ID_PATTERN = re.compile(r'^\d{8}_\d{6}_[0-9a-f]{6}$')
+
+# --- Journal de reprise (ecritures validees uniquement, jamais les PDFs) ---
+JOURNAL_FOLDER = Path('journal')
+JOURNAL_FOLDER.mkdir(exist_ok=True)
+JOURNAL_RETENTION_MINUTES = int(os.environ.get('JOURNAL_RETENTION_MINUTES', str(FILE_RETENTION_MINUTES)))
+# Periode de purge des journaux, captures et profils par la boucle de nettoyage (meme sans nouveau lot)
+RETENTION_SWEEP_SECONDS = max(1, min(60, JOURNAL_RETENTION_MINUTES * 60))
+
+# --- Optimisation du PDF tamponne fusionne (pieces jointes < limite Gmail de 25 Mo) ---
+PDF_OPTIMIZE = os.environ.get('PDF_OPTIMIZE', 'true').lower() == 'true'
+PDF_IMAGE_DPI = int(os.environ.get('PDF_IMAGE_DPI', '0'))  # 0 : images intactes sauf si PDF_MAX_BYTES depasse
+PDF_IMAGE_QUALITY = int(os.environ.get('PDF_IMAGE_QUALITY', '75'))
+PDF_MAX_BYTES = int(os.environ.get('PDF_MAX_BYTES', str(20 * 1024 * 1024)))  # 0 = pas de limite
+PDF_MIN_IMAGE_DPI = 100  # plancher de lisibilite des tickets
+
+# --- Profilage a la demande (cProfile) ---
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # vide : profilage HTTP desactive
+PROFILE_EMAIL = os.environ.get('PROFILE_EMAIL', 'false').lower() == 'true'
+PROFILE_FOLDER = Path('profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '20'))
+PROFILE_RETENTION_MINUTES = int(os.environ.get('PROFILE_RETENTION_MINUTES', '60'))
+PROFILE_TOP_N = 15
+
+# --- Registre des ecritures validees (SQLite, optionnel) : aucune image ni PDF stocke ---
+LEDGER_ENABLED = os.environ.get('LEDGER_ENABLED', 'false').lower() == 'true'
+LEDGER_PATH = Path(os.environ.get('LEDGER_PATH', 'ledger/ecritures.sqlite3'))
+LEDGER_RETENTION_DAYS = int(os.environ.get('LEDGER_RETENTION_DAYS', '400'))  # 0 = conservation illimitee
+
+# --- Capture du trafic (opt-in) : metadonnees anonymes par page, aucun contenu (ZDR) ---
+TRAFFIC_CAPTURE = os.environ.get('TRAFFIC_CAPTURE', 'false').lower() == 'true'
+CAPTURE_FOLDER = Path(os.environ.get('CAPTURE_FOLDER', 'captures'))
+CAPTURE_RETENTION_DAYS = int(os.environ.get('CAPTURE_RETENTION_DAYS', '30'))
+
+# --- Decoupage adaptatif (pages, puis zones de tickets sur les scans) ---
+SPLIT_MIN_PAGES = int(os.environ.get('SPLIT_MIN_PAGES', '3'))
+SPLIT_MAX_BYTES = int(os.environ.get('SPLIT_MAX_BYTES', str(5 * 1024 * 1024)))
+REGION_SEGMENTATION = os.environ.get('REGION_SEGMENTATION', 'true').lower() == 'true'
+REGION_RENDER_DPI = 36
+REGION_OUTPUT_DPI = 200
+REGION_MIN_GUTTER = 0.06   # bande blanche minimale (fraction de la zone decoupee)
+REGION_GAP_FACTOR = 3      # ... et multiple de l'interligne / espace median de la zone
+REGION_MIN_AREA = 0.03     # zone minimale de part et d'autre d'une coupe (fraction de la page)
+REGION_MIN_COVERAGE = 0.99  # part de l'encre que les zones doivent couvrir, sinon page entiere
+REGION_MAX_WIDTH = 0.5     # largeur maximale d'une zone (fraction de la page) : tickets de caisse
+REGION_ALIGNED_LINES = 0.6  # lignes alignees de part et d'autre d'une coupe verticale : tableau
+REGION_MAX = 6
+
+# --- Controle qualite local avant analyse (pages blanches / illisibles) ---
+PREFLIGHT = os.environ.get('PREFLIGHT', 'true').lower() == 'true'
+PREFLIGHT_MIN_SIDE_PT = float(os.environ.get('PREFLIGHT_MIN_SIDE_PT', '60'))
+PREFLIGHT_MIN_INK = float(os.environ.get('PREFLIGHT_MIN_INK', '0.002'))        # part de pixels encres
+PREFLIGHT_MIN_CONTRAST = float(os.environ.get('PREFLIGHT_MIN_CONTRAST', '12'))  # ecart-type niveaux de gris
+PREFLIGHT_MIN_SHARPNESS = float(os.environ.get('PREFLIGHT_MIN_SHARPNESS', '0.08'))  # gradient / contraste
+PREFLIGHT_DPI = 72
+# Contraste / nettete faibles : rejet seulement si strict (sinon simple trace)
+PREFLIGHT_STRICT = os.environ.get('PREFLIGHT_STRICT', 'false').lower() == 'true'
+
+# --- Reduction du texte envoye aux LLM (pages avec couche texte) ---
+TEXT_COMPACT = os.environ.get('TEXT_COMPACT', 'true').lower() == 'true'
+TEXT_TOKEN_BUDGET = int(os.environ.get('TEXT_TOKEN_BUDGET', '800'))  # tokens estimes par page, 0 = illimite
+CHARS_PER_TOKEN = 4  # estimation sans tokenizer (texte latin)
+BOILERPLATE_MIN_TICKETS = int(os.environ.get('BOILERPLATE_MIN_TICKETS', '5'))  # ligne vue sur N tickets = gabarit
+BOILERPLATE_HEADER_LINES = 2  # premieres lignes (enseigne) jamais retirees
+BOILERPLATE_FILE = Path('boilerplate_lines.json')  # empreintes des lignes uniquement, pas de texte
+BOILERPLATE_MAX_KEYS = 50000
+BOILERPLATE_SAVE_EVERY = 25  # tickets observes entre deux sauvegardes
+
+# --- Detection des doublons (hash perceptuel + empreinte texte) ---
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', '6'))  # bits sur 64
+DUPLICATE_HISTORY_MINUTES = int(os.environ.get('DUPLICATE_HISTORY_MINUTES', '60'))
+
+# --- Controles du lot entier (colonnaire, NumPy) ---
+# Compte de charge -> (part de TVA deductible, taux de TVA attendu ou None si variable ;
+# avec None, seule une part nulle est controlee : aucune TVA deductible attendue)
+DEDUCTIBILITY_RULES = {
+    '62520000': (0.8, 0.20),  # carburant vehicule de tourisme : 80% de la TVA a 20%
+    '62560000': (0.0, None),  # repas
+    '62560100': (0.0, None),  # hebergement
+}
+DEDUCTIBILITY_TOLERANCE = 0.05  # euros
+
 # --- Email (optionnel) ---
 EMAIL_ADDRESS = os.environ.get('EMAIL_ADDRESS', '')
 EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
-IMAP_SERVER = 'imap.gmail.com'
-SMTP_SERVER = 'smtp.gmail.com'
-SMTP_PORT = 465
-CHECK_INTERVAL = 30
+IMAP_SERVER = os.environ.get('IMAP_SERVER', 'imap.gmail.com')
+IMAP_PORT = int(os.environ.get('IMAP_PORT', '993'))
+IMAP_SSL = os.environ.get('IMAP_SSL', 'true').lower() == 'true'
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '465'))
+SMTP_SECURITY = os.environ.get('SMTP_SECURITY', 'ssl').lower()  # ssl | starttls | none
+CHECK_INTERVAL = int(os.environ.get('CHECK_INTERVAL', '30'))
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', '4'))
+EMAIL_QUEUE_SIZE = int(os.environ.get('EMAIL_QUEUE_SIZE', str(EMAIL_WORKERS * 2)))
+EMAIL_MAX_ATTEMPTS = 3
+SMTP_IDLE_TIMEOUT = 240  # Gmail coupe les sessions inactives apres ~5 min
+
+# --- Prompt comptable (externalise, lu au premier appel) ---
+PROMPT_PATH = Path('prompts/comptable.md')
+
+
+@lru_cache(maxsize=1)
+def get_system_prompt():
+    return PROMPT_PATH.read_text(encoding='utf-8')
 
-# --- Prompt comptable (externalise) ---
-SYSTEM_PROMPT = Path('prompts/comptable.md').read_text(encoding='utf-8')
+
+# --- Demarrage : prechargement des bibliotheques en arriere-plan (optionnel) ---
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() == 'true'
+PORT = int(os.environ.get('PORT', '5000'))
 
 
 # ===================================================================
@@ -241,25 +535,110 @@ def sanitize_filename(filename):
     return filename
 
 
+# Registre des fichiers de sortie : nom -> (echeance, taille) + tas des echeances
+output_registry = {}
+output_expiry_heap = []
+output_cond = threading.Condition()
+
+
+def register_output(filepath, expires_at=None):
+    """Enregistre un fichier de sortie avec son echeance de suppression"""
+    filepath = Path(filepath)
+    st = filepath.stat()
+    if expires_at is None:
+        expires_at = time.time() + FILE_RETENTION_MINUTES * 60
+    with output_cond:
+        output_registry[filepath.name] = (expires_at, st.st_size)
+        heapq.heappush(output_expiry_heap, (expires_at, filepath.name))
+        output_cond.notify()
+
+
+def unregister_output(name):
+    """Retire un fichier du registre (deja supprime, ex: apres download)"""
+    with output_cond:
+        output_registry.pop(name, None)
+
+
+def write_output(name, data):
+    """Ecrit un fichier de sortie et l'enregistre pour suppression automatique"""
+    filepath = OUTPUT_FOLDER / name
+    filepath.write_bytes(data)
+    register_output(filepath)
+    return {'name': name, 'path': str(filepath)}
+
+
+def rebuild_output_registry():
+    """Reconstruit le registre depuis le disque (demarrage)"""
+    retention = FILE_RETENTION_MINUTES * 60
+    with output_cond:
+        output_registry.clear()
+        output_expiry_heap.clear()
+    for f in OUTPUT_FOLDER.iterdir():
+        if f.is_file():
+            try:
+                register_output(f, expires_at=f.stat().st_mtime + retention)
+            except FileNotFoundError:
+                pass
+    logger.info(f"[Cleanup] Registre reconstruit : {len(output_registry)} fichier(s)")
+
+
+def output_stats():
+    """Nombre de fichiers de sortie vivants et taille totale"""
+    with output_cond:
+        return {
+            'count': len(output_registry),
+            'bytes': sum(size for _, size in output_registry.values())
+        }
+
+
 def cleanup_old_files():
-    """Supprime les fichiers de sortie de plus de FILE_RETENTION_MINUTES"""
-    try:
-        cutoff = datetime.now() - timedelta(minutes=FILE_RETENTION_MINUTES)
-        for f in OUTPUT_FOLDER.iterdir():
-            if f.is_file():
-                mtime = datetime.fromtimestamp(f.stat().st_mtime)
-                if mtime < cutoff:
-                    f.unlink()
-                    logger.info(f"[Cleanup] Supprime {f.name}")
-    except Exception as e:
-        logger.error(f"[Cleanup] Erreur: {e}")
+    """Supprime les fichiers de sortie dont l'echeance est passee"""
+    now = time.time()
+    expired = []
+    with output_cond:
+        while output_expiry_heap and output_expiry_heap[0][0] <= now:
+            expires_at, name = heapq.heappop(output_expiry_heap)
+            entry = output_registry.get(name)
+            # Entree perimee du tas (fichier reenregistre ou deja telecharge)
+            if entry is None or entry[0] != expires_at:
+                continue
+            del output_registry[name]
+            expired.append(name)
+    for name in expired:
+        try:
+            (OUTPUT_FOLDER / name).unlink()
+            logger.info(f"[Cleanup] Supprime {name}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"[Cleanup] Erreur: {e}")
+
+
+def purge_retained_files():
+    """Journaux, captures et profils dont la retention est depassee"""
+    purge_journals()
+    purge_captures()
+    prune_profiles()
 
 
 def schedule_cleanup():
-    """Lance le nettoyage automatique toutes les 5 minutes"""
+    """Supprime chaque fichier de sortie a son echeance exacte
+
+    Journaux, captures et profils sont purges toutes les RETENTION_SWEEP_SECONDS,
+    y compris apres le dernier lot d'une session (attente bornee).
+    """
+    rebuild_output_registry()
+    next_sweep = 0.0
     while True:
-        time.sleep(300)
         cleanup_old_files()
+        if time.time() >= next_sweep:
+            purge_retained_files()
+            next_sweep = time.time() + RETENTION_SWEEP_SECONDS
+        with output_cond:
+            timeout = max(0, next_sweep - time.time())
+            if output_expiry_heap:
+                timeout = min(timeout, max(0, output_expiry_heap[0][0] - time.time()))
+            output_cond.wait(timeout)
 
 
 # ===================================================================
@@ -308,6 +687,7 @@ def security_headers(response):
 
 def extract_text_from_pdf(pdf_bytes):
     """Extrait le texte d'un PDF avec PyMuPDF"""
+    import fitz
     try:
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         text = ""
@@ -321,6 +701,7 @@ def extract_text_from_pdf(pdf_bytes):
 
 def split_pdf_pages(pdf_bytes, filename):
     """Decoupe un PDF en pages individuelles"""
+    from PyPDF2 import PdfReader, PdfWriter
     reader = PdfReader(io.BytesIO(pdf_bytes))
     pages = []
     for i, page in enumerate(reader.pages):
@@ -338,8 +719,184 @@ def split_pdf_pages(pdf_bytes, filename):
     return pages
 
 
+# Pixel gris -> 1 si encre, 0 si fond (bytes.translate : masque calcule en C)
+INK_TABLE = bytes(1 if v < 200 else 0 for v in range(256))
+
+
+def should_split(page_count, size):
+    """Decoupe par page si plus rentable qu'un appel sur le document entier"""
+    if page_count <= 1:
+        return False
+    # 1-2 pages : souvent une seule facture, un appel global reste moins cher ;
+    # au-dela, ou si le document est lourd, des pages independantes se
+    # parallelisent et se rejouent une a une
+    return page_count >= SPLIT_MIN_PAGES or size > SPLIT_MAX_BYTES
+
+
+def blank_runs(profile, limit, min_length):
+    """Plages interieures (debut, fin) ou le profil d'encre reste sous la limite"""
+    runs = []
+    start = None
+    for i, value in enumerate(profile):
+        if value <= limit:
+            if start is None:
+                start = i
+        elif start is not None:
+            if start > 0 and i - start >= min_length:
+                runs.append((start, i))
+            start = None
+    return runs
+
+
+def ink_box(mask, box):
+    """Boite englobante de l'encre dans une zone (None si vide)"""
+    x0, y0, x1, y1 = box
+    rows = [y for y in range(y0, y1) if mask[y].find(1, x0, x1) >= 0]
+    if not rows:
+        return None
+    left = min(mask[y].find(1, x0, x1) for y in rows)
+    right = max(mask[y].rfind(1, x0, x1) for y in rows) + 1
+    return (left, rows[0], right, rows[-1] + 1)
+
+
+def line_starts(mask, box):
+    """Ordonnees des debuts de lignes de texte dans une zone"""
+    x0, y0, x1, y1 = box
+    inked = [mask[y].find(1, x0, x1) >= 0 for y in range(y0, y1)]
+    return [y0 + i for i, v in enumerate(inked) if v and (i == 0 or not inked[i - 1])]
+
+
+def aligned_columns(mask, parts):
+    """Vrai si les lignes des deux parties sont alignees (colonnes d'un tableau)"""
+    starts = [line_starts(mask, part) for part in parts]
+    fewer, other = sorted(starts, key=len)
+    if not fewer:
+        return False
+    other = set(other)
+    matched = sum(1 for y in fewer if {y - 1, y, y + 1} & other)
+    return matched >= REGION_ALIGNED_LINES * len(fewer)
+
+
+def xy_cut(mask, box, min_gutter, min_area, depth=0):
+    """Decoupe recursive d'une zone le long de la plus large bande blanche valide
+
+    Une coupe exige une bande large par rapport a la zone (REGION_MIN_GUTTER)
+    et a ses interlignes (REGION_GAP_FACTOR), et, de chaque cote, une partie
+    assez grande pour etre un ticket : un en-tete, une colonne de prix ou un
+    bloc de totaux ne sont pas detaches.
+    Une coupe verticale entre lignes alignees (tableau) est refusee.
+    """
+    box = ink_box(mask, box)
+    if box is None:
+        return []
+    x0, y0, x1, y1 = box
+    if depth >= 3:
+        return [box]
+    row_profile = [mask[y].count(1, x0, x1) for y in range(y0, y1)]
+    col_profile = [sum(col) for col in zip(*(mask[y][x0:x1] for y in range(y0, y1)))]
+
+    def area(part):
+        found = ink_box(mask, part)
+        return (found[2] - found[0]) * (found[3] - found[1]) if found else 0
+
+    # Tolerance de quelques points de poussiere par ligne/colonne
+    gaps = []
+    for axis, profile, limit in (('y', row_profile, (x1 - x0) // 100), ('x', col_profile, (y1 - y0) // 100)):
+        spacing = sorted(end - start for start, end in blank_runs(profile, limit, 1))
+        if not spacing:
+            continue
+        median = spacing[len(spacing) // 2]
+        threshold = max(min_gutter, int(REGION_MIN_GUTTER * len(profile)), REGION_GAP_FACTOR * median)
+        gaps += [(end - start, axis, start, end) for start, end in blank_runs(profile, limit, threshold)]
+    for _, axis, start, end in sorted(gaps, reverse=True):
+        if axis == 'y':
+            parts = [(x0, y0, x1, y0 + start), (x0, y0 + end, x1, y1)]
+        else:
+            parts = [(x0, y0, x0 + start, y1), (x0 + end, y0, x1, y1)]
+        if all(area(part) >= min_area for part in parts) and not (axis == 'x' and aligned_columns(mask, parts)):
+            return [region for part in parts for region in xy_cut(mask, part, min_gutter, min_area, depth + 1)]
+    return [box]
+
+
+def find_ticket_regions(page):
+    """Zones de tickets distinctes sur une page scannee (analyse des bandes blanches)
+
+    Les petits fragments restent dans la zone voisine (xy_cut ne les detache
+    pas) ; la segmentation n'est retenue que si les zones couvrent toute
+    l'encre, sinon la page est analysee entiere.
+    """
+    import fitz
+    zoom = REGION_RENDER_DPI / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    w, h, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+    mask = [samples[y * stride:y * stride + w].translate(INK_TABLE) for y in range(h)]
+
+    min_gutter = max(2, int(0.02 * min(w, h)))
+    min_area = REGION_MIN_AREA * w * h
+    regions = xy_cut(mask, (0, 0, w, h), min_gutter, min_area)
+    if not 2 <= len(regions) <= REGION_MAX:
+        return []
+    # Zone large : document pleine page (facture), pas un ticket de caisse
+    if any(x1 - x0 > REGION_MAX_WIDTH * w for x0, _, x1, _ in regions):
+        return []
+
+    # Encre hors des zones (poussiere toleree dans les bandes) : page entiere
+    total_ink = sum(row.count(1) for row in mask)
+    covered = sum(mask[y][x0:x1].count(1) for x0, y0, x1, y1 in regions for y in range(y0, y1))
+    if covered < REGION_MIN_COVERAGE * total_ink:
+        return []
+
+    # Retour en coordonnees page, avec une petite marge
+    margin = 4
+    return [
+        fitz.Rect(x0 / zoom - margin, y0 / zoom - margin, x1 / zoom + margin, y1 / zoom + margin) & page.rect
+        for x0, y0, x1, y1 in regions
+    ]
+
+
+def split_ticket_regions(file_info):
+    """Decoupe une page scannee contenant plusieurs tickets en une page par ticket"""
+    import fitz
+    try:
+        doc = fitz.open(stream=file_info['bytes'], filetype="pdf")
+    except Exception:
+        return [file_info]
+    try:
+        if len(doc) != 1 or doc[0].rotation or len(doc[0].get_text().strip()) > 50:
+            return [file_info]
+        regions = find_ticket_regions(doc[0])
+        if not regions:
+            return [file_info]
+
+        stem = Path(file_info['filename']).stem
+        units = []
+        for i, rect in enumerate(regions):
+            # Page scannee : on re-echantillonne la seule zone (sinon chaque zone
+            # embarquerait l'image complete de la page)
+            pix = doc[0].get_pixmap(dpi=REGION_OUTPUT_DPI, clip=rect)
+            out = fitz.open()
+            out_page = out.new_page(width=rect.width, height=rect.height)
+            out_page.insert_image(out_page.rect, stream=pix.tobytes('jpeg', jpg_quality=85))
+            units.append({
+                'filename': f"{stem}_zone{i+1}.pdf",
+                'bytes': out.tobytes(garbage=1),
+                'original_filename': file_info.get('original_filename', file_info['filename'])
+            })
+            out.close()
+        logger.info(f"Zones {file_info['filename']} : {len(units)} tickets detectes")
+        return units
+    except Exception as e:
+        logger.error(f"Erreur zones {file_info['filename']}: {e}")
+        return [file_info]
+    finally:
+        doc.close()
+
+
 def stamp_pdf_with_s(pdf_bytes):
     """Ajoute un S rouge sur le PDF"""
+    from PyPDF2 import PdfReader, PdfWriter
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.colors import red
     reader = PdfReader(io.BytesIO(pdf_bytes))
     writer = PdfWriter()
     for page in reader.pages:
@@ -362,46 +919,164 @@ def stamp_pdf_with_s(pdf_bytes):
     return output.read()
 
 
-def merge_pdfs(pdf_list):
-    """Fusionne plusieurs PDFs en un seul"""
-    writer = PdfWriter()
-    for pdf_bytes in pdf_list:
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        for page in reader.pages:
-            writer.add_page(page)
-    output = io.BytesIO()
-    writer.write(output)
-    output.seek(0)
-    return output.read()
+def downsample_images(doc, dpi, quality):
+    """Re-encode en JPEG les images dont la resolution effective depasse dpi"""
+    import fitz
+    seen = set()
+    count = 0
+    for page in doc:
+        for img in page.get_images(full=True):
+            xref, smask, width, height = img[0], img[1], img[2], img[3]
+            if xref in seen or smask:
+                continue
+            seen.add(xref)
+            rects = page.get_image_rects(xref)
+            if not rects:
+                continue
+            rect = max(rects, key=lambda r: r.width * r.height)
+            if rect.width <= 0 or rect.height <= 0:
+                continue
+            effective = max(width * 72 / rect.width, height * 72 / rect.height)
+            if effective <= dpi * 1.1:
+                continue
+            scale = dpi / effective
+            pix = fitz.Pixmap(doc, xref)
+            if pix.alpha:
+                pix = fitz.Pixmap(pix, 0)
+            if pix.n > 3:
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            small = fitz.Pixmap(pix, max(1, int(pix.width * scale)), max(1, int(pix.height * scale)), None)
+            data = small.tobytes('jpeg', jpg_quality=quality)
+            if len(data) < len(doc.xref_stream_raw(xref) or b''):
+                page.replace_image(xref, stream=data)
+                count += 1
+    return count
+
+
+def optimize_pdf(pdf_bytes):
+    """Reduit le PDF tamponne fusionne ; renvoie (octets, statistiques)
+
+    Dedoublonnage des objets identiques (dont la police du S repetee sur
+    chaque page), suppression des objets orphelins, compression des flux.
+    Les images sont sous-echantillonnees a PDF_IMAGE_DPI si demande, puis par
+    paliers tant que le fichier depasse PDF_MAX_BYTES.
+    """
+    import fitz
+    start = time.time()
+    save_options = dict(garbage=4, deflate=True, deflate_images=True, deflate_fonts=True, use_objstms=1)
+    images = 0
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if PDF_IMAGE_DPI:
+            images += downsample_images(doc, PDF_IMAGE_DPI, PDF_IMAGE_QUALITY)
+        output = doc.tobytes(**save_options)
+        dpi = PDF_IMAGE_DPI or 200
+        while PDF_MAX_BYTES and len(output) > PDF_MAX_BYTES and dpi > PDF_MIN_IMAGE_DPI:
+            dpi = max(PDF_MIN_IMAGE_DPI, dpi * 3 // 4)
+            images += downsample_images(doc, dpi, PDF_IMAGE_QUALITY)
+            output = doc.tobytes(**save_options)
+    finally:
+        doc.close()
+    if len(output) >= len(pdf_bytes):
+        output = pdf_bytes
+    return output, {
+        'bytes_in': len(pdf_bytes),
+        'bytes_out': len(output),
+        'images_downsampled': images,
+        'seconds': round(time.time() - start, 3)
+    }
 
 
 # ===================================================================
 # PROVIDERS IA
 # ===================================================================
 
-def call_anthropic(user_content):
+# Suivi latence / tokens / cout par niveau de modele
+tier_stats = {
+    tier: {'calls': 0, 'latency': 0.0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0}
+    for tier in ('fast', 'large')
+}
+tier_stats_lock = threading.Lock()
+tier_escalations = {'accepted': 0, 'escalated': 0}
+
+
+def record_model_usage(model, latency, input_tokens, output_tokens):
+    tier = 'fast' if model in (ANTHROPIC_FAST_MODEL, OPENAI_FAST_MODEL) else 'large'
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    with tier_stats_lock:
+        st = tier_stats[tier]
+        st['calls'] += 1
+        st['latency'] += latency
+        st['input_tokens'] += input_tokens
+        st['output_tokens'] += output_tokens
+        st['cost'] += (input_tokens * price_in + output_tokens * price_out) / 1_000_000
+    logger.debug("[Usage] %s : %.2fs, %d tokens entree / %d sortie",
+                  model, latency, input_tokens, output_tokens, extra={'latency': latency})
+
+
+def tier_report():
+    """Latence moyenne, tokens et cout cumule par niveau + taux d'escalade"""
+    with tier_stats_lock:
+        report = {}
+        for tier, st in tier_stats.items():
+            report[tier] = {
+                'calls': st['calls'],
+                'avg_latency': round(st['latency'] / st['calls'], 2) if st['calls'] else None,
+                'input_tokens': st['input_tokens'],
+                'output_tokens': st['output_tokens'],
+                'cost_usd': round(st['cost'], 4)
+            }
+        report['escalations'] = dict(tier_escalations)
+    return report
+
+
+def anthropic_payload(user_content, model=ANTHROPIC_MODEL):
+    payload = {
+        'model': model,
+        'max_tokens': 4000,
+        'system': get_system_prompt(),
+        'messages': [{'role': 'user', 'content': user_content}]
+    }
+    if STRUCTURED_OUTPUT:
+        # Tool use force : Claude renvoie directement un objet conforme au schema
+        payload['tools'] = [{
+            'name': 'enregistrer_ecritures',
+            'description': 'Enregistre le resultat de l\'analyse du ticket',
+            'input_schema': TICKET_SCHEMA
+        }]
+        payload['tool_choice'] = {'type': 'tool', 'name': 'enregistrer_ecritures'}
+    return payload
+
+
+def call_anthropic(user_content, model=ANTHROPIC_MODEL, timeout=120):
     """Appel Claude API"""
+    import requests
     if not ANTHROPIC_API_KEY:
         raise Exception("Anthropic: cle API non configuree")
 
+    start = time.time()
     response = requests.post(
-        'https://api.anthropic.com/v1/messages',
+        f'{ANTHROPIC_BASE_URL}/v1/messages',
         headers={
             'Content-Type': 'application/json',
             'x-api-key': ANTHROPIC_API_KEY,
             'anthropic-version': '2023-06-01'
         },
-        json={
-            'model': 'claude-sonnet-4-20250514',
-            'max_tokens': 4000,
-            'system': SYSTEM_PROMPT,
-            'messages': [{'role': 'user', 'content': user_content}]
-        },
-        timeout=120
+        json=anthropic_payload(user_content, model),
+        timeout=timeout
     )
 
     if response.status_code == 200:
-        return response.json()['content'][0]['text']
+        data = response.json()
+        usage = data.get('usage', {})
+        record_model_usage(model, time.time() - start, usage.get('input_tokens', 0), usage.get('output_tokens', 0))
+        content = data['content']
+        if STRUCTURED_OUTPUT:
+            tool_use = next((b for b in content if b.get('type') == 'tool_use'), None)
+            if tool_use is None:
+                raise ValueError("reponse sans appel d'outil")
+            return tool_use['input']
+        return content[0]['text']
 
     error_msg = f"Anthropic HTTP {response.status_code}"
     try:
@@ -413,8 +1088,26 @@ def call_anthropic(user_content):
     raise Exception(error_msg)
 
 
-def call_openai(user_content):
+def openai_payload(messages_content, model=OPENAI_MODEL):
+    payload = {
+        'model': model,
+        'max_tokens': 4000,
+        'messages': [
+            {'role': 'system', 'content': get_system_prompt()},
+            {'role': 'user', 'content': messages_content}
+        ]
+    }
+    if STRUCTURED_OUTPUT:
+        payload['response_format'] = {
+            'type': 'json_schema',
+            'json_schema': {'name': 'ecritures', 'strict': True, 'schema': TICKET_SCHEMA}
+        }
+    return payload
+
+
+def call_openai(user_content, model=OPENAI_MODEL, timeout=120):
     """Appel OpenAI GPT-4o (fallback 1)"""
+    import requests
     if not OPENAI_API_KEY:
         raise Exception("OpenAI: cle API non configuree")
 
@@ -433,58 +1126,409 @@ def call_openai(user_content):
     else:
         messages_content = user_content
 
+    start = time.time()
     response = requests.post(
-        'https://api.openai.com/v1/chat/completions',
+        f'{OPENAI_BASE_URL}/v1/chat/completions',
         headers={
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {OPENAI_API_KEY}'
         },
-        json={
-            'model': 'gpt-4o',
-            'max_tokens': 4000,
-            'messages': [
-                {'role': 'system', 'content': SYSTEM_PROMPT},
-                {'role': 'user', 'content': messages_content}
-            ]
-        },
-        timeout=120
+        json=openai_payload(messages_content, model),
+        timeout=timeout
     )
 
     if response.status_code == 200:
-        return response.json()['choices'][0]['message']['content']
+        data = response.json()
+        usage = data.get('usage', {})
+        record_model_usage(model, time.time() - start, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        message = data['choices'][0]['message']
+        if STRUCTURED_OUTPUT:
+            if message.get('refusal'):
+                raise ValueError(f"refus du modele: {message['refusal']}")
+            return json.loads(message['content'])
+        return message['content']
     raise Exception(f"OpenAI HTTP {response.status_code}")
 
 
-def call_ollama(text_content):
+# Etat par serveur Ollama : requetes en cours + sante
+ollama_pool = {
+    url: {
+        'outstanding': 0, 'healthy': None, 'failures': 0, 'down_until': 0.0,
+        'latency': None, 'last_check': None, 'last_error': ''
+    }
+    for url in OLLAMA_URLS
+}
+ollama_pool_lock = threading.Lock()
+
+
+def acquire_ollama_endpoint():
+    """Choisit le serveur Ollama le moins charge parmi ceux disponibles"""
+    now = time.time()
+    with ollama_pool_lock:
+        available = [u for u, st in ollama_pool.items() if st['down_until'] <= now]
+        if not available:
+            # Tous en quarantaine : on tente celui qui en sort le plus tot
+            available = [min(ollama_pool, key=lambda u: ollama_pool[u]['down_until'])]
+        url = min(available, key=lambda u: (ollama_pool[u]['outstanding'], ollama_pool[u]['latency'] or 0))
+        ollama_pool[url]['outstanding'] += 1
+        return url
+
+
+def record_ollama_result(url, ok, latency=None, error=''):
+    """Met a jour la sante d'un serveur Ollama apres un appel ou un ping"""
+    with ollama_pool_lock:
+        st = ollama_pool[url]
+        was_healthy = st['healthy']
+        st['last_check'] = time.time()
+        if ok:
+            st['healthy'] = True
+            st['failures'] = 0
+            st['down_until'] = 0.0
+            if latency is not None:
+                st['latency'] = latency if st['latency'] is None else 0.8 * st['latency'] + 0.2 * latency
+        else:
+            st['healthy'] = False
+            st['failures'] += 1
+            st['last_error'] = error
+            st['down_until'] = time.time() + OLLAMA_FAILURE_COOLDOWN * min(st['failures'], 10)
+    if was_healthy is not ok:
+        logger.info(f"[Ollama] {url} : {'OK' if ok else 'HS - ' + error}")
+
+
+def release_ollama_endpoint(url, ok, latency=None, error=''):
+    with ollama_pool_lock:
+        ollama_pool[url]['outstanding'] -= 1
+    record_ollama_result(url, ok, latency, error)
+
+
+def ollama_pool_status():
+    """Etat du pool Ollama pour /api/status"""
+    with ollama_pool_lock:
+        return {
+            url: {
+                'healthy': bool(st['healthy']),
+                'outstanding': st['outstanding'],
+                'latency': round(st['latency'], 2) if st['latency'] is not None else None
+            }
+            for url, st in ollama_pool.items()
+        }
+
+
+def warm_ollama_endpoint(url):
+    """Charge le modele en memoire (prompt vide) et prolonge son keep_alive"""
+    import requests
+    try:
+        r = requests.post(
+            f'{url}/api/generate',
+            json={'model': OLLAMA_MODEL, 'prompt': '', 'keep_alive': OLLAMA_KEEP_ALIVE},
+            timeout=180
+        )
+        if r.status_code == 200:
+            record_ollama_result(url, True)
+            return True
+        record_ollama_result(url, False, error=f"HTTP {r.status_code}")
+    except Exception as e:
+        record_ollama_result(url, False, error=type(e).__name__)
+    return False
+
+
+def ollama_keepalive_loop():
+    """Warmup au demarrage puis ping periodique : le modele reste resident"""
+    while True:
+        for url in OLLAMA_URLS:
+            warm_ollama_endpoint(url)
+        time.sleep(OLLAMA_PING_INTERVAL)
+
+
+def call_ollama(text_content, timeout=180):
     """Appel Ollama local (fallback 2 - texte uniquement)"""
+    import requests
     if not text_content or not isinstance(text_content, str):
         raise Exception("Ollama: pas de texte disponible")
 
-    prompt = f"{SYSTEM_PROMPT}\n\nAnalyse ce ticket de frais :\n\n{text_content}"
+    prompt = f"{get_system_prompt()}\n\nAnalyse ce ticket de frais :\n\n{text_content}"
 
+    url = acquire_ollama_endpoint()
+    start = time.time()
     try:
         response = requests.post(
-            f'{OLLAMA_URL}/api/generate',
+            f'{url}/api/generate',
             json={
                 'model': OLLAMA_MODEL,
                 'prompt': prompt,
                 'stream': False,
-                'options': {'temperature': 0.1, 'num_predict': 4000}
+                'keep_alive': OLLAMA_KEEP_ALIVE,
+                'options': {'temperature': 0.1, 'num_predict': 4000},
+                **({'format': TICKET_SCHEMA} if STRUCTURED_OUTPUT else {})
             },
-            timeout=180
+            timeout=timeout
         )
     except requests.exceptions.ConnectionError:
-        raise Exception("Ollama: serveur non accessible")
+        release_ollama_endpoint(url, False, error='connexion refusee')
+        raise Exception(f"Ollama: serveur non accessible ({url})")
+    except Exception as e:
+        release_ollama_endpoint(url, False, error=type(e).__name__)
+        raise
 
     if response.status_code == 200:
-        return response.json().get('response', '')
+        release_ollama_endpoint(url, True, latency=time.time() - start)
+        text = response.json().get('response', '')
+        return json.loads(text) if STRUCTURED_OUTPUT else text
+    release_ollama_endpoint(url, False, error=f"HTTP {response.status_code}")
     raise Exception(f"Ollama HTTP {response.status_code}")
 
 
+# ===================================================================
+# SANTE DES PROVIDERS
+# ===================================================================
+
+# Cache : provider -> {'ok', 'checked_at', 'latency', 'error'} (ok=None : jamais sonde)
+provider_health = {
+    name: {'ok': None, 'checked_at': None, 'latency': None, 'error': ''}
+    for name in ('anthropic', 'openai', 'ollama')
+}
+provider_health_lock = threading.Lock()
+
+
+def record_provider_health(name, ok, latency=None, error=''):
+    """Met a jour le cache de sante (sonde ou resultat d'un vrai appel)"""
+    with provider_health_lock:
+        was_ok = provider_health[name]['ok']
+        provider_health[name] = {
+            'ok': ok,
+            'checked_at': datetime.now().isoformat(timespec='seconds'),
+            'latency': round(latency, 3) if latency is not None else None,
+            'error': error
+        }
+    if was_ok is not ok:
+        logger.info(f"[Sante] {name} : {'OK' if ok else 'HS - ' + error}")
+
+
+def provider_available(name):
+    """Faux seulement si la derniere sonde connue a echoue"""
+    with provider_health_lock:
+        return provider_health[name]['ok'] is not False
+
+
+def probe_http(url, headers=None):
+    """Sonde GET legere (liste des modeles) : (ok, latence, erreur)"""
+    import requests
+    start = time.time()
+    try:
+        r = requests.get(url, headers=headers or {}, timeout=HEALTH_CHECK_TIMEOUT)
+        return r.status_code == 200, time.time() - start, '' if r.status_code == 200 else f"HTTP {r.status_code}"
+    except Exception as e:
+        return False, time.time() - start, type(e).__name__
+
+
+def probe_providers():
+    """Sonde tous les providers configures et met le cache a jour"""
+    if ANTHROPIC_API_KEY:
+        ok, latency, error = probe_http(
+            f'{ANTHROPIC_BASE_URL}/v1/models',
+            {'x-api-key': ANTHROPIC_API_KEY, 'anthropic-version': '2023-06-01'}
+        )
+        record_provider_health('anthropic', ok, latency, error)
+    if OPENAI_API_KEY:
+        ok, latency, error = probe_http(
+            f'{OPENAI_BASE_URL}/v1/models',
+            {'Authorization': f'Bearer {OPENAI_API_KEY}'}
+        )
+        record_provider_health('openai', ok, latency, error)
+
+    # Ollama : disponible si au moins un serveur du pool repond
+    results = []
+    for url in OLLAMA_URLS:
+        ok, latency, error = probe_http(f'{url}/api/tags')
+        record_ollama_result(url, ok, error=error)
+        results.append((ok, latency, error))
+    best = min(results, key=lambda r: (not r[0], r[1]))
+    record_provider_health('ollama', *best)
+
+
+def provider_health_loop():
+    """Sonde periodique en arriere-plan : /api/status ne bloque jamais"""
+    while True:
+        try:
+            probe_providers()
+        except Exception as e:
+            logger.error(f"[Sante] Erreur sonde: {e}")
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+
+# ===================================================================
+# REDUCTION DU TEXTE ENVOYE (COUCHE TEXTE)
+# ===================================================================
+
+# Lignes a conserver quoi qu'il arrive : TVA / totaux (prioritaires sous budget), montants, dates
+TOTAL_LINE_PATTERN = re.compile(r'\b(?:t\.?v\.?a|vat|h\.?t|t\.?t\.?c|total|net a payer|montant)\b', re.IGNORECASE)
+KEEP_LINE_PATTERN = re.compile(r'\d+[.,]\d{2}\b|\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b')
+FILLER_LINE_PATTERN = re.compile(r'^[\W_]*$')  # separateurs "-----", "*****"
+
+
+def boilerplate_key(line):
+    """Empreinte d'une ligne (casse, espaces, chiffres neutralises) : rien du texte n'est stocke"""
+    shape = re.sub(r'\d', '0', re.sub(r'\s+', ' ', line.lower())).strip()
+    return hashlib.sha256(shape.encode()).hexdigest()[:16]
+
+
+class BoilerplateLines:
+    """Nombre de tickets distincts contenant chaque ligne (en-tetes, mentions legales, fidelite)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = None  # charge au premier usage
+        self.pending = 0
+
+    def _load(self):
+        try:
+            self.counts = json.loads(self.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.counts = {}
+
+    def observe(self, keys):
+        """Compte les lignes d'un ticket ; renvoie les cles considerees comme gabarit"""
+        with self.lock:
+            if self.counts is None:
+                self._load()
+            for key in keys:
+                self.counts[key] = self.counts.get(key, 0) + 1
+            if len(self.counts) > BOILERPLATE_MAX_KEYS:
+                # Lignes vues une seule fois : les plus nombreuses, les moins utiles
+                self.counts = {k: c for k, c in self.counts.items() if c > 1}
+            self.pending += 1
+            if self.pending >= BOILERPLATE_SAVE_EVERY:
+                self._save()
+            return {k for k in keys if self.counts[k] >= BOILERPLATE_MIN_TICKETS}
+
+    def _save(self):
+        self.pending = 0
+        try:
+            self.path.write_text(json.dumps(self.counts), encoding='utf-8')
+        except OSError as e:
+            logger.error(f"[Texte] Sauvegarde des gabarits impossible: {e}")
+
+    def save(self):
+        with self.lock:
+            if self.counts is not None and self.pending:
+                self._save()
+
+
+boilerplate_lines = BoilerplateLines(BOILERPLATE_FILE)
+atexit.register(boilerplate_lines.save)
+
+text_compact_stats = {'pages': 0, 'tokens_in': 0, 'tokens_out': 0, 'lines_dropped': 0}
+text_compact_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def compact_ticket_text(text, budget=None):
+    """Texte d'une page reduit pour le prompt
+
+    Espaces et separateurs compactes, lignes gabarit (vues sur de nombreux
+    tickets) retirees du pied de ticket, puis budget de tokens applique en
+    gardant d'abord les totaux / TVA, puis l'en-tete et les lignes montant /
+    date, puis la description (nature de la depense).
+    """
+    budget = TEXT_TOKEN_BUDGET if budget is None else budget
+    lines = []
+    for raw in text.splitlines():
+        line = re.sub(r'[ \t\u00a0]+', ' ', raw).strip()
+        if line and not FILLER_LINE_PATTERN.match(line) and (not lines or lines[-1] != line):
+            lines.append(line)
+
+    keys = [boilerplate_key(line) for line in lines]
+    boilerplate = boilerplate_lines.observe(set(keys))
+    # Rang : 0 totaux / TVA, 1 en-tete, montants et dates, 2 description avant
+    # les totaux (nature de la depense, qui determine le compte), 3 le reste
+    first_total = next((i for i, line in enumerate(lines) if TOTAL_LINE_PATTERN.search(line)), len(lines))
+    rank = [0 if TOTAL_LINE_PATTERN.search(line) else
+            1 if i < BOILERPLATE_HEADER_LINES or KEEP_LINE_PATTERN.search(line) else
+            2 if i < first_total else 3
+            for i, line in enumerate(lines)]
+    # Gabarits retires en pied de ticket seulement (remerciements, fidelite, mentions legales)
+    kept = [i for i, key in enumerate(keys) if rank[i] < 3 or key not in boilerplate]
+
+    # Budget : lignes par rang, dans l'ordre du ticket a rang egal
+    if budget and estimate_tokens('\n'.join(lines[i] for i in kept)) > budget:
+        chars = budget * CHARS_PER_TOKEN
+        selected = set()
+        for i in sorted(kept, key=lambda i: rank[i]):
+            if chars - len(lines[i]) - 1 < 0:
+                continue
+            chars -= len(lines[i]) + 1
+            selected.add(i)
+        kept = sorted(selected)
+
+    compact = '\n'.join(lines[i] for i in kept)
+    tokens_in, tokens_out = estimate_tokens(text), estimate_tokens(compact)
+    with text_compact_lock:
+        text_compact_stats['pages'] += 1
+        text_compact_stats['tokens_in'] += tokens_in
+        text_compact_stats['tokens_out'] += tokens_out
+        text_compact_stats['lines_dropped'] += len(lines) - len(kept)
+    logger.debug("[Texte] %d -> %d tokens estimes (%d lignes retirees)",
+                 tokens_in, tokens_out, len(lines) - len(kept))
+    return compact
+
+
+def text_compact_report():
+    with text_compact_lock:
+        st = dict(text_compact_stats)
+    saved = st['tokens_in'] - st['tokens_out']
+    st['tokens_saved'] = saved
+    st['saved_ratio'] = round(saved / st['tokens_in'], 3) if st['tokens_in'] else None
+    return st
+
+
 # ===================================================================
 # MOTEUR D'ANALYSE AVEC RETRY + FALLBACK
 # ===================================================================
 
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """Budget de temps d'un lot, consomme par les tentatives et les attentes
+
+    seconds=None (ou 0) : pas de limite, les timeouts par defaut s'appliquent.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds or None
+        self.start = time.monotonic()
+        self.expires_at = self.start + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return float('inf')
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def used(self):
+        return time.monotonic() - self.start
+
+    def check(self):
+        if self.remaining() < MIN_ATTEMPT_SECONDS:
+            raise DeadlineExceeded(f"budget de {self.seconds}s epuise")
+
+    def timeout(self, cap):
+        """Timeout d'une tentative : le budget restant, plafonne a cap"""
+        self.check()
+        return min(cap, self.remaining())
+
+    def sleep(self, seconds):
+        """Attente de retry ; False (sans attendre) si elle ne tient pas dans le budget"""
+        if seconds + MIN_ATTEMPT_SECONDS > self.remaining():
+            return False
+        time.sleep(seconds)
+        return True
+
+
 def clean_json_response(text):
     """Nettoie et parse la reponse JSON"""
     text = re.sub(r'```json\s*', '', text)
@@ -494,6 +1538,101 @@ def clean_json_response(text):
         text = json_match.group()
     return json.loads(text)
 
+# Reponses recues / reponses rejetees (JSON ou schema invalide => retry), par mode.
+# Le mode texte cumule aussi les periodes precedentes (JSON_BASELINE_FILE).
+json_stats = {
+    'structured': {'responses': 0, 'invalid': 0},
+    'text': {'responses': 0, 'invalid': 0}
+}
+json_stats_lock = threading.Lock()
+json_baseline_pending = 0
+
+try:
+    json_stats['text'].update(json.loads(JSON_BASELINE_FILE.read_text(encoding='utf-8')))
+except (OSError, ValueError):
+    pass
+
+
+def save_json_baseline():
+    global json_baseline_pending
+    with json_stats_lock:
+        if not json_baseline_pending:
+            return
+        json_baseline_pending = 0
+        counters = dict(json_stats['text'])
+    try:
+        JSON_BASELINE_FILE.write_text(json.dumps(counters), encoding='utf-8')
+    except OSError as e:
+        logger.error(f"[JSON] Sauvegarde de la reference mode texte impossible: {e}")
+
+
+atexit.register(save_json_baseline)
+
+
+def record_json_result(valid):
+    global json_baseline_pending
+    mode = 'structured' if STRUCTURED_OUTPUT else 'text'
+    with json_stats_lock:
+        json_stats[mode]['responses'] += 1
+        if not valid:
+            json_stats[mode]['invalid'] += 1
+        if mode == 'text':
+            json_baseline_pending += 1
+            save = json_baseline_pending >= JSON_BASELINE_SAVE_EVERY
+    if mode == 'text' and save:
+        save_json_baseline()
+
+
+def json_retry_report():
+    """Retries JSON par mode et estimation des retries evites par le mode structure
+
+    Reference : taux mesure en mode texte (cumule entre redemarrages) s'il
+    porte sur assez de reponses, sinon JSON_TEXT_RETRY_RATE.
+    """
+    with json_stats_lock:
+        report = {mode: dict(st) for mode, st in json_stats.items()}
+    for st in report.values():
+        st['retry_rate'] = round(st['invalid'] / st['responses'], 4) if st['responses'] else None
+    text, structured = report['text'], report['structured']
+    if text['responses'] >= JSON_BASELINE_MIN_RESPONSES:
+        baseline = {'retry_rate': text['retry_rate'], 'source': 'mesure'}
+    elif JSON_TEXT_RETRY_RATE is not None:
+        baseline = {'retry_rate': JSON_TEXT_RETRY_RATE, 'source': 'config'}
+    else:
+        baseline = None
+    report['baseline'] = baseline
+    if baseline and structured['retry_rate'] is not None:
+        report['retries_avoided'] = round(
+            max(0.0, baseline['retry_rate'] - structured['retry_rate']) * structured['responses'], 1
+        )
+    return report
+
+
+def validate_ticket_json(result):
+    """Validation locale du resultat contre TICKET_SCHEMA (ValueError si invalide)"""
+    if not isinstance(result, dict):
+        raise ValueError("JSON racine n'est pas un objet")
+    if not isinstance(result.get('exploitable'), bool):
+        raise ValueError("JSON sans champ 'exploitable'")
+    ecritures = result.get('ecritures', [])
+    if not isinstance(ecritures, list):
+        raise ValueError("'ecritures' n'est pas une liste")
+    if result['exploitable'] and not ecritures:
+        raise ValueError("ticket exploitable sans ecritures")
+    for e in ecritures:
+        if not isinstance(e, dict) or not e.get('compte'):
+            raise ValueError("ecriture sans compte")
+        for field in ('debit', 'credit'):
+            try:
+                float(e.get(field, 0) or 0)
+            except (TypeError, ValueError):
+                raise ValueError(f"{field} non numerique: {e.get(field)!r}")
+    confidence = result.get('confidence', 1.0)
+    if not isinstance(confidence, (int, float)) or not 0 <= confidence <= 1:
+        raise ValueError(f"confidence hors [0, 1]: {confidence!r}")
+    return result
+
+
 def validate_and_fix_ecritures(ecritures):
     """Post-traitement Python : verifie et corrige les maths"""
     alerts = []
@@ -558,13 +1697,74 @@ def validate_and_fix_ecritures(ecritures):
 
     return ecritures, alerts
 
-def analyze_ticket_with_retry(pdf_bytes, filename="ticket.pdf"):
-    """Analyse avec fallback : Claude -> OpenAI -> Ollama"""
+def is_easy_page(text):
+    """Page simple : couche texte courte d'un fournisseur connu"""
+    return (
+        len(text) <= TIER_EASY_MAX_CHARS
+        and TIER_EASY_VENDORS.search(text) is not None
+    )
+
+
+def try_fast_tier(cloud_content, filename, deadline):
+    """Un essai sur le petit modele ; None si le resultat doit etre escalade"""
+    if ANTHROPIC_API_KEY and provider_available('anthropic'):
+        provider_name, health_key = "Claude", 'anthropic'
+        call = lambda: call_anthropic(cloud_content, ANTHROPIC_FAST_MODEL, timeout=deadline.timeout(120))
+    elif OPENAI_API_KEY and provider_available('openai'):
+        provider_name, health_key = "OpenAI", 'openai'
+        call = lambda: call_openai(cloud_content, OPENAI_FAST_MODEL, timeout=deadline.timeout(120))
+    else:
+        return None
+
+    reason = None
+    status = 'escalated'
+    start = time.time()
+    try:
+        raw_response = call()
+        result = raw_response if isinstance(raw_response, dict) else clean_json_response(raw_response)
+        validate_ticket_json(result)
+        if not result['exploitable']:
+            reason = "ticket juge inexploitable"
+        elif result.get('confidence', 1.0) < TIER_MIN_CONFIDENCE:
+            reason = f"confiance {result['confidence']:.0%}"
+        else:
+            _, fixes = validate_and_fix_ecritures([dict(e) for e in result['ecritures']])
+            if fixes:
+                reason = f"corrections necessaires ({len(fixes)})"
+    except DeadlineExceeded:
+        raise
+    except (json.JSONDecodeError, ValueError) as e:
+        reason = f"JSON invalide ({e})"
+        status = 'json'
+    except Exception as e:
+        reason = f"erreur {e}"
+        status = attempt_status(e)
+    capture_attempt(health_key, 'fast', time.time() - start, status if reason else 'ok')
+
+    with tier_stats_lock:
+        tier_escalations['escalated' if reason else 'accepted'] += 1
+    if reason:
+        logger.info(f"[{provider_name} rapide] {filename} - escalade : {reason}")
+        return None
+    logger.info(f"[{provider_name} rapide] {filename} - OK")
+    return result
+
+
+def analyze_ticket_with_retry(pdf_bytes, filename="ticket.pdf", deadline=None):
+    """Analyse avec fallback : Claude -> OpenAI -> Ollama
+
+    Chaque tentative recoit le budget restant de deadline comme timeout ;
+    DeadlineExceeded est propage quand il ne reste plus assez de temps.
+    """
+    import requests
+    deadline = deadline or Deadline()
     text = extract_text_from_pdf(pdf_bytes)
     has_text = len(text.strip()) > 50
+    capture_note(has_text=has_text, text_chars=len(text))
 
     if has_text:
-        cloud_content = f"Analyse ce ticket de frais et produis les ecritures comptables :\n\n{text}"
+        prompt_text = compact_ticket_text(text) if TEXT_COMPACT else text
+        cloud_content = f"Analyse ce ticket de frais et produis les ecritures comptables :\n\n{prompt_text}"
     else:
         pdf_b64 = base64.b64encode(pdf_bytes).decode('utf-8')
         cloud_content = [
@@ -583,13 +1783,24 @@ def analyze_ticket_with_retry(pdf_bytes, filename="ticket.pdf"):
             }
         ]
 
+    # Page simple : petit modele d'abord, grand modele seulement en cas de doute
+    if MODEL_TIERING and has_text and is_easy_page(text):
+        result = try_fast_tier(cloud_content, filename, deadline)
+        if result is not None:
+            return result
+
     providers = []
     if ANTHROPIC_API_KEY:
-        providers.append(("Claude", lambda c=cloud_content: call_anthropic(c)))
+        providers.append(("Claude", 'anthropic',
+                          lambda c=cloud_content: call_anthropic(c, timeout=deadline.timeout(120))))
     if OPENAI_API_KEY:
-        providers.append(("OpenAI", lambda c=cloud_content: call_openai(c)))
+        providers.append(("OpenAI", 'openai',
+                          lambda c=cloud_content: call_openai(c, timeout=deadline.timeout(120))))
     if has_text:
-        providers.append(("Ollama", lambda t=text: call_ollama(t)))
+        providers.append(("Ollama", 'ollama', lambda t=prompt_text: call_ollama(t, timeout=deadline.timeout(180))))
+
+    # Providers connus HS (cache de sante) relegues en fin de chaine, sans etre retires
+    providers.sort(key=lambda p: not provider_available(p[1]))
 
     if not providers:
         return {
@@ -599,48 +1810,94 @@ def analyze_ticket_with_retry(pdf_bytes, filename="ticket.pdf"):
         }
 
     last_error = ""
-    for provider_name, provider_fn in providers:
+    over_budget = None  # attente de retry hors budget : provider suivant
+
+    def retry_wait(seconds):
+        """Attente avant la tentative suivante ; False => provider suivant"""
+        nonlocal over_budget
+        if attempt == MAX_RETRIES - 1:
+            return False
+        if deadline.sleep(seconds):
+            return True
+        over_budget = seconds
+        return False
+
+    for provider_name, health_key, provider_fn in providers:
         for attempt in range(MAX_RETRIES):
             try:
-                logger.info(f"[{provider_name}] {filename} - tentative {attempt+1}/{MAX_RETRIES}")
+                logger.info(
+                    f"[{provider_name}] {filename} - tentative {attempt+1}/{MAX_RETRIES}",
+                    extra={'provider': health_key, **({'sample': f'retry:{health_key}'} if attempt else {})}
+                )
+                call_start = time.time()
                 raw_response = provider_fn()
-                result = clean_json_response(raw_response)
-                if 'exploitable' not in result:
-                    raise ValueError("JSON sans champ 'exploitable'")
-                logger.info(f"[{provider_name}] {filename} - OK")
+                latency = time.time() - call_start
+                record_provider_health(health_key, True, latency)
+                # Mode structure : objet deja parse par le provider
+                if isinstance(raw_response, dict):
+                    result = raw_response
+                else:
+                    result = clean_json_response(raw_response)
+                validate_ticket_json(result)
+                record_json_result(True)
+                capture_attempt(health_key, 'large', latency, 'ok')
+                logger.info(f"[{provider_name}] {filename} - OK", extra={'provider': health_key, 'latency': latency})
                 return result
 
+            except DeadlineExceeded:
+                raise
+
             except json.JSONDecodeError as e:
+                record_json_result(False)
+                capture_attempt(health_key, 'large', time.time() - call_start, 'json')
                 last_error = f"{provider_name}: JSON invalide ({e})"
-                logger.info(f"[{provider_name}] JSON invalide, retry...")
-                time.sleep(RETRY_BASE_DELAY)
+                logger.info(f"[{provider_name}] JSON invalide, retry...",
+                            extra={'provider': health_key, 'sample': f'retry:{health_key}'})
+                if not retry_wait(RETRY_BASE_DELAY):
+                    break
 
             except ValueError as e:
+                record_json_result(False)
+                capture_attempt(health_key, 'large', time.time() - call_start, 'invalid')
                 last_error = f"{provider_name}: {e}"
-                logger.info(f"[{provider_name}] {e}, retry...")
-                time.sleep(RETRY_BASE_DELAY)
+                logger.info(f"[{provider_name}] {e}, retry...",
+                            extra={'provider': health_key, 'sample': f'retry:{health_key}'})
+                if not retry_wait(RETRY_BASE_DELAY):
+                    break
 
             except Exception as e:
                 error_str = str(e)
                 last_error = f"{provider_name}: {error_str}"
-                logger.error(f"[{provider_name}] Erreur: {error_str}")
+                capture_attempt(health_key, 'large', time.time() - call_start, attempt_status(e))
+                logger.error(f"[{provider_name}] Erreur: {error_str}", extra={'provider': health_key})
+                if isinstance(e, requests.exceptions.RequestException):
+                    record_provider_health(health_key, False, error=type(e).__name__)
 
                 if '429' in error_str:
                     wait = RATE_LIMIT_429_WAIT * (attempt + 1)
-                    logger.info(f"[{provider_name}] Rate limit 429, attente {wait}s...")
-                    time.sleep(wait)
+                    logger.info(f"[{provider_name}] Rate limit 429, attente {wait}s...",
+                                extra={'provider': health_key, 'sample': f'wait:{health_key}'})
+                    if not retry_wait(wait):
+                        break
                     continue
                 if '529' in error_str:
                     wait = RETRY_BASE_DELAY * (attempt + 1) * 2
-                    logger.info(f"[{provider_name}] Surcharge 529, attente {wait}s...")
-                    time.sleep(wait)
+                    logger.info(f"[{provider_name}] Surcharge 529, attente {wait}s...",
+                                extra={'provider': health_key, 'sample': f'wait:{health_key}'})
+                    if not retry_wait(wait):
+                        break
                     continue
                 if '400' in error_str:
                     logger.info(f"[{provider_name}] Erreur 400, provider suivant")
                     break
-                time.sleep(RETRY_BASE_DELAY * (attempt + 1))
+                if not retry_wait(RETRY_BASE_DELAY * (attempt + 1)):
+                    break
 
-        logger.info(f"[{provider_name}] Echec apres {MAX_RETRIES} tentatives")
+        logger.info(f"[{provider_name}] Echec apres {MAX_RETRIES} tentatives", extra={'provider': health_key})
+
+    # Chaine epuisee faute de temps (et non d'echec definitif) : page a resoumettre
+    if over_budget is not None:
+        raise DeadlineExceeded(f"budget de {deadline.seconds}s epuise (attente {over_budget}s impossible)")
 
     return {
         "exploitable": False,
@@ -650,45 +1907,172 @@ def analyze_ticket_with_retry(pdf_bytes, filename="ticket.pdf"):
 
 
 # ===================================================================
-# GENERATION EXCEL SAGE
+# CONTROLES DU LOT (COLONNAIRE)
 # ===================================================================
 
-def create_excel(all_ecritures, alerts=None, low_confidence_refs=None):
-    """Cree le fichier Excel format Sage"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Ecritures comptables"
-
-    header_font = Font(name='Calibri', bold=True, size=11, color='FFFFFF')
-    header_fill = PatternFill(start_color='2C3E50', end_color='2C3E50', fill_type='solid')
-    header_alignment = Alignment(horizontal='center', vertical='center')
-    border = Border(
-        left=Side(style='thin'), right=Side(style='thin'),
-        top=Side(style='thin'), bottom=Side(style='thin')
-    )
-    orange_fill = PatternFill(start_color='FFB347', end_color='FFB347', fill_type='solid')
+class BatchChecks:
+    """Controles croises du lot, accumules ticket par ticket au fil du pipeline
+
+    add() calcule les sommes de chaque ticket des que sa page est analysee
+    (une passe sur ses lignes) ; validate() ne parcourt plus que les tickets :
+    equilibre, HT + TVA = TTC, taux de deductibilite par compte et doublons
+    probables entre tickets (meme date, meme TTC, meme fournisseur).
+    Une page (reference T) peut porter plusieurs tickets : ses lignes sont
+    coupees apres chaque ligne banque (ordre charge, TVA, banque du prompt).
+    Montants en centimes (entiers) : pas d'erreur d'arrondi sur les sommes.
+    """
+
+    def __init__(self):
+        self.tickets = []
+        self.total_debit = 0
+        self.total_credit = 0
+        self.dates = {}
+
+    def _date(self, value):
+        """JJ/MM/AAAA -> ordinal (cache par lot), -1 si illisible"""
+        if value not in self.dates:
+            try:
+                self.dates[value] = datetime.strptime(str(value).strip(), '%d/%m/%Y').toordinal()
+            except ValueError:
+                self.dates[value] = -1
+        return self.dates[value]
+
+    @staticmethod
+    def split_tickets(rows):
+        """Lignes (compte, debit, credit, ...) d'une page -> tickets, coupes apres chaque ligne banque"""
+        tickets = [[]]
+        for row in rows:
+            if tickets[-1] and tickets[-1][-1][0].startswith('512') and not row[0].startswith('512'):
+                tickets.append([])
+            tickets[-1].append(row)
+        return tickets
+
+    def add(self, reference, ecritures):
+        """Ajoute les tickets d'une page (reference T deja attribuee)"""
+        if not ecritures:
+            return
+        rows = []
+        for e in ecritures:
+            debit = round(float(e.get('debit', 0) or 0) * 100)
+            credit = round(float(e.get('credit', 0) or 0) * 100)
+            self.total_debit += debit
+            self.total_credit += credit
+            rows.append((str(e.get('compte', '')), debit, credit, e))
+        tickets = self.split_tickets(rows)
+        # Lignes non groupees par ticket (un ticket desequilibre) : la page reste
+        # controlee en bloc (equilibre, HT + TVA), sans deductibilite ni doublon
+        single = len(tickets) == 1 or all(abs(sum(r[1] - r[2] for r in t)) <= 1 for t in tickets)
+        if not single:
+            tickets = [rows]
+
+        for k, ticket in enumerate(tickets):
+            balance = tva = ttc = charge = 0
+            expected = 0.0
+            rule = None
+            other_charge = False
+            for compte, debit, credit, _ in ticket:
+                balance += debit - credit
+                if compte.startswith('4456'):
+                    tva += debit
+                elif compte.startswith('512'):
+                    ttc += credit
+                elif debit > 0:
+                    charge += debit
+                    # Charge = HT + TVA non deductible = HT (1 + (1 - part) taux), TVA deductible = part taux HT
+                    share, rate = DEDUCTIBILITY_RULES.get(compte, (None, None))
+                    if share is None or (rate is None and share != 0):
+                        other_charge = True  # TVA inconnue : pas de controle du ticket
+                        continue
+                    rate = rate or 0.0
+                    expected += debit * share * rate / (1 + (1 - share) * rate)
+                    rule = compte
+            first = ticket[0][3]
+            # Libelle "Fournisseur - Nature de la depense" : le fournisseur identifie le ticket
+            vendor = re.sub(r'[^a-z]+', ' ', str(first.get('libelle', '')).split(' - ')[0].lower()).strip()
+            self.tickets.append({
+                'label': reference if len(tickets) == 1 else f"{reference} (ticket {k + 1})",
+                'single': single, 'date': self._date(first.get('date', '')), 'vendor': vendor,
+                'balance': balance, 'tva': tva, 'ttc': ttc, 'charge': charge,
+                'expected': round(expected), 'rule': None if other_charge else rule
+            })
 
-    headers = ['Date', 'Reference', 'Journal', 'Compte', 'Libelle', 'Debit', 'Credit']
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = border
+    def validate(self):
+        unbalanced, mismatch, deductibility = [], [], []
+        seen = {}
+        alerts = []
+        for t in self.tickets:
+            label = t['label']
+            if abs(t['balance']) > 1:
+                unbalanced.append(label)
+                alerts.append(f"{label} : desequilibre de {t['balance'] / 100:.2f} EUR")
+            if t['ttc'] > 0 and abs(t['charge'] + t['tva'] - t['ttc']) > 2:
+                mismatch.append(label)
+                alerts.append(f"{label} : HT + TVA ({(t['charge'] + t['tva']) / 100:.2f}) "
+                              f"!= TTC ({t['ttc'] / 100:.2f})")
+            if t['single'] and t['rule'] and abs(t['tva'] - t['expected']) > DEDUCTIBILITY_TOLERANCE * 100:
+                deductibility.append(label)
+                alerts.append(f"{label} : TVA deduite {t['tva'] / 100:.2f} EUR, attendu "
+                              f"{t['expected'] / 100:.2f} EUR ({DEDUCTIBILITY_RULES[t['rule']][0]:.0%} "
+                              f"deductible sur {t['rule']})")
+            if t['single'] and t['ttc'] > 0 and t['date'] >= 0:
+                seen.setdefault((t['date'], t['ttc'], t['vendor']), []).append(label)
+
+        duplicates = [labels for labels in seen.values() if len(labels) > 1]
+        for labels in duplicates:
+            alerts.append(f"Doublon probable : {', '.join(labels)} (meme date, meme TTC, meme fournisseur)")
 
-    row = 2
-    total_debit = 0
-    total_credit = 0
+        return {
+            'total_debit': round(self.total_debit / 100, 2),
+            'total_credit': round(self.total_credit / 100, 2),
+            'unbalanced': unbalanced,
+            'ht_tva_ttc': mismatch,
+            'deductibility': deductibility,
+            'duplicates': duplicates,
+            'alerts': alerts
+        }
 
-    for e in all_ecritures:
-        debit = round(float(e.get('debit', 0) or 0), 2)
-        credit = round(float(e.get('credit', 0) or 0), 2)
-        total_debit += debit
-        total_credit += credit
 
-        is_low_confidence = (
-            low_confidence_refs and e.get('reference', '') in low_confidence_refs
+# ===================================================================
+# GENERATION EXCEL SAGE
+# ===================================================================
+
+class SageExcelWriter:
+    """Classeur Sage construit ligne a ligne (ecriture incrementale)"""
+
+    def __init__(self):
+        from openpyxl import Workbook
+        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+        self.wb = Workbook()
+        self.ws = self.wb.active
+        self.ws.title = "Ecritures comptables"
+
+        header_font = Font(name='Calibri', bold=True, size=11, color='FFFFFF')
+        header_fill = PatternFill(start_color='2C3E50', end_color='2C3E50', fill_type='solid')
+        header_alignment = Alignment(horizontal='center', vertical='center')
+        self.border = Border(
+            left=Side(style='thin'), right=Side(style='thin'),
+            top=Side(style='thin'), bottom=Side(style='thin')
         )
+        self.orange_fill = PatternFill(start_color='FFB347', end_color='FFB347', fill_type='solid')
+
+        headers = ['Date', 'Reference', 'Journal', 'Compte', 'Libelle', 'Debit', 'Credit']
+        for col, header in enumerate(headers, 1):
+            cell = self.ws.cell(row=1, column=col, value=header)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = header_alignment
+            cell.border = self.border
+
+        self.row = 2
+        self.total_debit = 0
+        self.total_credit = 0
+
+    def add(self, e, low_confidence=False):
+        from openpyxl.styles import Alignment
+        debit = round(float(e.get('debit', 0) or 0), 2)
+        credit = round(float(e.get('credit', 0) or 0), 2)
+        self.total_debit += debit
+        self.total_credit += credit
 
         values = [
             e.get('date', ''),
@@ -700,51 +2084,59 @@ def create_excel(all_ecritures, alerts=None, low_confidence_refs=None):
             credit
         ]
         for col, val in enumerate(values, 1):
-            cell = ws.cell(row=row, column=col, value=val)
-            cell.border = border
-            if is_low_confidence:
-                cell.fill = orange_fill
+            cell = self.ws.cell(row=self.row, column=col, value=val)
+            cell.border = self.border
+            if low_confidence:
+                cell.fill = self.orange_fill
             if col in (6, 7):
                 cell.number_format = '#,##0.00'
                 cell.alignment = Alignment(horizontal='right')
-        row += 1
-
-    row += 1
-    equilibre = abs(total_debit - total_credit) < 0.01
-    ctrl_fill = PatternFill(
-        start_color='27AE60' if equilibre else 'E74C3C',
-        end_color='27AE60' if equilibre else 'E74C3C',
-        fill_type='solid'
-    )
-    ctrl_font = Font(name='Calibri', bold=True, color='FFFFFF')
-
-    ws.cell(row=row, column=4, value='CONTROLE').font = ctrl_font
-    ws.cell(row=row, column=4).fill = ctrl_fill
-    status = 'OK - Equilibre' if equilibre else 'ERREUR - Desequilibre'
-    ws.cell(row=row, column=5, value=status).font = ctrl_font
-    ws.cell(row=row, column=5).fill = ctrl_fill
-    ws.cell(row=row, column=6, value=round(total_debit, 2)).font = ctrl_font
-    ws.cell(row=row, column=6).fill = ctrl_fill
-    ws.cell(row=row, column=6).number_format = '#,##0.00'
-    ws.cell(row=row, column=7, value=round(total_credit, 2)).font = ctrl_font
-    ws.cell(row=row, column=7).fill = ctrl_fill
-    ws.cell(row=row, column=7).number_format = '#,##0.00'
-
-    if alerts:
-        row += 2
-        alert_font = Font(name='Calibri', bold=True, color='E74C3C')
-        ws.cell(row=row, column=1, value='ALERTES').font = alert_font
-        for alert in alerts:
-            row += 1
-            ws.cell(row=row, column=1, value=alert)
-
-    for col_letter, width in [('A', 14), ('B', 12), ('C', 10), ('D', 12), ('E', 45), ('F', 14), ('G', 14)]:
-        ws.column_dimensions[col_letter].width = width
+        self.row += 1
+
+    def finish(self, alerts=None, totals=None):
+        """Ligne de controle, alertes, largeurs de colonnes ; renvoie les octets xlsx
+
+        totals : (debit, credit) deja calcules sur le lot, sinon sommes des lignes ajoutees.
+        """
+        from openpyxl.styles import Font, PatternFill
+        ws = self.ws
+        row = self.row + 1
+        total_debit, total_credit = totals or (self.total_debit, self.total_credit)
+        equilibre = abs(total_debit - total_credit) < 0.01
+        ctrl_fill = PatternFill(
+            start_color='27AE60' if equilibre else 'E74C3C',
+            end_color='27AE60' if equilibre else 'E74C3C',
+            fill_type='solid'
+        )
+        ctrl_font = Font(name='Calibri', bold=True, color='FFFFFF')
+
+        ws.cell(row=row, column=4, value='CONTROLE').font = ctrl_font
+        ws.cell(row=row, column=4).fill = ctrl_fill
+        status = 'OK - Equilibre' if equilibre else 'ERREUR - Desequilibre'
+        ws.cell(row=row, column=5, value=status).font = ctrl_font
+        ws.cell(row=row, column=5).fill = ctrl_fill
+        ws.cell(row=row, column=6, value=round(total_debit, 2)).font = ctrl_font
+        ws.cell(row=row, column=6).fill = ctrl_fill
+        ws.cell(row=row, column=6).number_format = '#,##0.00'
+        ws.cell(row=row, column=7, value=round(total_credit, 2)).font = ctrl_font
+        ws.cell(row=row, column=7).fill = ctrl_fill
+        ws.cell(row=row, column=7).number_format = '#,##0.00'
+
+        if alerts:
+            row += 2
+            alert_font = Font(name='Calibri', bold=True, color='E74C3C')
+            ws.cell(row=row, column=1, value='ALERTES').font = alert_font
+            for alert in alerts:
+                row += 1
+                ws.cell(row=row, column=1, value=alert)
+
+        for col_letter, width in [('A', 14), ('B', 12), ('C', 10), ('D', 12), ('E', 45), ('F', 14), ('G', 14)]:
+            ws.column_dimensions[col_letter].width = width
 
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    return output.read()
+        output = io.BytesIO()
+        self.wb.save(output)
+        output.seek(0)
+        return output.read()
 
 
 # ===================================================================
@@ -753,6 +2145,9 @@ def create_excel(all_ecritures, alerts=None, low_confidence_refs=None):
 
 def create_inexploitable_report(inexploitable_tickets):
     """Cree un PDF listant les tickets inexploitables"""
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.colors import red, black
+    from reportlab.lib.pagesizes import A4
     buffer = io.BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
@@ -790,146 +2185,1341 @@ def create_inexploitable_report(inexploitable_tickets):
 
 
 # ===================================================================
-# TRAITEMENT PRINCIPAL
+# CONTROLE QUALITE (PREFLIGHT)
 # ===================================================================
 
-def process_tickets(files_data):
-    """Traite une liste de tickets"""
-    all_ecritures = []
-    exploited_pdfs = []
-    inexploitable_tickets = []
-    alerts = []
-    low_confidence_refs = set()
-    ticket_num = 1
-    results_detail = []
+def page_quality_signals(page):
+    """Signaux bon marche sur le rendu d'une page : encre, contraste, nettete
+
+    Contraste et nettete sont mesures dans la boite englobante de l'encre :
+    un ticket net scanne sur une page A4 n'est pas penalise par le blanc autour.
+    """
+    import fitz
+    signals = {
+        'width_pt': round(page.rect.width, 1),
+        'height_pt': round(page.rect.height, 1),
+        'text_chars': len(page.get_text().strip())
+    }
+    if signals['text_chars'] > 50:
+        return signals  # couche texte exploitable : pas de rendu
+
+    zoom = PREFLIGHT_DPI / 72
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    w, h, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+    rows = [samples[y * stride:y * stride + w] for y in range(h)]
+    masks = [row.translate(INK_TABLE) for row in rows]
+    ink_rows = [y for y, mask in enumerate(masks) if mask.find(1) >= 0]
+    signals['ink'] = round(sum(mask.count(1) for mask in masks) / max(w * h, 1), 5)
+    if not ink_rows:
+        signals.update(contrast=0.0, sharpness=0.0)
+        return signals
+
+    # Boite englobante de l'encre (comme dhash_page)
+    top, bottom = ink_rows[0], ink_rows[-1] + 1
+    left = min(masks[y].find(1) for y in ink_rows)
+    right = max(masks[y].rfind(1) for y in ink_rows) + 1
+    box = [rows[y][left:right] for y in range(top, bottom)]
+    total = (bottom - top) * (right - left)
+
+    # Histogramme (bytes.count : une passe en C par niveau)
+    crop = b''.join(box)
+    histogram = [crop.count(v) for v in range(256)]
+    mean = sum(v * n for v, n in enumerate(histogram)) / total
+    variance = sum(n * (v - mean) ** 2 for v, n in enumerate(histogram)) / total
+    contrast = variance ** 0.5
+
+    # Nettete : gradient horizontal moyen (1 ligne sur 2) rapporte au contraste
+    gradient = 0
+    count = 0
+    for row in box[::2]:
+        gradient += sum(abs(a - b) for a, b in zip(row, row[1:]))
+        count += len(row) - 1
+    signals['contrast'] = round(contrast, 2)
+    signals['sharpness'] = round((gradient / max(count, 1)) / (contrast + 1), 4)
+    return signals
+
+
+def preflight_check(pdf_bytes):
+    """Rejette localement les pages inutilisables : (raison ou None, signaux)
+
+    Seules les pages trop petites ou blanches sont rejetees ; contraste et
+    nettete ne rejettent qu'avec PREFLIGHT_STRICT (seuils a valider sur des
+    scans reels avec tools/preflight_report.py), sinon ils sont journalises.
+    """
+    import fitz
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception:
+        return None, []
+    try:
+        signals = [page_quality_signals(page) for page in doc]
+    finally:
+        doc.close()
 
-    # Split multi-pages (seulement si >20 pages)
-    split_files = []
-    for file_info in files_data:
-        try:
-            reader = PdfReader(io.BytesIO(file_info['bytes']))
-            if len(reader.pages) > 20:
-                logger.info(f"Split {file_info['filename']} : {len(reader.pages)} pages")
-                pages = split_pdf_pages(file_info['bytes'], file_info['filename'])
-                split_files.extend(pages)
-            else:
-                split_files.append(file_info)
-        except Exception as e:
-            logger.error(f"Erreur split {file_info['filename']}: {e}")
-            split_files.append(file_info)
+    reasons = []
+    for sig in signals:
+        weak = None
+        if min(sig['width_pt'], sig['height_pt']) < PREFLIGHT_MIN_SIDE_PT:
+            reasons.append("Page trop petite pour etre un justificatif")
+            continue
+        elif sig['text_chars'] > 50:
+            return None, signals  # couche texte exploitable
+        elif sig['ink'] < PREFLIGHT_MIN_INK:
+            reasons.append("Page blanche (aucun contenu detecte)")
+            continue
+        elif sig['contrast'] < PREFLIGHT_MIN_CONTRAST:
+            weak = "Scan illisible (contraste insuffisant)"
+        elif sig['sharpness'] < PREFLIGHT_MIN_SHARPNESS:
+            weak = "Scan illisible (image floue)"
+        if weak and PREFLIGHT_STRICT:
+            reasons.append(weak)
+            continue
+        if weak:
+            logger.debug("[Preflight] signal faible (%s) : %s", weak, sig)
+        return None, signals  # au moins une page utilisable
+    return (reasons[0] if reasons else None), signals
 
-    total_pages = len(split_files)
-    logger.info(f"{'='*50}")
-    logger.info(f"Traitement de {total_pages} page(s)")
-    logger.info(f"{'='*50}")
 
-    for idx, file_info in enumerate(split_files):
-        filename = file_info['filename']
-        pdf_bytes = file_info['bytes']
+def preflight_record(file_info, digest):
+    """Enregistrement 'inexploitable' si le preflight rejette la page, sinon None
 
-        logger.info(f"[{idx+1}/{total_pages}] {filename}")
-        result = analyze_ticket_with_retry(pdf_bytes, filename)
+    Travail CPU local : appele avant de prendre un creneau provider.
+    """
+    if not PREFLIGHT:
+        return None
+    raison, _ = preflight_check(file_info['bytes'])
+    if not raison:
+        return None
+    capture_note(preflight=True)
+    logger.info(f"[Preflight] {file_info['filename']} - rejete : {raison}")
+    return {'page': digest, 'filename': file_info['filename'], 'status': 'inexploitable', 'raison': raison}
 
-        # Verification confiance
-        if result.get('confidence', 1.0) < 0.7:
-            alerts.append(
-                f"\u26a0\ufe0f Confiance faible ({result['confidence']:.0%}) "
-                f"sur {filename} \u2014 verification manuelle recommandee"
-            )
 
-        if result.get('exploitable'):
-            ecritures = result.get('ecritures', [])
-            for e in ecritures:
-                e['reference'] = f'T{ticket_num}'
-
-            # Tracker les references a faible confiance
-            if result.get('confidence', 1.0) < 0.7:
-                low_confidence_refs.add(f'T{ticket_num}')
-
-            # Post-traitement Python
-            ecritures, fix_alerts = validate_and_fix_ecritures(ecritures)
-            for a in fix_alerts:
-                alerts.append(f"T{ticket_num} ({filename}) : {a}")
-
-            # Verification equilibre
-            total_d = sum(e['debit'] for e in ecritures)
-            total_c = sum(e['credit'] for e in ecritures)
-            if abs(total_d - total_c) > 0.01:
-                alerts.append(f"T{ticket_num} ({filename}) : Desequilibre ({total_d:.2f} != {total_c:.2f})")
-                ligne_banque = next((e for e in ecritures if e['compte'] == '51200000'), None)
-                if ligne_banque:
-                    ligne_banque['credit'] = round(total_d, 2)
-
-            all_ecritures.extend(ecritures)
-            stamped = stamp_pdf_with_s(pdf_bytes)
-            exploited_pdfs.append(stamped)
-            results_detail.append({
-                'filename': filename, 'status': 'exploitable',
-                'reference': f'T{ticket_num}', 'ecritures': ecritures
-            })
-            ticket_num += 1
-        else:
-            raison = result.get('raison_non_exploitable', 'Document inexploitable')
-            inexploitable_tickets.append({'filename': filename, 'raison': raison})
-            alerts.append(f"!! {filename} : {raison}")
-            results_detail.append({
-                'filename': filename, 'status': 'inexploitable', 'raison': raison
-            })
+# ===================================================================
+# DETECTION DES DOUBLONS
+# ===================================================================
 
-        if idx < total_pages - 1:
-            time.sleep(RATE_LIMIT_DELAY)
+def dhash_page(page, size=8):
+    """Hash perceptuel (difference hash 64 bits) du contenu d'une page, marges blanches rognees"""
+    import fitz
+    zoom = 128 / max(page.rect.width, 1)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    w, h, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+    rows = [samples[y * stride:y * stride + w] for y in range(h)]
+
+    # Boite englobante de l'encre : le ticket seul, quelle que soit sa place sur le scan
+    ink_rows = [y for y, row in enumerate(rows) if row.translate(INK_TABLE).find(1) >= 0]
+    if not ink_rows:
+        return 0
+    top, bottom = ink_rows[0], ink_rows[-1] + 1
+    left = min(rows[y].translate(INK_TABLE).find(1) for y in ink_rows)
+    right = max(rows[y].translate(INK_TABLE).rfind(1) for y in ink_rows) + 1
+    bw, bh = right - left, bottom - top
+
+    # Moyenne par bloc sur une grille (size+1) x size
+    grid = []
+    for gy in range(size):
+        y0 = top + gy * bh // size
+        y1 = max(top + (gy + 1) * bh // size, y0 + 1)
+        row = []
+        for gx in range(size + 1):
+            x0 = left + gx * bw // (size + 1)
+            x1 = max(left + (gx + 1) * bw // (size + 1), x0 + 1)
+            total = sum(sum(rows[y][x0:x1]) for y in range(y0, y1))
+            row.append(total / ((y1 - y0) * (x1 - x0)))
+        grid.append(row)
+    bits = 0
+    for row in grid:
+        for a, b in zip(row, row[1:]):
+            bits = (bits << 1) | (a > b)
+    return bits
+
+
+def normalize_ticket_text(text):
+    """Texte normalise (casse, ponctuation, espaces) pour l'empreinte"""
+    return re.sub(r'\s+', ' ', re.sub(r'[^0-9a-z,.\s]', '', text.lower())).strip()
+
+
+def page_fingerprint(pdf_bytes):
+    """Empreintes d'un document : hash perceptuel par page + cles exactes (octets, texte)"""
+    import fitz
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        hashes = tuple(dhash_page(page) for page in doc)
+        text = normalize_ticket_text(''.join(page.get_text() for page in doc))
+        doc.close()
+    except Exception:
+        return None
+    keys = [f"sha:{page_hash(pdf_bytes)}"]
+    # Texte trop court (scan) : pas d'empreinte texte fiable
+    if len(text) > 50:
+        keys.append(f"txt:{hashlib.sha1(text.encode()).hexdigest()}")
+    return {'phash': hashes, 'keys': keys}
+
+
+class PageHashIndex:
+    """Index des empreintes pour recherche rapide par distance de Hamming.
+
+    Multi-index hashing : le hash 64 bits de la 1re page est coupe en 8 octets ;
+    deux hashes a distance <= 7 partagent forcement au moins un octet, donc seuls
+    les candidats d'un meme seau sont compares.
+    """
+
+    BANDS = 8
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.entries = {}
+        self.order = deque()  # (horodatage, id) par ordre d'insertion
+        self.by_key = {}
+        self.buckets = [{} for _ in range(self.BANDS)]
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def _bands(self, phash):
+        return [(phash >> (8 * i)) & 0xFF for i in range(self.BANDS)]
+
+    def _evict(self):
+        if self.max_age is None:
+            return
+        cutoff = time.time() - self.max_age
+        while self.order and self.order[0][0] < cutoff:
+            _, entry_id = self.order.popleft()
+            fingerprint, _ = self.entries.pop(entry_id)
+            for key in fingerprint['keys']:
+                if self.by_key.get(key) == entry_id:
+                    del self.by_key[key]
+            if fingerprint['phash']:
+                for band, key in zip(self.buckets, self._bands(fingerprint['phash'][0])):
+                    band[key].discard(entry_id)
+
+    def add(self, fingerprint, payload):
+        with self.lock:
+            self._evict()
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (fingerprint, payload)
+            self.order.append((time.time(), entry_id))
+            for key in fingerprint['keys']:
+                self.by_key.setdefault(key, entry_id)
+            if fingerprint['phash']:
+                for band, key in zip(self.buckets, self._bands(fingerprint['phash'][0])):
+                    band.setdefault(key, set()).add(entry_id)
+
+    def lookup(self, fingerprint, max_distance=DUPLICATE_MAX_DISTANCE):
+        """Renvoie (payload, distance, exact) du plus proche doublon, ou None"""
+        with self.lock:
+            self._evict()
+            for key in fingerprint['keys']:
+                entry_id = self.by_key.get(key)
+                if entry_id is not None:
+                    return self.entries[entry_id][1], 0, True
+
+            phash = fingerprint['phash']
+            if not phash:
+                return None
+            candidates = set()
+            for band, key in zip(self.buckets, self._bands(phash[0])):
+                candidates |= band.get(key, set())
+            best = None
+            for candidate in candidates:
+                other, payload = self.entries[candidate]
+                if len(other['phash']) != len(phash):
+                    continue
+                distance = sum((a ^ b).bit_count() for a, b in zip(phash, other['phash']))
+                if distance <= max_distance and (best is None or distance < best[1]):
+                    best = (payload, distance, False)
+            return best
 
-    # Generation fichiers (supprimes automatiquement apres FILE_RETENTION_MINUTES)
-    output_files = {}
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
 
-    if all_ecritures:
-        excel_bytes = create_excel(
-            all_ecritures,
-            alerts if alerts else None,
-            low_confidence_refs=low_confidence_refs
-        )
-        excel_name = f'Sage_import_{timestamp}.xlsx'
-        (OUTPUT_FOLDER / excel_name).write_bytes(excel_bytes)
-        output_files['excel'] = {'name': excel_name, 'path': str(OUTPUT_FOLDER / excel_name)}
+# Historique recent (tous lots confondus) : analyses reutilisables
+duplicate_history = PageHashIndex(max_age=DUPLICATE_HISTORY_MINUTES * 60)
 
-    if exploited_pdfs:
-        merged = merge_pdfs(exploited_pdfs)
-        stamped_name = f'Tickets_exploites_S_{timestamp}.pdf'
-        (OUTPUT_FOLDER / stamped_name).write_bytes(merged)
-        output_files['stamped_pdf'] = {'name': stamped_name, 'path': str(OUTPUT_FOLDER / stamped_name)}
 
-    if inexploitable_tickets:
-        report = create_inexploitable_report(inexploitable_tickets)
-        report_name = f'Justificatifs_inexploites_{timestamp}.pdf'
-        (OUTPUT_FOLDER / report_name).write_bytes(report)
-        output_files['inexploitable_pdf'] = {'name': report_name, 'path': str(OUTPUT_FOLDER / report_name)}
+# ===================================================================
+# JOURNAL DE REPRISE
+# ===================================================================
 
-    total_d = round(sum(e['debit'] for e in all_ecritures), 2)
-    total_c = round(sum(e['credit'] for e in all_ecritures), 2)
-    logger.info(f"{'='*50}")
-    logger.info(f"RESULTAT : {len(exploited_pdfs)} exploites / {len(inexploitable_tickets)} inexploitables")
-    logger.info(f"TOTAUX   : D={total_d} | C={total_c} | {'OK' if abs(total_d - total_c) < 0.01 else 'ERREUR'}")
+journal_lock = threading.Lock()
+
+
+def page_hash(pdf_bytes):
+    """Empreinte d'une page (cle du journal)"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def journal_path(batch_id):
+    return JOURNAL_FOLDER / f'{batch_id}.jsonl'
+
+
+def load_journal(batch_id):
+    """Charge les pages deja traitees d'un lot : page_hash -> enregistrement"""
+    completed = {}
+    path = journal_path(batch_id)
+    if not path.exists():
+        return completed
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Derniere ligne tronquee par un crash pendant l'ecriture
+                continue
+            completed[record['page']] = record
+    return completed
+
+
+def append_journal(batch_id, record):
+    """Ajoute un resultat de page au journal (durable : fsync)"""
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    with journal_lock:
+        with open(journal_path(batch_id), 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def purge_journals():
+    """Supprime les journaux plus vieux que JOURNAL_RETENTION_MINUTES"""
+    cutoff = time.time() - JOURNAL_RETENTION_MINUTES * 60
+    for f in JOURNAL_FOLDER.glob('*.jsonl'):
+        try:
+            if f.stat().st_mtime < cutoff:
+                f.unlink()
+                logger.info(f"[Journal] Supprime {f.name}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"[Journal] Erreur purge: {e}")
+
+
+def build_page_record(file_info, digest, deadline=None):
+    """Analyse une page et produit l'enregistrement de journal correspondant"""
+    filename = file_info['filename']
+    result = analyze_ticket_with_retry(file_info['bytes'], filename, deadline)
+    record = {
+        'page': digest,
+        'filename': filename,
+        'confidence': result.get('confidence', 1.0)
+    }
+
+    if not result.get('exploitable'):
+        record['status'] = 'inexploitable'
+        record['raison'] = result.get('raison_non_exploitable', 'Document inexploitable')
+        return record
+
+    # Post-traitement Python (equilibre residuel signale par BatchChecks sur le lot)
+    ecritures, fix_alerts = validate_and_fix_ecritures(result.get('ecritures', []))
+
+    record['status'] = 'exploitable'
+    record['ecritures'] = ecritures
+    record['alerts'] = fix_alerts
+    return record
+
+
+# ===================================================================
+# ORDONNANCEUR DES APPELS PROVIDERS
+# ===================================================================
+
+class JobScheduler:
+    """Creneaux de concurrence providers partages par toutes les sources
+
+    Priorite stricte par classe (interactive > webhook > email), puis file
+    equitable ponderee (WFQ) entre sources d'une meme classe : une source qui
+    soumet 300 pages n'empeche pas une autre d'avancer page par page.
+    """
+
+    def __init__(self, slots, weights=None):
+        self.slots = slots
+        self.weights = weights or {}
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = []  # heap (classe, fin virtuelle, seq, ticket)
+        self.seq = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.stats = {
+            cls: {'queued': 0, 'max_queued': 0, 'granted': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for cls in JOB_CLASSES
+        }
+
+    def acquire(self, job_class, source):
+        """Bloque jusqu'a l'obtention d'un creneau ; renvoie l'attente en secondes"""
+        priority = JOB_CLASSES.index(job_class)
+        start = time.monotonic()
+        with self.cond:
+            weight = self.weights.get(source, 1.0)
+            finish = max(self.virtual_time, self.last_finish.get(source, 0.0)) + 1.0 / weight
+            self.last_finish[source] = finish
+            self.seq += 1
+            ticket = {'granted': False}
+            heapq.heappush(self.waiting, (priority, finish, self.seq, ticket))
+            stats = self.stats[job_class]
+            stats['queued'] += 1
+            stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+            self._dispatch()
+            while not ticket['granted']:
+                self.cond.wait()
+            waited = time.monotonic() - start
+            stats['queued'] -= 1
+            stats['granted'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+        return waited
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        """Attribue les creneaux libres aux tickets en tete de file (verrou tenu)"""
+        granted = False
+        while self.waiting and self.active < self.slots:
+            _, finish, _, ticket = heapq.heappop(self.waiting)
+            self.virtual_time = max(self.virtual_time, finish)
+            ticket['granted'] = True
+            self.active += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+        if not self.waiting:
+            # Sources inactives : leur retard ne doit pas etre rejoue plus tard
+            self.last_finish = {
+                src: f for src, f in self.last_finish.items() if f > self.virtual_time
+            }
+
+    @contextmanager
+    def slot(self, job_class, source):
+        waited = self.acquire(job_class, source)
+        if waited > 1:
+            logger.info(f"[Ordonnanceur] {job_class}/{source} : creneau obtenu apres {waited:.1f}s")
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def report(self):
+        """Profondeur de file et temps d'attente par classe (pour /api/status)"""
+        with self.cond:
+            return {
+                'slots': self.slots,
+                'active': self.active,
+                'classes': {
+                    cls: {
+                        'queued': st['queued'],
+                        'max_queued': st['max_queued'],
+                        'granted': st['granted'],
+                        'avg_wait': round(st['wait_total'] / st['granted'], 3) if st['granted'] else 0.0,
+                        'max_wait': round(st['wait_max'], 3)
+                    }
+                    for cls, st in self.stats.items()
+                }
+            }
+
+
+job_scheduler = JobScheduler(PROVIDER_SLOTS, SCHEDULER_SOURCE_WEIGHTS)
+
+
+# ===================================================================
+# REGISTRE DES ECRITURES (SQLITE)
+# ===================================================================
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ecritures (
+    batch_id   TEXT NOT NULL,
+    reference  TEXT NOT NULL,
+    line       INTEGER NOT NULL,
+    date       TEXT,
+    date_piece TEXT,
+    journal    TEXT,
+    compte     TEXT,
+    libelle    TEXT,
+    debit      REAL NOT NULL DEFAULT 0,
+    credit     REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (batch_id, reference, line)
+);
+-- Index couvrant : les totaux par periode se calculent sans lire la table
+CREATE INDEX IF NOT EXISTS idx_ecritures_date ON ecritures (date, compte, debit, credit);
+CREATE INDEX IF NOT EXISTS idx_ecritures_compte_date ON ecritures (compte, date);
+CREATE INDEX IF NOT EXISTS idx_ecritures_created ON ecritures (created_at);
+"""
+
+ledger_lock = threading.Lock()
+ledger_conn = None
+ledger_last_purge = 0.0
+
+
+def ledger_connect():
+    conn = sqlite3.connect(LEDGER_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def get_ledger():
+    """Connexion d'ecriture partagee (WAL : les lectures ne bloquent pas les ecritures)"""
+    global ledger_conn
+    if ledger_conn is None:
+        LEDGER_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = ledger_connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(LEDGER_SCHEMA)
+        ledger_conn = conn
+    return ledger_conn
+
+
+def ledger_date(value):
+    """JJ/MM/AAAA -> AAAA-MM-JJ (tri et plages de dates sur l'index) ; None si illisible"""
+    try:
+        return datetime.strptime(str(value).strip(), '%d/%m/%Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def ledger_record_batch(batch_id, ecritures):
+    """Remplace les ecritures d'un lot (une reprise du meme lot ne cree pas de doublons)"""
+    now = time.time()
+    rows = []
+    lines = {}
+    for e in ecritures:
+        reference = e.get('reference', '')
+        line = lines[reference] = lines.get(reference, 0) + 1
+        rows.append((
+            batch_id, reference, line, ledger_date(e.get('date', '')), e.get('date', ''),
+            e.get('journal', 'FCB'), e.get('compte', ''), e.get('libelle', ''),
+            e.get('debit', 0) or 0, e.get('credit', 0) or 0, now
+        ))
+    with ledger_lock:
+        conn = get_ledger()
+        with conn:
+            conn.execute('DELETE FROM ecritures WHERE batch_id = ?', (batch_id,))
+            conn.executemany('INSERT INTO ecritures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    logger.info(f"[Registre] {len(rows)} ecriture(s) enregistree(s)", extra={'batch_id': batch_id})
+
+
+def purge_ledger(batch_id=None, before=None):
+    """Supprime un lot, les ecritures datees avant `before` (AAAA-MM-JJ),
+    ou par defaut celles enregistrees il y a plus de LEDGER_RETENTION_DAYS"""
+    global ledger_last_purge
+    with ledger_lock:
+        conn = get_ledger()
+        with conn:
+            if batch_id:
+                cur = conn.execute('DELETE FROM ecritures WHERE batch_id = ?', (batch_id,))
+            elif before:
+                cur = conn.execute('DELETE FROM ecritures WHERE date < ?', (before,))
+            elif LEDGER_RETENTION_DAYS:
+                limit = time.time() - LEDGER_RETENTION_DAYS * 86400
+                cur = conn.execute('DELETE FROM ecritures WHERE created_at < ?', (limit,))
+                ledger_last_purge = time.time()
+            else:
+                return 0
+    if cur.rowcount:
+        logger.info(f"[Registre] {cur.rowcount} ecriture(s) supprimee(s)")
+    return cur.rowcount
+
+
+def ledger_where(start, end, compte=None):
+    clauses, params = ['date >= ?', 'date <= ?'], [start, end]
+    if compte:
+        # Prefixe de compte : "6" -> toutes les charges, "62510000" -> un compte
+        clauses.append('compte >= ? AND compte < ?')
+        params += [compte, compte + '\uffff']
+    return ' AND '.join(clauses), params
+
+
+def ledger_rows(start, end, compte=None):
+    """Ecritures d'une periode, lues en flux (connexion de lecture dediee)
+
+    Les references T sont renumerotees sur la periode : T1 d'un lot et T1
+    d'un autre lot deviennent deux pieces distinctes dans l'export.
+    """
+    where, params = ledger_where(start, end, compte)
+    conn = ledger_connect()
+    try:
+        cursor = conn.execute(
+            f'SELECT * FROM ecritures WHERE {where} ORDER BY date, batch_id, reference, line', params
+        )
+        pieces = {}
+        for row in cursor:
+            key = (row['batch_id'], row['reference'])
+            if key not in pieces:
+                pieces[key] = f'T{len(pieces) + 1}'
+            yield {
+                'date': row['date_piece'], 'reference': pieces[key], 'journal': row['journal'],
+                'compte': row['compte'], 'libelle': row['libelle'],
+                'debit': row['debit'], 'credit': row['credit']
+            }
+    finally:
+        conn.close()
+
+
+def ledger_totals(start, end, compte=None):
+    """Totaux debit / credit / solde par compte sur une periode"""
+    where, params = ledger_where(start, end, compte)
+    conn = ledger_connect()
+    try:
+        rows = conn.execute(
+            f'SELECT compte, COUNT(*) AS lignes, ROUND(SUM(debit), 2) AS debit, ROUND(SUM(credit), 2) AS credit '
+            f'FROM ecritures WHERE {where} GROUP BY compte ORDER BY compte', params
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        dict(compte=r['compte'], lignes=r['lignes'], debit=r['debit'], credit=r['credit'],
+             solde=round(r['debit'] - r['credit'], 2))
+        for r in rows
+    ]
+
+
+def stream_ledger_csv(rows):
+    """Export Sage en CSV (separateur ;) genere ligne a ligne"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(['Date', 'Reference', 'Journal', 'Compte', 'Libelle', 'Debit', 'Credit'])
+    for e in rows:
+        writer.writerow([
+            e['date'], e['reference'], e['journal'], e['compte'], e['libelle'],
+            f"{e['debit']:.2f}".replace('.', ','), f"{e['credit']:.2f}".replace('.', ',')
+        ])
+        if buffer.tell() >= DOWNLOAD_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# ===================================================================
+# CAPTURE DU TRAFIC (REJEU / CAPACITE)
+# ===================================================================
+
+# Une ligne JSON par page analysee : tailles, couche texte, tentatives providers
+# (latence, statut), attente d'ordonnanceur. Ni texte, ni image, ni ecriture ;
+# lots et sources ne sont conserves que sous forme d'empreinte.
+capture_context = threading.local()
+capture_lock = threading.Lock()
+
+
+def capture_begin():
+    capture_context.page = {'attempts': []} if TRAFFIC_CAPTURE else None
+
+
+def capture_note(**fields):
+    page = getattr(capture_context, 'page', None)
+    if page is not None:
+        page.update(fields)
+
+
+def capture_attempt(provider, tier, latency, status):
+    page = getattr(capture_context, 'page', None)
+    if page is not None:
+        page['attempts'].append({
+            'provider': provider, 'tier': tier, 'latency': round(latency, 3), 'status': status
+        })
+
+
+def attempt_status(error):
+    """Statut rejouable d'un appel en echec : code HTTP, timeout, connexion ou error"""
+    import requests
+    if isinstance(error, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return 'connection'
+    match = re.search(r'HTTP (\d{3})', str(error))
+    return match.group(1) if match else 'error'
+
+
+def anonymize(value):
+    return hashlib.sha256(str(value).encode()).hexdigest()[:12]
+
+
+def capture_source(source):
+    """email:compta@client.fr -> email:<empreinte> (type de source conserve)"""
+    kind, _, rest = source.partition(':')
+    return f"{kind}:{anonymize(rest)}" if rest else kind
+
+
+def capture_detach():
+    """Capture en cours du thread (worker d'analyse), a reprendre par capture_attach"""
+    page = getattr(capture_context, 'page', None)
+    capture_context.page = None
+    return page
+
+
+def capture_attach(page):
+    capture_context.page = page
+
+
+def capture_end(**fields):
+    """Ajoute la page capturee au fichier du jour"""
+    page = getattr(capture_context, 'page', None)
+    capture_context.page = None
+    if page is None:
+        return
+    page.update(fields)
+    line = json.dumps(page, separators=(',', ':'))
+    path = CAPTURE_FOLDER / f"capture_{datetime.now().strftime('%Y%m%d')}.jsonl"
+    try:
+        with capture_lock:
+            CAPTURE_FOLDER.mkdir(parents=True, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+    except OSError as e:
+        logger.error(f"[Capture] Ecriture impossible: {e}")
+
+
+def purge_captures():
+    """Supprime les captures plus vieilles que CAPTURE_RETENTION_DAYS"""
+    cutoff = time.time() - CAPTURE_RETENTION_DAYS * 86400
+    for f in CAPTURE_FOLDER.glob('capture_*.jsonl'):
+        try:
+            if f.stat().st_mtime < cutoff:
+                f.unlink()
+                logger.info(f"[Capture] Supprime {f.name}")
+        except FileNotFoundError:
+            pass
+
+
+# ===================================================================
+# TRAITEMENT PRINCIPAL
+# ===================================================================
+
+def new_batch_id():
+    """Identifiant de lot : horodatage + suffixe aleatoire (lots simultanes)"""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(3)}"
+
+
+_PIPELINE_END = object()
+
+
+def pipeline_put(q, item, abort):
+    """put bloquant interrompu si un autre etage du pipeline a echoue"""
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def pipeline_get(q, abort):
+    """get bloquant ; renvoie _PIPELINE_END si le pipeline est interrompu"""
+    while not abort.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _PIPELINE_END
+
+
+def pipeline_result(future, abort):
+    """Resultat d'un worker ; None si le pipeline est interrompu entre-temps"""
+    while not abort.is_set():
+        try:
+            return future.result(timeout=0.5)
+        except FutureTimeout:
+            continue
+    return None
+
+
+def run_pipeline_stage(target, errors, abort, profiler=None):
+    """Lance un etage dans un thread ; une exception interrompt tout le pipeline"""
+    def runner():
+        try:
+            with profiler.collect() if profiler else nullcontext():
+                target()
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+    thread = threading.Thread(target=runner, daemon=True)
+    thread.start()
+    return thread
+
+
+def process_tickets(files_data, batch_id=None, job_class='interactive', source='web', budget_seconds=None,
+                    profiler=None):
+    """Traite une liste de tickets (reprend le lot si batch_id a deja un journal)
+
+    Pipeline a trois etages relies par des files bornees : analyse (appels LLM
+    sur plusieurs workers, journal, doublons) -> validation/tampon de chaque page -> ecriture
+    incrementale du PDF fusionne et du classeur Sage. Chaque appel LLM passe
+    par job_scheduler avec la classe et la source du lot, et dans le budget de
+    temps du lot (BATCH_BUDGET_SECONDS de la classe par defaut).
+    """
+    from PyPDF2 import PdfReader, PdfWriter
+    purge_journals()
+    if TRAFFIC_CAPTURE:
+        purge_captures()
+    batch_id = batch_id or new_batch_id()
+    batch_start = time.time()
+    completed = load_journal(batch_id)
+    if completed:
+        logger.info(f"[Journal] Reprise du lot {batch_id} : {len(completed)} page(s) deja traitee(s)")
+    all_ecritures = []
+    inexploitable_tickets = []
+    alerts = []
+    results_detail = []
+
+    # Decoupage adaptatif : pages independantes, puis zones de tickets par page
+    split_files = []
+    unit_pages = []  # (pages du document d'origine, pages de l'unite) pour la capture
+    for file_info in files_data:
+        units = [file_info]
+        page_count = None
+        try:
+            reader = PdfReader(io.BytesIO(file_info['bytes']))
+            page_count = len(reader.pages)
+            if should_split(len(reader.pages), len(file_info['bytes'])):
+                logger.info(f"Split {file_info['filename']} : {len(reader.pages)} pages")
+                units = split_pdf_pages(file_info['bytes'], file_info['filename'])
+        except Exception as e:
+            logger.error(f"Erreur split {file_info['filename']}: {e}")
+        if REGION_SEGMENTATION:
+            units = [region for unit in units for region in split_ticket_regions(unit)]
+        split_files.extend(units)
+        unit_pages.extend([(page_count, page_count if len(units) == 1 else 1)] * len(units))
+
+    total_pages = len(split_files)
+    batch_index = PageHashIndex()
+    if budget_seconds is None:
+        budget_seconds = BATCH_BUDGET_SECONDS.get(job_class, 0)
+    deadline = Deadline(budget_seconds)
+    expired_pages = []
+    logger.info(f"{'='*50}")
+    logger.info(f"Traitement de {total_pages} page(s)")
+    logger.info(f"{'='*50}")
+
+    analyzed_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stamped_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    abort = threading.Event()
+    errors = []
+
+    worker_pace = threading.local()
+
+    def capture(idx, digest, outcome, status, started, waited=0.0, ended=None):
+        capture_end(
+            ts=round(started, 3), batch=anonymize(batch_id), batch_start=round(batch_start, 3),
+            job_class=job_class, source=capture_source(source), unit=idx, units=total_pages,
+            doc_pages=unit_pages[idx][0], pages=unit_pages[idx][1], bytes=len(split_files[idx]['bytes']), hash=digest[:16],
+            outcome=outcome, status=status, wait=round(waited, 3), seconds=round((ended or time.time()) - started, 3)
+        )
+
+    def analyze_unit(file_info, digest):
+        """Worker d'analyse : preflight puis appel LLM dans un creneau de l'ordonnanceur
+
+        Renvoie (record, DeadlineExceeded ou None, attente du creneau, capture, debut, fin).
+        """
+        with profiler.collect() if profiler else nullcontext():
+            # Rate limit pris par chaque worker avant son appel suivant : ne retarde pas la remise du resultat
+            pause = getattr(worker_pace, 'last', 0.0) + RATE_LIMIT_DELAY - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            log_context.batch_id = batch_id
+            log_context.page = file_info['filename']
+            started = time.time()
+            capture_begin()
+            record, expired, waited = None, None, 0.0
+            try:
+                deadline.check()
+                record = preflight_record(file_info, digest)
+                if record is None:
+                    with job_scheduler.slot(job_class, source) as waited:
+                        record = build_page_record(file_info, digest, deadline)
+            except DeadlineExceeded as e:
+                expired = e
+            finally:
+                worker_pace.last = time.time()
+            return record, expired, waited, capture_detach(), started, time.time()
+
+    def analysis_stage():
+        """Etage 1 : empreinte, doublons, journal ; appels LLM repartis sur des workers
+
+        Les pages a analyser partent aussitot vers les workers (au plus les creneaux
+        de l'ordonnanceur) ; les resultats sont remis dans l'ordre des pages, ce qui
+        fixe les references T, le journal et les doublons du lot comme en serie.
+        """
+        log_context.batch_id = batch_id
+        ticket_num = 1
+        plan = []
+        workers = ThreadPoolExecutor(max_workers=max(1, min(job_scheduler.slots, total_pages)),
+                                     thread_name_prefix='analyse')
+        try:
+            # Repartition : decisions sans appel LLM prises dans l'ordre des pages
+            for idx, file_info in enumerate(split_files):
+                if abort.is_set():
+                    return
+                filename = file_info['filename']
+                log_context.page = filename
+                pdf_bytes = file_info['bytes']
+                unit = {
+                    'file_info': file_info, 'digest': page_hash(pdf_bytes), 'alerts': [], 'started': time.time(),
+                    'original': None, 'entry': None, 'record': None, 'outcome': None, 'future': None
+                }
+                plan.append(unit)
+
+                fingerprint = unit['fingerprint'] = page_fingerprint(pdf_bytes)
+                duplicate = batch_index.lookup(fingerprint) if fingerprint else None
+
+                # Doublon certain dans le lot (memes octets ou meme texte) : pas de 2e reference T
+                if duplicate and duplicate[2]:
+                    unit['original'] = duplicate[0]
+                    unit['ended'] = time.time()
+                    continue
+                if duplicate:
+                    unit['alerts'].append(
+                        f"Doublon probable : {filename} ressemble a {duplicate[0]['filename']} "
+                        f"(distance {duplicate[1]}) \u2014 verifier avant import"
+                    )
+                if fingerprint:
+                    # Reference T renseignee a la remise dans l'ordre
+                    unit['entry'] = {'filename': filename, 'reference': None}
+                    batch_index.add(fingerprint, unit['entry'])
+
+                record = completed.get(unit['digest'])
+                previous = None
+                if record is None and fingerprint:
+                    previous = duplicate_history.lookup(fingerprint)
+                    # Pages de ce lot : deja signalees par batch_index
+                    if previous and previous[0]['batch_id'] == batch_id:
+                        previous = None
+                if previous and not previous[2] and not duplicate:
+                    # Rescan d'un ticket d'un lot recent (octets differents) : signale, analyse quand meme
+                    unit['alerts'].append(
+                        f"Doublon probable : {filename} ressemble a {previous[0]['record']['filename']} "
+                        f"du lot {previous[0]['batch_id']} (distance {previous[1]}) \u2014 verifier avant import"
+                    )
+                if record:
+                    logger.info(f"[{idx+1}/{total_pages}] {filename} - repris du journal")
+                    unit['outcome'] = 'journal'
+                elif previous and previous[2]:
+                    # Meme ticket deja analyse recemment (autre lot) : analyse reutilisee
+                    origin = previous[0]
+                    logger.info(f"[{idx+1}/{total_pages}] {filename} - analyse reutilisee du lot {origin['batch_id']}")
+                    unit['alerts'].append(f"{filename} : deja analyse dans le lot {origin['batch_id']}, analyse reutilisee")
+                    record = dict(origin['record'], page=unit['digest'], filename=filename)
+                    append_journal(batch_id, record)
+                    completed[unit['digest']] = record
+                    unit['outcome'] = 'reused'
+                else:
+                    logger.info(f"[{idx+1}/{total_pages}] {filename}")
+                    unit['future'] = workers.submit(analyze_unit, file_info, unit['digest'])
+                    unit['outcome'] = 'analyzed'
+                unit['record'] = record
+                unit['ended'] = time.time()
+
+            # Remise dans l'ordre des pages
+            for idx, unit in enumerate(plan):
+                file_info, digest = unit['file_info'], unit['digest']
+                filename = file_info['filename']
+                log_context.page = filename
+
+                if unit['original'] is not None:
+                    original = unit['original']
+                    raison = f"Doublon de {original['filename']} ({original['reference'] or 'rejete'})"
+                    logger.info(f"[{idx+1}/{total_pages}] {filename} - {raison}")
+                    record = {'filename': filename, 'status': 'inexploitable', 'raison': raison}
+                    capture_begin()
+                    capture(idx, digest, 'duplicate', record['status'], unit['started'], ended=unit['ended'])
+                    if not pipeline_put(analyzed_queue, (file_info, record, None, unit['alerts'], True), abort):
+                        return
+                    continue
+
+                record, outcome = unit['record'], unit['outcome']
+                started, waited, ended = unit['started'], 0.0, unit['ended']
+                if unit['future'] is None:
+                    capture_begin()
+                else:
+                    result = pipeline_result(unit['future'], abort)
+                    if result is None:
+                        return
+                    record, expired, waited, captured, started, ended = result
+                    capture_attach(captured)
+                    if expired:
+                        # Pas de journal : une reprise du lot retentera la page
+                        outcome = 'expired'
+                        expired_pages.append(filename)
+                        logger.info(f"[{idx+1}/{total_pages}] {filename} - delai depasse : {expired}")
+                        record = {
+                            'page': digest, 'filename': filename, 'status': 'inexploitable',
+                            'raison': f"Delai de traitement depasse : {expired} - page a resoumettre"
+                        }
+                    else:
+                        if record['status'] == 'exploitable':
+                            record['reference'] = f'T{ticket_num}'
+                        # Checkpoint durable avant tout travail CPU sur la page
+                        append_journal(batch_id, record)
+                        completed[digest] = record
+
+                reference = None
+                if record['status'] == 'exploitable':
+                    reference = f'T{ticket_num}'
+                    ticket_num += 1
+
+                if unit['entry'] is not None:
+                    unit['entry']['reference'] = reference
+                    if reference:
+                        duplicate_history.add(unit['fingerprint'], {'batch_id': batch_id, 'record': record})
+                capture(idx, digest, outcome, record['status'], started, waited, ended)
+
+                if not pipeline_put(analyzed_queue, (file_info, record, reference, unit['alerts'], False), abort):
+                    return
+            pipeline_put(analyzed_queue, _PIPELINE_END, abort)
+        finally:
+            workers.shutdown(wait=True, cancel_futures=True)
+
+    pdf_writer = PdfWriter()
+    excel_writer = SageExcelWriter()
+
+    def writer_stage():
+        """Etage 3 : ajout incremental au PDF fusionne et au classeur"""
+        while True:
+            item = pipeline_get(stamped_queue, abort)
+            if item is _PIPELINE_END:
+                return
+            stamped, ecritures, low_confidence = item
+            for page in PdfReader(io.BytesIO(stamped)).pages:
+                pdf_writer.add_page(page)
+            for e in ecritures:
+                excel_writer.add(e, low_confidence)
+
+    threads = [
+        run_pipeline_stage(analysis_stage, errors, abort, profiler),
+        run_pipeline_stage(writer_stage, errors, abort, profiler),
+    ]
+
+    # Etage 2 (thread courant) : controles, alertes et tampon des que le resultat arrive
+    exploited_count = 0
+    batch_checks = BatchChecks()
+    log_context.batch_id = batch_id
+    try:
+        while True:
+            item = pipeline_get(analyzed_queue, abort)
+            if item is _PIPELINE_END:
+                break
+            file_info, record, reference, page_alerts, batch_duplicate = item
+            filename = file_info['filename']
+            log_context.page = filename
+
+            if batch_duplicate:
+                raison = record['raison']
+                inexploitable_tickets.append({'filename': filename, 'raison': raison})
+                alerts.append(f"!! {filename} : {raison}")
+                results_detail.append({
+                    'filename': filename, 'status': 'inexploitable', 'raison': raison
+                })
+                continue
+            alerts.extend(page_alerts)
+
+            # Verification confiance
+            confidence = record.get('confidence', 1.0)
+            if confidence < 0.7:
+                alerts.append(
+                    f"\u26a0\ufe0f Confiance faible ({confidence:.0%}) "
+                    f"sur {filename} \u2014 verification manuelle recommandee"
+                )
+
+            if reference:
+                ecritures = [dict(e, reference=reference) for e in record['ecritures']]
+
+                for a in record['alerts']:
+                    alerts.append(f"{reference} ({filename}) : {a}")
+
+                all_ecritures.extend(ecritures)
+                batch_checks.add(reference, ecritures)
+                stamp_start = time.time()
+                stamped = stamp_pdf_with_s(file_info['bytes'])
+                logger.debug("[Tampon] %s : %.3fs", filename, time.time() - stamp_start)
+                if not pipeline_put(stamped_queue, (stamped, ecritures, confidence < 0.7), abort):
+                    break
+                results_detail.append({
+                    'filename': filename, 'status': 'exploitable',
+                    'reference': reference, 'ecritures': ecritures
+                })
+                exploited_count += 1
+            else:
+                raison = record['raison']
+                inexploitable_tickets.append({'filename': filename, 'raison': raison})
+                alerts.append(f"!! {filename} : {raison}")
+                results_detail.append({
+                    'filename': filename, 'status': 'inexploitable', 'raison': raison
+                })
+        pipeline_put(stamped_queue, _PIPELINE_END, abort)
+    except Exception:
+        abort.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        log_context.batch_id = log_context.page = None
+    if errors:
+        raise errors[0]
+
+    # Controles croises sur tout le lot (sommes par ticket deja faites par add()) : alertes et totaux
+    checks = batch_checks.validate()
+    alerts.extend(checks['alerts'])
+    total_d, total_c = checks['total_debit'], checks['total_credit']
+
+    # Generation fichiers (supprimes automatiquement apres FILE_RETENTION_MINUTES)
+    output_files = {}
+
+    if all_ecritures:
+        excel_bytes = excel_writer.finish(alerts if alerts else None, (total_d, total_c))
+        excel_name = f'Sage_import_{batch_id}.xlsx'
+        output_files['excel'] = write_output(excel_name, excel_bytes)
+
+    pdf_optimization = None
+    if exploited_count:
+        merged = io.BytesIO()
+        pdf_writer.write(merged)
+        merged_bytes = merged.getvalue()
+        if PDF_OPTIMIZE:
+            try:
+                merged_bytes, pdf_optimization = optimize_pdf(merged_bytes)
+                logger.info(
+                    f"[PDF] {pdf_optimization['bytes_in']} -> {pdf_optimization['bytes_out']} octets "
+                    f"en {pdf_optimization['seconds']}s ({pdf_optimization['images_downsampled']} image(s) reduite(s))",
+                    extra={'batch_id': batch_id}
+                )
+            except Exception as e:
+                logger.error(f"[PDF] Optimisation impossible: {e}", extra={'batch_id': batch_id})
+        stamped_name = f'Tickets_exploites_S_{batch_id}.pdf'
+        output_files['stamped_pdf'] = write_output(stamped_name, merged_bytes)
+
+    if inexploitable_tickets:
+        report = create_inexploitable_report(inexploitable_tickets)
+        report_name = f'Justificatifs_inexploites_{batch_id}.pdf'
+        output_files['inexploitable_pdf'] = write_output(report_name, report)
+
+    # Registre : ecritures validees uniquement (le registre ne bloque jamais le lot)
+    if LEDGER_ENABLED and all_ecritures:
+        try:
+            ledger_record_batch(batch_id, all_ecritures)
+            if time.time() - ledger_last_purge > 3600:
+                purge_ledger()
+        except sqlite3.Error as e:
+            logger.error(f"[Registre] Erreur: {e}", extra={'batch_id': batch_id})
+
+    logger.info(f"{'='*50}")
+    logger.info(f"RESULTAT : {exploited_count} exploites / {len(inexploitable_tickets)} inexploitables",
+                extra={'batch_id': batch_id})
+    logger.info(f"TOTAUX   : D={total_d} | C={total_c} | {'OK' if abs(total_d - total_c) < 0.01 else 'ERREUR'}",
+                extra={'batch_id': batch_id})
+    if expired_pages:
+        logger.info(f"BUDGET   : {deadline.seconds}s depasse, {len(expired_pages)} page(s) non analysee(s)",
+                    extra={'batch_id': batch_id})
     logger.info(f"{'='*50}")
 
     return {
+        'batch_id': batch_id,
         'output_files': output_files,
         'results_detail': results_detail,
         'summary': {
             'total': total_pages,
-            'exploites': len(exploited_pdfs),
+            'exploites': exploited_count,
             'inexploites': len(inexploitable_tickets),
             'total_debit': total_d,
             'total_credit': total_c,
-            'equilibre': abs(total_d - total_c) < 0.01
+            'equilibre': abs(total_d - total_c) < 0.01,
+            'batch_checks': {
+                key: len(checks[key]) for key in ('unbalanced', 'ht_tva_ttc', 'deductibility', 'duplicates')
+            },
+            'budget': {
+                'seconds': deadline.seconds,
+                'used': round(deadline.used(), 1),
+                'expired_pages': len(expired_pages)
+            },
+            'pdf_optimization': pdf_optimization
         }
     }
 
 
+# ===================================================================
+# PROFILAGE A LA DEMANDE
+# ===================================================================
+
+# Regroupement des fonctions par bibliotheque dans le resume
+PROFILE_CATEGORIES = (
+    ('PyPDF2', 'pdf_parsing'),
+    ('pymupdf', 'pymupdf'),
+    ('fitz', 'pymupdf'),
+    ('reportlab', 'stamping'),
+    ('openpyxl', 'excel'),
+    ('json', 'json'),
+    ('requests', 'network'),
+    ('urllib3', 'network'),
+    ('sqlite3', 'ledger'),
+)
+
+
+class JobProfiler:
+    """Profil cProfile d'un job, collecte dans chaque thread du pipeline"""
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def collect(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12 : un seul profileur actif a la fois, ce thread n'est pas profile
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def finish(self, batch_id, top_n=PROFILE_TOP_N):
+        """Enregistre le profil fusionne et renvoie le resume des fonctions chaudes"""
+        stats = pstats.Stats(*self.profiles)
+        PROFILE_FOLDER.mkdir(exist_ok=True)
+        path = PROFILE_FOLDER / f'{batch_id}.prof'
+        stats.dump_stats(path)
+        prune_profiles()
+
+        by_category = {}
+        functions = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            category = next((c for key, c in PROFILE_CATEGORIES if key in filename), None)
+            if category is None:
+                if filename == '~':
+                    # Attentes (files du pipeline, rate limit, reseau) : pas du temps CPU
+                    waiting = any(w in name for w in ('acquire', 'sleep', 'wait', 'recv', 'select'))
+                    category = 'wait' if waiting else 'builtin'
+                elif 'importlib' in filename:
+                    category = 'imports'
+                else:
+                    category = 'app' if filename.endswith('app.py') else 'other'
+            by_category[category] = by_category.get(category, 0.0) + tottime
+            if category != 'wait':
+                functions.append((tottime, cumtime, ncalls, f"{Path(filename).name}:{line}({name})"))
+        functions.sort(reverse=True)
+        return {
+            'file': path.name,
+            'total_seconds': round(stats.total_tt, 3),
+            'by_category': {c: round(t, 3) for c, t in sorted(by_category.items(), key=lambda x: -x[1])},
+            'top': [
+                {'function': label, 'calls': ncalls, 'self_s': round(tottime, 4), 'cumulative_s': round(cumtime, 4)}
+                for tottime, cumtime, ncalls, label in functions[:top_n]
+            ]
+        }
+
+
+def prune_profiles():
+    """Borne le dossier des profils : anciennete et nombre de fichiers"""
+    limit = time.time() - PROFILE_RETENTION_MINUTES * 60
+    files = sorted(PROFILE_FOLDER.glob('*.prof'), key=lambda f: f.stat().st_mtime, reverse=True)
+    for index, path in enumerate(files):
+        if index >= PROFILE_MAX_FILES or path.stat().st_mtime < limit:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def profiling_requested():
+    """En-tete X-Profile-Token egal a PROFILE_TOKEN (reserve a l'admin)
+
+    Jamais en parametre d'URL : le secret finirait dans les logs d'acces et
+    l'historique du navigateur.
+    """
+    if not PROFILE_TOKEN:
+        return False
+    token = request.headers.get('X-Profile-Token', '')
+    return hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+def process_tickets_profiled(files_data, profile=False, **kwargs):
+    """process_tickets, avec resume de profil dans results['profile'] si demande"""
+    if not profile:
+        return process_tickets(files_data, **kwargs)
+    profiler = JobProfiler()
+    with profiler.collect():
+        results = process_tickets(files_data, profiler=profiler, **kwargs)
+    results['profile'] = profiler.finish(results['batch_id'])
+    logger.info(
+        f"[Profil] {results['profile']['file']} : "
+        + ", ".join(f"{c}={t}s" for c, t in results['profile']['by_category'].items()),
+        extra={'batch_id': results['batch_id']}
+    )
+    return results
+
+
 # ===================================================================
 # EMAIL
 # ===================================================================
 
+# Pool de workers : chaque mail est un job independant
+email_executor = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix='email')
+email_slots = threading.BoundedSemaphore(EMAIL_QUEUE_SIZE)
+email_in_flight = set()
+email_failures = {}
+email_batches = {}  # UID -> batch_id : un nouvel essai reprend le journal du lot
+email_done = queue.Queue()  # UIDs a marquer lus par le thread IMAP
+email_lock = threading.Lock()
+
+# Pool de sessions SMTP authentifiees, reutilisees entre les envois
+smtp_pool = queue.LifoQueue(maxsize=EMAIL_WORKERS)
+
+
+def smtp_connect():
+    """Ouvre et authentifie une nouvelle session SMTP"""
+    if SMTP_SECURITY == 'ssl':
+        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=60)
+    else:
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=60)
+        if SMTP_SECURITY == 'starttls':
+            server.starttls()
+    server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    return server
+
+
+def smtp_close(server):
+    """Ferme une session SMTP sans lever d'erreur"""
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+@contextmanager
+def smtp_connection():
+    """Emprunte une session SMTP du pool (reconnexion si perimee)"""
+    server = None
+    try:
+        server, last_used = smtp_pool.get_nowait()
+        if time.time() - last_used > SMTP_IDLE_TIMEOUT or server.noop()[0] != 250:
+            smtp_close(server)
+            server = None
+    except queue.Empty:
+        pass
+    except smtplib.SMTPException:
+        server = None
+    if server is None:
+        server = smtp_connect()
+
+    try:
+        yield server
+    except Exception:
+        smtp_close(server)
+        raise
+    try:
+        smtp_pool.put_nowait((server, time.time()))
+    except queue.Full:
+        smtp_close(server)
+
+
 def send_email_with_attachments(to_email, subject, body, attachments):
     msg = MIMEMultipart()
     msg['From'] = EMAIL_ADDRESS
@@ -942,35 +3532,26 @@ def send_email_with_attachments(to_email, subject, body, attachments):
         encoders.encode_base64(part)
         part.add_header('Content-Disposition', f'attachment; filename="{att_filename}"')
         msg.attach(part)
-    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        server.send_message(msg)
+    # Une session du pool peut avoir ete coupee par le serveur : un seul nouvel essai
+    for attempt in range(2):
+        try:
+            with smtp_connection() as server:
+                server.send_message(msg)
+            return
+        except smtplib.SMTPServerDisconnected:
+            if attempt:
+                raise
 
 
-def check_emails_once():
-    """Une iteration de verification des emails"""
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-    mail.select('INBOX')
-    _, messages = mail.search(None, 'UNSEEN')
-    for num in messages[0].split():
-        if not num:
-            continue
-        _, msg_data = mail.fetch(num, '(RFC822)')
-        msg = email.message_from_bytes(msg_data[0][1])
-        sender = email.utils.parseaddr(msg['From'])[1]
-        subject = msg['Subject'] or 'Sans objet'
-        files_data = []
-        for part in msg.walk():
-            if part.get_content_type() == 'application/pdf':
-                att_filename = part.get_filename() or 'document.pdf'
-                pdf_bytes = part.get_payload(decode=True)
-                if pdf_bytes:
-                    files_data.append({'filename': att_filename, 'bytes': pdf_bytes})
-        if not files_data:
-            continue
+def process_email_job(uid, sender, subject, files_data):
+    """Job d'un mail : traitement, reponse, puis marquage lu si succes"""
+    try:
         logger.info(f"[EMAIL] Mail de {sender} - {len(files_data)} PDF(s)")
-        results = process_tickets(files_data)
+        with email_lock:
+            batch_id = email_batches.setdefault(uid, new_batch_id())
+        results = process_tickets_profiled(
+            files_data, profile=PROFILE_EMAIL, batch_id=batch_id, job_class='email', source=f'email:{sender}'
+        )
         attachments = []
         files = results['output_files']
         for key in ['excel', 'stamped_pdf', 'inexploitable_pdf']:
@@ -990,7 +3571,96 @@ Traitement de vos {s['total']} justificatif(s) termine.
 
 Agent Comptable IA"""
         send_email_with_attachments(sender, f"Re: {subject}", body, attachments)
+        # Marque lu uniquement apres envoi reussi de la reponse
+        email_done.put(uid)
         logger.info(f"[EMAIL] Reponse envoyee a {sender}")
+    except Exception as e:
+        with email_lock:
+            email_failures[uid] = email_failures.get(uid, 0) + 1
+            failures = email_failures[uid]
+        if failures >= EMAIL_MAX_ATTEMPTS:
+            logger.error(f"[EMAIL] Mail {uid} abandonne apres {failures} echecs (reste non lu): {e}")
+        else:
+            logger.error(f"[EMAIL] Echec mail {uid} ({failures}/{EMAIL_MAX_ATTEMPTS}), nouvel essai au prochain passage: {e}")
+    finally:
+        with email_lock:
+            email_in_flight.discard(uid)
+        email_slots.release()
+
+
+def flush_seen_emails(mail):
+    """Marque \\Seen les mails dont la reponse a ete envoyee"""
+    while True:
+        try:
+            uid = email_done.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            mail.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+            with email_lock:
+                email_failures.pop(uid, None)
+                email_batches.pop(uid, None)
+        except Exception:
+            email_done.put(uid)
+            raise
+
+
+def imap_connect():
+    """Connexion IMAP (TLS sauf IMAP_SSL=false, ex. serveur de test local)"""
+    if IMAP_SSL:
+        return imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+    return imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
+
+
+def check_emails_once():
+    """Une iteration : distribue les mails non lus sur le pool de workers"""
+    mail = imap_connect()
+    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    mail.select('INBOX')
+    flush_seen_emails(mail)
+    _, messages = mail.uid('SEARCH', None, 'UNSEEN')
+    for raw_uid in messages[0].split():
+        if not raw_uid:
+            continue
+        uid = raw_uid.decode()
+        with email_lock:
+            if uid in email_in_flight or email_failures.get(uid, 0) >= EMAIL_MAX_ATTEMPTS:
+                continue
+        # File pleine : les mails restants seront repris au prochain passage
+        if not email_slots.acquire(blocking=False):
+            logger.info("[EMAIL] File de traitement pleine, report au prochain passage")
+            break
+        # Jusqu'au submit, le creneau appartient a cette boucle : une erreur IMAP
+        # (deconnexion) ou de parsing le rend avant de remonter au watchdog
+        slot_held = True
+        try:
+            # BODY.PEEK : ne pas marquer lu avant la reponse
+            _, msg_data = mail.uid('FETCH', uid, '(BODY.PEEK[])')
+            msg = email.message_from_bytes(msg_data[0][1])
+            sender = email.utils.parseaddr(msg['From'])[1]
+            subject = msg['Subject'] or 'Sans objet'
+            files_data = []
+            for part in msg.walk():
+                if part.get_content_type() == 'application/pdf':
+                    att_filename = part.get_filename() or 'document.pdf'
+                    pdf_bytes = part.get_payload(decode=True)
+                    if pdf_bytes:
+                        files_data.append({'filename': att_filename, 'bytes': pdf_bytes})
+            if not files_data:
+                slot_held = False
+                email_slots.release()
+                mail.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+                continue
+            with email_lock:
+                email_in_flight.add(uid)
+            email_executor.submit(process_email_job, uid, sender, subject, files_data)
+            slot_held = False  # rendu par process_email_job
+        finally:
+            if slot_held:
+                with email_lock:
+                    email_in_flight.discard(uid)
+                email_slots.release()
+    flush_seen_emails(mail)
     mail.logout()
 
 
@@ -1006,6 +3676,191 @@ def check_emails():
         time.sleep(CHECK_INTERVAL)
 
 
+# ===================================================================
+# TELECHARGEMENTS
+# ===================================================================
+
+class DownloadFile(io.FileIO):
+    """Fichier servi en download : memorise l'octet le plus loin transmis"""
+
+    def __init__(self, path, on_close=None):
+        super().__init__(path, 'rb')
+        self.size = os.fstat(self.fileno()).st_size
+        self.high_water = 0
+        self.range_stop = self.size  # fin de la plage demandee (Range)
+        self.sends_body = False  # GET 200 / 206 : corps effectivement transmis
+        self.on_close = on_close
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.high_water = max(self.high_water, self.tell())
+        return data
+
+    def close(self):
+        # Appele par le serveur WSGI une fois la reponse terminee ou abandonnee
+        was_open = not self.closed
+        super().close()
+        if was_open and self.on_close:
+            self.on_close(self)
+
+
+def finish_download(download):
+    """Supprime le fichier une fois le corps entierement envoye (ZDR)"""
+    filepath = Path(download.name)
+    if not download.sends_body:
+        return  # HEAD, 304, 416 : rien n'a ete transmis
+    # Aucune lecture Python : corps confie a sendfile, suppression selon ZDR_DELETE_ZERO_COPY
+    zero_copy = download.high_water == 0 and download.range_stop == download.size
+    if zero_copy and not ZDR_DELETE_ZERO_COPY:
+        logger.info(f"[ZDR] {filepath.name} servi en zero-copy, conserve jusqu'a echeance")
+        return
+    # Download interrompu : on garde le fichier pour une reprise (Range),
+    # supprime a son echeance par schedule_cleanup
+    if not zero_copy and (download.range_stop < download.size or download.high_water < download.size):
+        logger.info(f"[ZDR] Download partiel de {filepath.name}, fichier conserve")
+        return
+    try:
+        filepath.unlink()
+        unregister_output(filepath.name)
+        logger.info(f"[ZDR] Fichier supprime apres download: {filepath.name}")
+    except Exception:
+        pass
+
+
+class ZipStream(io.RawIOBase):
+    """Tampon d'ecriture non seekable : zipfile y ecrit, le generateur le vide"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(paths):
+    """Genere un ZIP a la volee (sans fichier temporaire) puis supprime les sources"""
+    buffer = ZipStream()
+    # PDF et xlsx sont deja compresses : ZIP_STORED evite un travail CPU inutile
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+        for path in paths:
+            with open(path, 'rb') as src, zf.open(path.name, 'w', force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+    # Atteint seulement si le client a tout recu (sinon GeneratorExit)
+    for path in paths:
+        try:
+            path.unlink()
+            unregister_output(path.name)
+            logger.info(f"[ZDR] Fichier supprime apres download ZIP: {path.name}")
+        except Exception:
+            pass
+
+
+# ===================================================================
+# IDEMPOTENCE WEBHOOK
+# ===================================================================
+
+# cle -> {'payload', 'done' (Event), 'results', 'error', 'expires_at'}
+webhook_jobs = {}
+webhook_jobs_lock = threading.Lock()
+
+
+def purge_webhook_jobs():
+    now = time.time()
+    with webhook_jobs_lock:
+        for key in [k for k, job in webhook_jobs.items() if job['expires_at'] and job['expires_at'] <= now]:
+            del webhook_jobs[key]
+
+
+def claim_webhook_job(key, payload_hash):
+    """Renvoie (job, owner) : owner=True si l'appelant doit executer le traitement
+
+    Un doublon concurrent recoit le job en cours et attend son resultat ; un
+    doublon d'un job termine recoit le resultat memorise.
+    """
+    purge_webhook_jobs()
+    with webhook_jobs_lock:
+        job = webhook_jobs.get(key)
+        if job is not None:
+            return job, False
+        job = {
+            'payload': payload_hash, 'done': threading.Event(), 'batch_id': None,
+            'results': None, 'error': None, 'expires_at': None
+        }
+        webhook_jobs[key] = job
+        return job, True
+
+
+def finish_webhook_job(key, job, results=None, error=None):
+    with webhook_jobs_lock:
+        job['results'] = results
+        job['error'] = error
+        if error is None:
+            retention = min(IDEMPOTENCY_TTL_MINUTES, FILE_RETENTION_MINUTES)
+            job['expires_at'] = time.time() + retention * 60
+        elif webhook_jobs.get(key) is job:
+            # Echec : un nouvel envoi de la meme cle relance le traitement
+            del webhook_jobs[key]
+    job['done'].set()
+
+
+def run_webhook_job(key, job, files_data, **kwargs):
+    """Traitement d'un lot webhook, detache de la requete qui l'a soumis"""
+    try:
+        results = process_tickets_profiled(files_data, **kwargs)
+    except Exception as e:
+        logger.error(f"[Webhook] Lot {job['batch_id']} en echec : {e}")
+        finish_webhook_job(key, job, error=str(e))
+        return
+    finish_webhook_job(key, job, results=results)
+
+
+def webhook_pending(job):
+    """202 : lot toujours en cours apres WEBHOOK_WAIT_SECONDS"""
+    response = jsonify({
+        'batch_id': job['batch_id'], 'status': 'en_cours',
+        'message': "Traitement en cours : renvoyer la meme requete pour obtenir le resultat"
+    })
+    response.status_code = 202
+    response.headers['Retry-After'] = str(max(1, min(WEBHOOK_WAIT_SECONDS, 30)))
+    return response
+
+
+def webhook_response(results):
+    """Summary + fichiers en base64 ; None si un fichier a deja expire"""
+    response_data = {'batch_id': results['batch_id'], 'summary': results['summary'], 'files': {}}
+    if results.get('profile'):
+        response_data['profile'] = results['profile']
+    for key, file_info in results['output_files'].items():
+        try:
+            with open(file_info['path'], 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        response_data['files'][key] = {
+            'name': file_info['name'],
+            'data': base64.b64encode(data).decode()
+        }
+    return response_data
+
+
 # ===================================================================
 # ROUTES
 # ===================================================================
@@ -1088,8 +3943,15 @@ def api_process():
     if not files_data:
         return jsonify({'error': 'Aucun fichier PDF valide'}), 400
 
+    # Meme batch_id apres un echec : reprise depuis le journal
+    batch_id = request.form.get('batch_id') or None
+    if batch_id and not BATCH_ID_PATTERN.match(batch_id):
+        return jsonify({'error': 'batch_id invalide'}), 400
+
     try:
-        results = process_tickets(files_data)
+        results = process_tickets_profiled(
+            files_data, profile=profiling_requested(), batch_id=batch_id, source=f'web:{request.remote_addr}'
+        )
 
         # Nettoyage immediat des donnees en memoire
         for fd in files_data:
@@ -1117,36 +3979,160 @@ def download_file(filename):
     except ValueError:
         abort(403)
 
-    @after_this_request
-    def remove_file(response):
-        try:
-            filepath.unlink()
-            logger.info(f"[ZDR] Fichier supprime apres download: {safe_name}")
-        except Exception:
-            pass
-        return response
+    if app.config['USE_X_SENDFILE']:
+        return send_file(filepath, as_attachment=True, download_name=safe_name)
+
+    # send_file passe par wsgi.file_wrapper (sendfile cote serveur WSGI) ;
+    # Range gere par make_conditional pour reprendre un download interrompu
+    download = DownloadFile(filepath, on_close=finish_download)
+    mtime = os.fstat(download.fileno()).st_mtime
+    response = send_file(
+        download, as_attachment=True, download_name=safe_name,
+        conditional=False, etag=False, last_modified=mtime
+    )
+    response.content_length = download.size
+    response.set_etag(f"{mtime}-{download.size}")
+    try:
+        response = response.make_conditional(
+            request, accept_ranges=True, complete_length=download.size
+        )
+    except Exception:
+        download.close()
+        raise
+    if response.status_code == 206:
+        download.range_stop = response.content_range.stop
+    download.sends_body = request.method == 'GET' and response.status_code in (200, 206)
+    return response
+
+
+@app.route('/api/download/batch/<batch_id>')
+@login_required
+def download_batch(batch_id):
+    """Tous les fichiers d'un lot dans un seul ZIP genere a la volee"""
+    if not BATCH_ID_PATTERN.match(batch_id):
+        abort(400)
+
+    paths = sorted(f for f in OUTPUT_FOLDER.glob(f'*_{batch_id}.*') if f.is_file())
+    if not paths:
+        return jsonify({'error': 'Lot non trouve'}), 404
+
+    return Response(
+        stream_zip(paths),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="Lot_{batch_id}.zip"'}
+    )
+
+
+def parse_iso_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def ledger_period_args():
+    """(start, end) depuis la query string, None si absent ou invalide"""
+    start = parse_iso_date(request.args.get('start'))
+    end = parse_iso_date(request.args.get('end'))
+    if not start or not end or start > end:
+        return None
+    return start, end
+
+
+@app.route('/api/ledger/export')
+@login_required
+def ledger_export():
+    """Export Sage d'une periode depuis le registre (xlsx par defaut, ou csv en flux)"""
+    if not LEDGER_ENABLED:
+        return jsonify({'error': 'Registre desactive (LEDGER_ENABLED)'}), 404
+    period = ledger_period_args()
+    if period is None:
+        return jsonify({'error': 'Parametres start/end attendus au format AAAA-MM-JJ'}), 400
+    start, end = period
+    compte = request.args.get('compte', '').strip()
+    if compte and not compte.isdigit():
+        return jsonify({'error': 'compte invalide'}), 400
+
+    rows = ledger_rows(start, end, compte)
+    if request.args.get('format') == 'csv':
+        return Response(
+            stream_ledger_csv(rows),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="Sage_{start}_{end}.csv"'}
+        )
+
+    writer = SageExcelWriter()
+    for e in rows:
+        writer.add(e)
+    return Response(
+        writer.finish(),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename="Sage_{start}_{end}.xlsx"'}
+    )
+
 
-    return send_file(filepath, as_attachment=True, download_name=safe_name)
+@app.route('/api/ledger/totals')
+@login_required
+def ledger_totals_route():
+    if not LEDGER_ENABLED:
+        return jsonify({'error': 'Registre desactive (LEDGER_ENABLED)'}), 404
+    period = ledger_period_args()
+    if period is None:
+        return jsonify({'error': 'Parametres start/end attendus au format AAAA-MM-JJ'}), 400
+    compte = request.args.get('compte', '').strip()
+    if compte and not compte.isdigit():
+        return jsonify({'error': 'compte invalide'}), 400
+    start_time = time.time()
+    totals = ledger_totals(*period, compte)
+    return jsonify({
+        'start': period[0], 'end': period[1], 'comptes': totals,
+        'total_debit': round(sum(t['debit'] for t in totals), 2),
+        'total_credit': round(sum(t['credit'] for t in totals), 2),
+        'query_ms': round((time.time() - start_time) * 1000, 2)
+    })
+
+
+@app.route('/api/ledger/purge', methods=['POST'])
+@login_required
+def ledger_purge_route():
+    """Suppression d'un lot (batch_id) ou des ecritures anterieures a une date (before)"""
+    if not LEDGER_ENABLED:
+        return jsonify({'error': 'Registre desactive (LEDGER_ENABLED)'}), 404
+    data = request.get_json(silent=True) or request.form
+    batch_id = data.get('batch_id')
+    before = data.get('before')
+    if batch_id and not BATCH_ID_PATTERN.match(batch_id):
+        return jsonify({'error': 'batch_id invalide'}), 400
+    if before and not parse_iso_date(before):
+        return jsonify({'error': 'before attendu au format AAAA-MM-JJ'}), 400
+    if not batch_id and not before:
+        return jsonify({'error': 'batch_id ou before requis'}), 400
+    return jsonify({'deleted': purge_ledger(batch_id=batch_id, before=before)})
 
 
 @app.route('/api/status')
 @login_required
 def api_status():
+    # Lecture du cache alimente par provider_health_loop : aucun appel reseau ici
+    with provider_health_lock:
+        health = {name: dict(h) for name, h in provider_health.items()}
     providers = {
-        'anthropic': bool(ANTHROPIC_API_KEY),
-        'openai': bool(OPENAI_API_KEY),
-        'ollama': False
+        'anthropic': bool(ANTHROPIC_API_KEY) and health['anthropic']['ok'] is not False,
+        'openai': bool(OPENAI_API_KEY) and health['openai']['ok'] is not False,
+        'ollama': bool(health['ollama']['ok'])
     }
-    try:
-        r = requests.get(f'{OLLAMA_URL}/api/tags', timeout=3)
-        providers['ollama'] = r.status_code == 200
-    except Exception:
-        pass
 
     return jsonify({
         'providers': providers,
+        'provider_health': health,
+        'ollama_endpoints': ollama_pool_status(),
+        'json_retries': json_retry_report(),
+        'model_tiers': tier_report(),
+        'text_compaction': text_compact_report(),
+        'scheduler': job_scheduler.report(),
         'active_providers': sum(1 for v in providers.values() if v),
-        'file_retention_minutes': FILE_RETENTION_MINUTES
+        'file_retention_minutes': FILE_RETENTION_MINUTES,
+        'output_files': output_stats()
     })
 
 
@@ -1165,37 +4151,92 @@ def webhook():
     if not data or 'files' not in data:
         return jsonify({'error': 'Format invalide, attendu: {"files": [{"name": "...", "data": "base64..."}]}'}), 400
 
-    files_data = []
-    for f in data['files']:
-        pdf_bytes = base64.b64decode(f['data'])
-        if pdf_bytes[:5] != b'%PDF-':
-            continue
-        files_data.append({
-            'filename': sanitize_filename(f.get('name', 'document.pdf')),
-            'bytes': pdf_bytes
-        })
+    # Cle d'idempotence : en-tete explicite, sinon empreinte du corps
+    payload_hash = hashlib.sha256(request.get_data()).hexdigest()
+    idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+    if idempotency_key and not IDEMPOTENCY_KEY_PATTERN.match(idempotency_key):
+        return jsonify({'error': 'Idempotency-Key invalide'}), 400
+    job_key = f"key:{idempotency_key}" if idempotency_key else f"sha:{payload_hash}"
+
+    job, owner = claim_webhook_job(job_key, payload_hash)
+    if not owner:
+        if job['payload'] != payload_hash:
+            return jsonify({'error': 'Idempotency-Key deja utilisee pour un autre contenu'}), 422
+        logger.info(f"[Webhook] {job_key[:20]} : {'en cours, attente' if not job['done'].is_set() else 'rejoue'}")
+        if not job['done'].wait(WEBHOOK_WAIT_SECONDS):
+            return webhook_pending(job)
+        if job['error'] is not None:
+            return jsonify({'error': job['error']}), 500
+        response_data = webhook_response(job['results'])
+        if response_data is not None:
+            response = jsonify(response_data)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        # Fichiers deja supprimes : le resultat n'est plus rejouable
+        with webhook_jobs_lock:
+            if webhook_jobs.get(job_key) is job:
+                del webhook_jobs[job_key]
+        job, owner = claim_webhook_job(job_key, payload_hash)
+        if not owner:
+            return jsonify({'error': 'Traitement deja en cours pour cette cle'}), 409
 
-    if not files_data:
-        return jsonify({'error': 'Aucun PDF valide'}), 400
-
-    results = process_tickets(files_data)
+    try:
+        files_data = []
+        for f in data['files']:
+            pdf_bytes = base64.b64decode(f['data'])
+            if pdf_bytes[:5] != b'%PDF-':
+                continue
+            files_data.append({
+                'filename': sanitize_filename(f.get('name', 'document.pdf')),
+                'bytes': pdf_bytes
+            })
 
+        if not files_data:
+            finish_webhook_job(job_key, job, error='Aucun PDF valide')
+            return jsonify({'error': 'Aucun PDF valide'}), 400
+
+        batch_id = data.get('batch_id') or None
+        if batch_id and not BATCH_ID_PATTERN.match(batch_id):
+            finish_webhook_job(job_key, job, error='batch_id invalide')
+            return jsonify({'error': 'batch_id invalide'}), 400
+
+        source = re.sub(r'[^\w.@-]', '', str(data.get('source') or ''))[:64] or 'openclaw'
+        job['batch_id'] = batch_id = batch_id or new_batch_id()
+        # Lot traite hors du thread de requete : un lot lent ne retient pas l'appelant
+        threading.Thread(
+            target=run_webhook_job, args=(job_key, job, files_data), daemon=True,
+            kwargs={'profile': profiling_requested(), 'batch_id': batch_id,
+                    'job_class': 'webhook', 'source': f'webhook:{source}'}
+        ).start()
+    except Exception as e:
+        finish_webhook_job(job_key, job, error=str(e))
+        raise
+
+    if not job['done'].wait(WEBHOOK_WAIT_SECONDS):
+        logger.info(f"[Webhook] Lot {batch_id} en cours apres {WEBHOOK_WAIT_SECONDS}s : 202")
+        return webhook_pending(job)
+    if job['error'] is not None:
+        return jsonify({'error': job['error']}), 500
     # Retourne le summary + les fichiers en base64
-    response_data = {'summary': results['summary'], 'files': {}}
-    for key, file_info in results['output_files'].items():
-        with open(file_info['path'], 'rb') as fh:
-            response_data['files'][key] = {
-                'name': file_info['name'],
-                'data': base64.b64encode(fh.read()).decode()
-            }
-
-    return jsonify(response_data)
+    return jsonify(webhook_response(job['results']))
 
 
 # ===================================================================
 # DEMARRAGE
 # ====================================================================
 
+def warmup():
+    """Importe les bibliotheques lourdes et lit le prompt avant la 1re requete"""
+    start = time.time()
+    import requests  # noqa: F401
+    import fitz  # noqa: F401
+    import PyPDF2  # noqa: F401
+    import openpyxl  # noqa: F401
+    import reportlab.pdfgen.canvas  # noqa: F401
+    get_system_prompt()
+    logger.info(f"[Warmup] Bibliotheques et prompt charges en {time.time() - start:.2f}s")
+
+
 if __name__ == '__main__':
     logger.info("=" * 50)
     logger.info("  AGENT COMPTABLE IA v5.0 SECURE")
@@ -1212,11 +4253,7 @@ if __name__ == '__main__':
     logger.info("Providers :")
     logger.info(f"  Claude  : {'OK' if ANTHROPIC_API_KEY else 'NON'}")
     logger.info(f"  OpenAI  : {'OK' if OPENAI_API_KEY else 'NON'}")
-    try:
-        r = requests.get(f'{OLLAMA_URL}/api/tags', timeout=3)
-        logger.info(f"  Ollama  : {'OK - ' + OLLAMA_MODEL if r.status_code == 200 else 'NON'}")
-    except Exception:
-        logger.info(f"  Ollama  : NON ({OLLAMA_URL})")
+    logger.info(f"  Ollama  : {OLLAMA_MODEL} sur {', '.join(OLLAMA_URLS)} (sonde en arriere-plan)")
 
     logger.info(f"  Webhook : {'actif sur /api/webhook' if WEBHOOK_TOKEN else 'desactive (WEBHOOK_TOKEN non defini)'}")
 
@@ -1231,7 +4268,18 @@ if __name__ == '__main__':
     cleanup_thread = threading.Thread(target=schedule_cleanup, daemon=True)
     cleanup_thread.start()
 
-    logger.info(f"Interface : http://localhost:5000")
+    # Sonde de sante des providers (cache pour /api/status et la selection)
+    health_thread = threading.Thread(target=provider_health_loop, daemon=True)
+    health_thread.start()
+
+    # Warmup + keep-alive des serveurs Ollama
+    ollama_thread = threading.Thread(target=ollama_keepalive_loop, daemon=True)
+    ollama_thread.start()
+
+    if STARTUP_WARMUP:
+        threading.Thread(target=warmup, daemon=True).start()
+
+    logger.info(f"Interface : http://localhost:{PORT}")
     logger.info("=" * 50)
 
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
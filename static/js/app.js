@@ -4,6 +4,15 @@ const fileList = document.getElementById('fileList');
 const processBtn = document.getElementById('processBtn');
 
 let selectedFiles = [];
+// Conserve apres un echec : renvoyer les memes fichiers reprend le lot cote serveur
+let batchId = null;
+
+function newBatchId() {
+    const d = new Date();
+    const p = n => String(n).padStart(2, '0');
+    const rand = Array.from(crypto.getRandomValues(new Uint8Array(3)), b => b.toString(16).padStart(2, '0')).join('');
+    return `${d.getFullYear()}${p(d.getMonth() + 1)}${p(d.getDate())}_${p(d.getHours())}${p(d.getMinutes())}${p(d.getSeconds())}_${rand}`;
+}
 
 // Drag & Drop
 ['dragenter', 'dragover'].forEach(e => {
@@ -65,8 +74,10 @@ processBtn.addEventListener('click', async () => {
     document.getElementById('upload-section').style.display = 'none';
     document.getElementById('loading').classList.add('active');
 
+    if (!batchId) batchId = newBatchId();
     const formData = new FormData();
     selectedFiles.forEach(f => formData.append('files', f));
+    formData.append('batch_id', batchId);
 
     try {
         const resp = await fetch('/api/process', {
@@ -84,14 +95,15 @@ processBtn.addEventListener('click', async () => {
 
         if (data.error) {
             alert('Erreur : ' + data.error);
-            resetAll();
+            backToUpload();
             return;
         }
 
+        batchId = null;
         showResults(data);
     } catch (err) {
-        alert('Erreur de connexion : ' + err.message);
-        resetAll();
+        alert('Erreur de connexion : ' + err.message + '\nRelancez l\'analyse pour reprendre le lot.');
+        backToUpload();
     }
 });
 
@@ -137,6 +149,10 @@ function showResults(data) {
     if (dl.inexploitable_pdf) {
         dlHtml += downloadCard('\u26A0\uFE0F', 'pdf-x', dl.inexploitable_pdf.name, 'Justificatifs a corriger');
     }
+    if (data.batch_id && Object.keys(dl).length > 1) {
+        dlHtml += downloadCard('\u{1F4E6}', 'zip', `Lot_${data.batch_id}.zip`, 'Tous les fichiers du lot en une fois',
+            `/api/download/batch/${data.batch_id}`);
+    }
 
     document.getElementById('downloads').innerHTML = dlHtml;
 
@@ -155,7 +171,7 @@ function showResults(data) {
     }).join('');
 }
 
-function downloadCard(icon, type, filename, desc) {
+function downloadCard(icon, type, filename, desc, href = `/api/download/${filename}`) {
     return `
         <div class="download-card">
             <div class="download-info">
@@ -165,13 +181,19 @@ function downloadCard(icon, type, filename, desc) {
                     <div class="download-desc">${desc}</div>
                 </div>
             </div>
-            <a href="/api/download/${filename}" class="download-btn">Telecharger</a>
+            <a href="${href}" class="download-btn">Telecharger</a>
         </div>
     `;
 }
 
+function backToUpload() {
+    document.getElementById('upload-section').style.display = 'block';
+    document.getElementById('loading').classList.remove('active');
+}
+
 function resetAll() {
     selectedFiles = [];
+    batchId = null;
     fileList.innerHTML = '';
     processBtn.disabled = true;
     document.getElementById('upload-section').style.display = 'block';
@@ -0,0 +1,138 @@
+"""
+Niveaux de modele : compteurs par niveau, /api/status et escalade petit -> grand
+modele, avec une reponse Claude simulee (requests.post remplace).
+"""
+
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+TICKET = {
+    'exploitable': True, 'raison_non_exploitable': '', 'confidence': 0.95,
+    'ecritures': [
+        {'date': '15/01/2026', 'compte': '62510000', 'libelle': 'Indigo - Parking', 'debit': 10.0, 'credit': 0},
+        {'date': '15/01/2026', 'compte': '44566000', 'libelle': 'Indigo - Parking', 'debit': 2.0, 'credit': 0},
+        {'date': '15/01/2026', 'compte': '51200000', 'libelle': 'Indigo - Parking', 'debit': 0, 'credit': 12.0}
+    ]
+}
+USAGE = {'input_tokens': 1000, 'output_tokens': 200}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, ticket):
+        self.payload = {'content': [{'type': 'tool_use', 'name': 'ecritures', 'input': ticket}], 'usage': USAGE}
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    """app importe dans un repertoire temporaire (logs/, outputs/ hors du depot)"""
+    cwd = os.getcwd()
+    workdir = tmp_path_factory.mktemp('app')
+    os.chdir(workdir)
+    os.environ.update({
+        'ANTHROPIC_API_KEY': 'test', 'OPENAI_API_KEY': '', 'OLLAMA_URLS': 'http://127.0.0.1:9',
+        'EMAIL_ADDRESS': '', 'EMAIL_PASSWORD': '', 'TRAFFIC_CAPTURE': 'false', 'LEDGER_ENABLED': 'false',
+        'MODEL_TIERING': 'true', 'STRUCTURED_OUTPUT': 'true'
+    })
+    sys.path.insert(0, str(ROOT))
+    import app as module
+    module.PROMPT_PATH = ROOT / module.PROMPT_PATH
+    module.boilerplate_lines.path = workdir / module.BOILERPLATE_FILE
+    yield module
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def claude(app, monkeypatch):
+    """Claude simule : confiance par modele, modeles appeles dans l'ordre"""
+    import requests
+    fake = SimpleNamespace(models=[], confidence={})
+
+    def post(url, json=None, **kwargs):
+        fake.models.append(json['model'])
+        return FakeResponse(dict(TICKET, confidence=fake.confidence.get(json['model'], 0.95)))
+
+    monkeypatch.setattr(requests, 'post', post)
+    for st in app.tier_stats.values():
+        st.update(calls=0, latency=0.0, input_tokens=0, output_tokens=0, cost=0.0)
+    app.tier_escalations.update(accepted=0, escalated=0)
+    app.record_provider_health('anthropic', None)
+    return fake
+
+
+def parking_pdf():
+    """Page simple (fournisseur connu, couche texte courte) : eligible au petit modele"""
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=420)
+    for n, text in enumerate(["PARKING INDIGO GARE PART-DIEU", "15/01/2026 08:12 - 11:40",
+                              "TOTAL TTC 12,00 EUR", "DONT TVA 20% 2,00 EUR"]):
+        page.insert_text((20, 40 + 20 * n), text, fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_usage_recorded_per_tier(app, claude):
+    app.call_anthropic("ticket", app.ANTHROPIC_FAST_MODEL)
+    app.call_anthropic("ticket", app.ANTHROPIC_MODEL)
+    app.call_anthropic("ticket", app.ANTHROPIC_MODEL)
+
+    report = app.tier_report()
+    price_in, price_out = app.MODEL_PRICES[app.ANTHROPIC_FAST_MODEL]
+    assert report['fast']['calls'] == 1
+    assert report['fast']['input_tokens'] == 1000 and report['fast']['output_tokens'] == 200
+    assert report['fast']['cost_usd'] == round((1000 * price_in + 200 * price_out) / 1_000_000, 4)
+    assert report['large']['calls'] == 2
+    assert report['large']['avg_latency'] is not None
+
+
+def test_api_status_reports_tiers(app, claude):
+    app.call_anthropic("ticket", app.ANTHROPIC_FAST_MODEL)
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['authenticated'] = True
+
+    response = client.get('/api/status')
+    assert response.status_code == 200
+    tiers = response.get_json()['model_tiers']
+    assert tiers['fast']['calls'] == 1
+    assert tiers['escalations'] == {'accepted': 0, 'escalated': 0}
+
+
+def test_fast_tier_accepted(app, claude):
+    result = app.analyze_ticket_with_retry(parking_pdf(), 'parking.pdf')
+
+    assert result['exploitable'] and result['confidence'] == 0.95
+    assert claude.models == [app.ANTHROPIC_FAST_MODEL]
+    assert app.tier_report()['escalations'] == {'accepted': 1, 'escalated': 0}
+
+
+def test_low_confidence_escalates_to_large_model(app, claude):
+    claude.confidence[app.ANTHROPIC_FAST_MODEL] = 0.3
+
+    result = app.analyze_ticket_with_retry(parking_pdf(), 'parking.pdf')
+
+    assert result['confidence'] == 0.95
+    assert claude.models == [app.ANTHROPIC_FAST_MODEL, app.ANTHROPIC_MODEL]
+    report = app.tier_report()
+    assert report['escalations'] == {'accepted': 0, 'escalated': 1}
+    assert report['fast']['calls'] == 1 and report['large']['calls'] == 1
+
+
+def test_fast_tier_unavailable_without_healthy_provider(app, claude):
+    app.record_provider_health('anthropic', False)
+
+    assert app.try_fast_tier("ticket", 'parking.pdf', app.Deadline()) is None
+    assert claude.models == []
+    assert app.tier_report()['escalations'] == {'accepted': 0, 'escalated': 0}
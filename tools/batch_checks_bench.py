@@ -0,0 +1,165 @@
+"""
+Controles du lot entier : BatchChecks (sommes par ticket faites a l'ajout,
+validate() sur les tickets seulement) contre une boucle de reference qui
+recalcule tout a la fin (scans par ligne, totaux du lot resommes).
+
+Les deux implementations doivent produire les memes anomalies ; le bench
+s'arrete sinon. Le temps de BatchChecks inclut l'ajout des lignes (fait au
+fil du pipeline dans process_tickets, pendant l'attente des providers) et la
+validation, mesuree aussi seule.
+
+Usage :
+    python tools/batch_checks_bench.py [--lines 1000 10000 100000] [--runs 3]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import statistics
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+VENDORS = ['Total Energies', 'Esso', 'Le Bistrot', 'Ibis Lyon', 'Indigo', 'Sanef', 'Carrefour City']
+
+
+def make_batch(lines, seed):
+    """Tickets de 2 a 3 lignes (parfois deux par page), avec quelques anomalies de chaque type"""
+    rng = random.Random(seed)
+    batch = []
+    count = 0
+    while count < lines:
+        ref = f"T{len(batch) + 1}"
+        date = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2026"
+        vendor = rng.choice(VENDORS)
+        ttc = round(rng.uniform(5, 150), 2)
+        kind = rng.random()
+        if kind < 0.3:  # carburant : 80% de la TVA a 20%
+            tva = round(ttc / 6, 2)
+            deductible = round(tva * (1.0 if rng.random() < 0.02 else 0.8), 2)
+            ecritures = [('62520000', round(ttc - deductible, 2), 0), ('44566000', deductible, 0)]
+        elif kind < 0.6:  # repas : pas de TVA deductible
+            ecritures = [('62560000', ttc, 0)]
+            if rng.random() < 0.02:
+                ecritures = [('62560000', round(ttc * 0.9, 2), 0), ('44566000', round(ttc - round(ttc * 0.9, 2), 2), 0)]
+        else:
+            tva = round(ttc / 6, 2)
+            ecritures = [('62780000', round(ttc - tva, 2), 0), ('44566000', tva, 0)]
+        bank = ttc + (1.0 if rng.random() < 0.01 else 0.0)
+        ecritures.append(('51200000', 0, round(bank, 2)))
+        batch.append((ref, [dict(date=date, compte=c, libelle=f"{vendor} - Frais", debit=d, credit=cr)
+                            for c, d, cr in ecritures]))
+        count += len(ecritures)
+        if rng.random() < 0.005:  # meme ticket saisi deux fois
+            batch.append((f"T{len(batch) + 1}", [dict(e) for e in batch[-1][1]]))
+            count += len(ecritures)
+        elif rng.random() < 0.05 and len(batch) > 1:  # deux tickets sur une meme page
+            _, previous = batch.pop(-2)
+            batch[-1] = (batch[-1][0], previous + batch[-1][1])
+    return batch
+
+
+def loop_checks(app, batch):
+    """Reference : controles ticket par ticket, dans le style de validate_and_fix_ecritures"""
+    unbalanced, mismatch, deductibility = [], [], []
+    seen = {}
+    for ref, ecritures in batch:
+        # Decoupage de la page en tickets apres chaque ligne banque
+        tickets = [[]]
+        for e in ecritures:
+            if tickets[-1] and tickets[-1][-1]['compte'].startswith('512') and not e['compte'].startswith('512'):
+                tickets.append([])
+            tickets[-1].append(e)
+        single = len(tickets) == 1 or all(
+            abs(sum(round(e['debit'] * 100) - round(e['credit'] * 100) for e in t)) <= 1 for t in tickets)
+        if not single:
+            tickets = [ecritures]
+        for k, ticket in enumerate(tickets):
+            label = ref if len(tickets) == 1 else f"{ref} (ticket {k + 1})"
+            total_d = sum(round(e['debit'] * 100) for e in ticket)
+            total_c = sum(round(e['credit'] * 100) for e in ticket)
+            if abs(total_d - total_c) > 1:
+                unbalanced.append(label)
+            ttc = sum(round(e['credit'] * 100) for e in ticket if e['compte'].startswith('512'))
+            tva = sum(round(e['debit'] * 100) for e in ticket if e['compte'].startswith('4456'))
+            charges = [e for e in ticket if not e['compte'].startswith(('4456', '512')) and e['debit'] > 0]
+            charge = sum(round(e['debit'] * 100) for e in charges)
+            if ttc > 0 and abs(charge + tva - ttc) > 2:
+                mismatch.append(label)
+            ruled = [e for e in charges if e['compte'] in app.DEDUCTIBILITY_RULES]
+            if single and ruled and len(ruled) == len(charges):
+                expected = 0.0
+                for e in ruled:
+                    share, rate = app.DEDUCTIBILITY_RULES[e['compte']]
+                    rate = rate or 0.0
+                    expected += round(e['debit'] * 100) * share * rate / (1 + (1 - share) * rate)
+                if abs(tva - round(expected)) > app.DEDUCTIBILITY_TOLERANCE * 100:
+                    deductibility.append(label)
+            vendor = re.sub(r'[^a-z]+', ' ', ticket[0]['libelle'].split(' - ')[0].lower()).strip()
+            if single and ttc > 0:
+                seen.setdefault((ticket[0]['date'], ttc, vendor), []).append(label)
+    # Totaux recalcules comme avant (resume du lot, puis controle Excel)
+    all_lines = [e for _, ecritures in batch for e in ecritures]
+    for _ in range(2):
+        totals = (round(sum(e['debit'] for e in all_lines), 2), round(sum(e['credit'] for e in all_lines), 2))
+    duplicates = [labels for labels in seen.values() if len(labels) > 1]
+    return unbalanced, mismatch, deductibility, duplicates, totals
+
+
+def batch_checks(app, batch):
+    checks = app.BatchChecks()
+    for ref, ecritures in batch:
+        checks.add(ref, ecritures)
+    result = checks.validate()
+    return (result['unbalanced'], result['ht_tva_ttc'], result['deductibility'], result['duplicates'],
+            (result['total_debit'], result['total_credit']))
+
+
+def best_of(fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return min(samples), statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Controles du lot : BatchChecks vs boucle de reference")
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    import app
+
+    for lines in args.lines:
+        batch = make_batch(lines, seed=lines)
+        loop_best, loop_median, expected = best_of(lambda: loop_checks(app, batch), args.runs)
+        checks_best, checks_median, got = best_of(lambda: batch_checks(app, batch), args.runs)
+        filled = app.BatchChecks()
+        for ref, ecritures in batch:
+            filled.add(ref, ecritures)
+        validate_best = best_of(filled.validate, args.runs)[0]
+        # Memes anomalies (ordre des doublons indifferent)
+        if (expected[:3] != got[:3] or sorted(map(sorted, expected[3])) != sorted(map(sorted, got[3]))
+                or abs(expected[4][0] - got[4][0]) > 0.01 or abs(expected[4][1] - got[4][1]) > 0.01):
+            sys.exit(f"Resultats differents sur {lines} lignes")
+        print(f"{sum(len(e) for _, e in batch):>7} lignes / {len(batch):>6} pages : "
+              f"boucle {loop_best * 1000:8.1f} ms  BatchChecks {checks_best * 1000:8.1f} ms  "
+              f"(dont validate {validate_best * 1000:6.1f} ms)  x{loop_best / checks_best:4.1f}   "
+              f"(desequilibres {len(got[0])}, HT+TVA {len(got[1])}, deductibilite {len(got[2])}, "
+              f"doublons {len(got[3])})")
+
+    os.chdir(ROOT)
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
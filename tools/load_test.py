@@ -0,0 +1,488 @@
+"""
+Test de charge de bout en bout avec des serveurs locaux a la place de Gmail et des LLM.
+
+Demarre dans le processus :
+  - un faux provider LLM (HTTP : /v1/messages, /v1/models, /api/tags, /api/generate)
+    avec latence et taux d'erreur (429 / 500) reglables ;
+  - un serveur SMTP minimal qui enregistre les reponses envoyees ;
+  - un serveur IMAP minimal (LOGIN, SELECT, UID SEARCH/FETCH/STORE) ;
+  - l'application elle-meme, pointee sur ces serveurs par les variables
+    IMAP_SERVER / SMTP_SERVER / ANTHROPIC_BASE_URL / OLLAMA_URLS.
+
+Deux scenarios, lances en parallele par defaut :
+  - webhook : N requetes POST /api/webhook concurrentes ;
+  - email   : M mails deposes dans la boite IMAP, latence = reception de la reponse SMTP.
+
+Rapporte par scenario : latence p50 / p90 / p99 / max, debit et echecs.
+
+Usage :
+    python tools/load_test.py [--scenario all|webhook|email] [--requests 40] [--concurrency 8]
+                              [--emails 20] [--pages 3] [--llm-ms 300] [--error-rate 0.05]
+"""
+
+import os
+import sys
+import atexit
+import json
+import time
+import logging
+import base64
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+import socketserver
+import urllib.request
+import urllib.error
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+MAILBOX = 'compta@load.test'
+WEBHOOK_TOKEN = 'load-test'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+# ===================================================================
+# FAUX PROVIDER LLM
+# ===================================================================
+
+def fake_ticket():
+    """Reponse conforme a TICKET_SCHEMA : une depense equilibree"""
+    ttc = round(random.uniform(5, 200), 2)
+    ht = round(ttc / 1.2, 2)
+    return {
+        'exploitable': True,
+        'raison_non_exploitable': '',
+        'confidence': 0.95,
+        'ecritures': [
+            {'date': '15/01/2026', 'compte': '62510000', 'libelle': 'Repas', 'debit': ht, 'credit': 0},
+            {'date': '15/01/2026', 'compte': '44566000', 'libelle': 'TVA', 'debit': round(ttc - ht, 2), 'credit': 0},
+            {'date': '15/01/2026', 'compte': '51200000', 'libelle': 'Repas', 'debit': 0, 'credit': ttc}
+        ]
+    }
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.3
+    jitter = 0.3
+    error_rate = 0.0
+    stats = None  # dict partage, protege par stats_lock
+    stats_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in ('/v1/models', '/api/tags'):
+            return self.reply(200, {'data': [], 'models': []})
+        self.reply(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        # Latence log-normale autour de la valeur cible (queue de distribution realiste)
+        time.sleep(self.latency * random.lognormvariate(0, self.jitter) if self.latency else 0)
+        with self.stats_lock:
+            self.stats['calls'] += 1
+        if random.random() < self.error_rate:
+            status = random.choice((429, 500))
+            with self.stats_lock:
+                self.stats[f'http_{status}'] += 1
+            return self.reply(status, {'error': {'message': 'erreur injectee'}})
+
+        ticket = fake_ticket()
+        usage = {'input_tokens': 1200, 'output_tokens': 180}
+        if self.path == '/v1/messages':
+            if payload.get('tools'):
+                content = [{'type': 'tool_use', 'name': 'enregistrer_ecritures', 'input': ticket}]
+            else:
+                content = [{'type': 'text', 'text': json.dumps(ticket)}]
+            return self.reply(200, {'content': content, 'usage': usage})
+        if self.path == '/v1/chat/completions':
+            return self.reply(200, {
+                'choices': [{'message': {'content': json.dumps(ticket)}}],
+                'usage': {'prompt_tokens': 1200, 'completion_tokens': 180}
+            })
+        if self.path == '/api/generate':
+            return self.reply(200, {'response': json.dumps(ticket)})
+        self.reply(404, {'error': {'message': 'not found'}})
+
+
+# ===================================================================
+# SERVEUR SMTP MINIMAL
+# ===================================================================
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    received = None  # liste partagee de (horodatage, destinataire, objet)
+    lock = threading.Lock()
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.send('220 localhost ESMTP load-test')
+        rcpt = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.send('250-localhost')
+                self.send('250-AUTH PLAIN LOGIN')
+                self.send('250 SIZE 52428800')
+            elif verb == 'HELO':
+                self.send('250 localhost')
+            elif verb == 'AUTH':
+                parts = command.split()
+                if parts[1].upper() == 'LOGIN' and len(parts) == 2:
+                    self.send('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self.send('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                elif parts[1].upper() == 'PLAIN' and len(parts) == 2:
+                    self.send('334 ')
+                    self.rfile.readline()
+                self.send('235 2.7.0 Authentication successful')
+            elif verb == 'MAIL':
+                rcpt = []
+                self.send('250 OK')
+            elif verb == 'RCPT':
+                rcpt.append(command.split(':', 1)[1].strip(' <>'))
+                self.send('250 OK')
+            elif verb == 'DATA':
+                self.send('354 End data with <CR><LF>.<CR><LF>')
+                subject = ''
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                    if not subject and data.lower().startswith(b'subject:'):
+                        subject = data.decode(errors='replace').split(':', 1)[1].strip()
+                with self.lock:
+                    for to in rcpt:
+                        self.received.append((time.perf_counter(), to, subject))
+                self.send('250 OK queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.send('250 OK')
+            elif verb == 'QUIT':
+                self.send('221 Bye')
+                return
+            else:
+                self.send('502 Command not implemented')
+
+
+# ===================================================================
+# SERVEUR IMAP MINIMAL
+# ===================================================================
+
+class Mailbox:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []  # dicts {uid, data, seen}
+
+    def add(self, data):
+        with self.lock:
+            uid = len(self.messages) + 1
+            self.messages.append({'uid': uid, 'data': data, 'seen': False})
+            return uid
+
+    def find(self, uid):
+        for seq, msg in enumerate(self.messages, 1):
+            if msg['uid'] == uid:
+                return seq, msg
+        return None, None
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    mailbox = None
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.send('* OK [CAPABILITY IMAP4rev1] load-test ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode(errors='replace').strip().split()
+            if len(parts) < 2:
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2:]
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1 AUTH=PLAIN')
+            elif command == 'SELECT':
+                with self.mailbox.lock:
+                    self.send(f'* {len(self.mailbox.messages)} EXISTS')
+                self.send('* 0 RECENT')
+                self.send('* FLAGS (\\Seen)')
+                self.send(f'{tag} OK [READ-WRITE] SELECT completed')
+                continue
+            elif command == 'UID':
+                self.uid_command(args)
+            elif command == 'LOGOUT':
+                self.send('* BYE logging out')
+                self.send(f'{tag} OK LOGOUT completed')
+                return
+            elif command not in ('LOGIN', 'NOOP'):
+                self.send(f'{tag} BAD unknown command')
+                continue
+            self.send(f'{tag} OK {command} completed')
+
+    def uid_command(self, args):
+        sub = args[0].upper()
+        with self.mailbox.lock:
+            if sub == 'SEARCH':
+                uids = [str(m['uid']) for m in self.mailbox.messages if not m['seen']]
+                self.send('* SEARCH ' + ' '.join(uids) if uids else '* SEARCH')
+            elif sub == 'FETCH':
+                seq, msg = self.mailbox.find(int(args[1]))
+                if msg is not None:
+                    self.wfile.write(f'* {seq} FETCH (UID {msg["uid"]} BODY[] {{{len(msg["data"])}}}\r\n'.encode())
+                    self.wfile.write(msg['data'] + b')\r\n')
+            elif sub == 'STORE':
+                seq, msg = self.mailbox.find(int(args[1]))
+                if msg is not None:
+                    msg['seen'] = True
+                    self.send(f'* {seq} FETCH (UID {msg["uid"]} FLAGS (\\Seen))')
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ===================================================================
+# DONNEES DE TEST
+# ===================================================================
+
+def make_pdf(pages, seed):
+    """PDF texte de plusieurs tickets, contenu unique (pas de dedoublonnage)"""
+    import fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=300, height=400)
+        page.insert_text((30, 60), f"RESTAURANT LE COMPTOIR - TICKET {seed}-{i}", fontsize=9)
+        page.insert_text((30, 80), f"15/01/2026  TABLE {random.randint(1, 40)}", fontsize=9)
+        # Nombre et largeur des lignes variables : pas de doublon au hash perceptuel
+        y = 100
+        for _ in range(random.randint(1, 8)):
+            page.insert_text((30 + random.randint(0, 60), y), "ARTICLE " + "X" * random.randint(2, 20)
+                             + f"  {random.uniform(1, 30):.2f}", fontsize=9)
+            y += 16
+        page.insert_text((30, y + 10), f"TOTAL TTC {random.uniform(5, 200):.2f} EUR  TVA 10%", fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def make_email(seed, pages):
+    msg = MIMEMultipart()
+    msg['From'] = f'client{seed}@load.test'
+    msg['To'] = MAILBOX
+    msg['Subject'] = f'Tickets lot {seed}'
+    msg.attach(MIMEText('Ci-joint mes tickets', 'plain'))
+    part = MIMEBase('application', 'pdf')
+    part.set_payload(make_pdf(pages, f'mail{seed}'))
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', f'attachment; filename="tickets_{seed}.pdf"')
+    msg.attach(part)
+    return msg.as_bytes()
+
+
+# ===================================================================
+# SCENARIOS
+# ===================================================================
+
+def run_webhook(base_url, args):
+    """N requetes webhook concurrentes, latence cote client"""
+    from concurrent.futures import ThreadPoolExecutor
+    bodies = [json.dumps({
+        'files': [{'name': f'lot_{i}.pdf', 'data': base64.b64encode(make_pdf(args.pages, f'wh{i}')).decode()}],
+        'source': 'loadtest'
+    }).encode() for i in range(args.requests)]
+
+    def one(body):
+        request = urllib.request.Request(
+            f'{base_url}/api/webhook', data=body, method='POST',
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {WEBHOOK_TOKEN}'}
+        )
+        start = time.perf_counter()
+        ok = False
+        try:
+            # 202 : lot encore en cours, le meme envoi recupere le resultat
+            while time.perf_counter() - start < args.timeout:
+                with urllib.request.urlopen(request, timeout=args.timeout) as r:
+                    if r.status != 202:
+                        ok = r.status == 200 and 'summary' in json.loads(r.read())
+                        break
+                time.sleep(min(float(r.headers.get('Retry-After', 1)), 1))
+        except (urllib.error.URLError, OSError, ValueError):
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, bodies))
+    return results, time.perf_counter() - start
+
+
+def run_email(app_module, mailbox, smtp_received, args):
+    """M mails deposes d'un coup, releve IMAP en boucle jusqu'a toutes les reponses"""
+    messages = [make_email(i, args.pages) for i in range(args.emails)]
+    sent_at = {}
+    start = time.perf_counter()
+    for i, data in enumerate(messages):
+        mailbox.add(data)
+        sent_at[f'client{i}@load.test'] = time.perf_counter()
+
+    deadline = start + args.timeout
+    while time.perf_counter() < deadline:
+        try:
+            app_module.check_emails_once()
+        except Exception as e:
+            print(f"  [email] releve en echec : {e}")
+        with SMTPHandler.lock:
+            if len({to for _, to, _ in smtp_received}) >= args.emails:
+                break
+        time.sleep(args.poll_interval)
+    # Dernier passage : marque \Seen les mails repondus
+    try:
+        app_module.check_emails_once()
+    except Exception:
+        pass
+
+    replied = {}
+    with SMTPHandler.lock:
+        for at, to, _ in smtp_received:
+            replied.setdefault(to, at)
+    results = [(to in replied, (replied.get(to, time.perf_counter())) - t0) for to, t0 in sent_at.items()]
+    return results, time.perf_counter() - start
+
+
+def report(name, results, wall, pages):
+    latencies = [lat for ok, lat in results if ok]
+    failures = len(results) - len(latencies)
+    print(f"\n{name} : {len(results)} lots x {pages} pages en {wall:.1f}s")
+    if latencies:
+        print(f"  latence  p50 {percentile(latencies, 50):6.2f}s  p90 {percentile(latencies, 90):6.2f}s  "
+              f"p99 {percentile(latencies, 99):6.2f}s  max {max(latencies):6.2f}s  "
+              f"(moyenne {statistics.mean(latencies):.2f}s)")
+    print(f"  debit    {len(latencies) / wall:.2f} lots/s  {len(latencies) * pages / wall:.2f} pages/s")
+    print(f"  echecs   {failures} ({failures / len(results):.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge webhook + email avec serveurs simules")
+    parser.add_argument('--scenario', choices=('all', 'webhook', 'email'), default='all')
+    parser.add_argument('--requests', type=int, default=40, help="requetes webhook")
+    parser.add_argument('--concurrency', type=int, default=8, help="clients webhook simultanes")
+    parser.add_argument('--emails', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=3, help="pages par lot")
+    parser.add_argument('--llm-ms', type=float, default=300, help="latence mediane du faux LLM")
+    parser.add_argument('--llm-jitter', type=float, default=0.3, help="sigma log-normal de la latence")
+    parser.add_argument('--error-rate', type=float, default=0.05, help="part de reponses 429/500")
+    parser.add_argument('--provider-slots', type=int, default=None, help="surcharge PROVIDER_SLOTS")
+    parser.add_argument('--poll-interval', type=float, default=0.5, help="releve IMAP (s)")
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    FakeLLMHandler.latency = args.llm_ms / 1000
+    FakeLLMHandler.jitter = args.llm_jitter
+    FakeLLMHandler.error_rate = args.error_rate
+    FakeLLMHandler.stats = {'calls': 0, 'http_429': 0, 'http_500': 0}
+    llm_port, smtp_port, imap_port, app_port = free_port(), free_port(), free_port(), free_port()
+    serve(ThreadingHTTPServer(('127.0.0.1', llm_port), FakeLLMHandler))
+    smtp_received = []
+    SMTPHandler.received = smtp_received
+    serve(ThreadingTCPServer(('127.0.0.1', smtp_port), SMTPHandler))
+    mailbox = Mailbox()
+    IMAPHandler.mailbox = mailbox
+    serve(ThreadingTCPServer(('127.0.0.1', imap_port), IMAPHandler))
+
+    llm_url = f'http://127.0.0.1:{llm_port}'
+    os.environ.update({
+        'ANTHROPIC_API_KEY': 'load-test', 'ANTHROPIC_BASE_URL': llm_url,
+        'OPENAI_API_KEY': '', 'OLLAMA_URLS': llm_url,
+        'EMAIL_ADDRESS': MAILBOX, 'EMAIL_PASSWORD': 'load-test',
+        'IMAP_SERVER': '127.0.0.1', 'IMAP_PORT': str(imap_port), 'IMAP_SSL': 'false',
+        'SMTP_SERVER': '127.0.0.1', 'SMTP_PORT': str(smtp_port), 'SMTP_SECURITY': 'none',
+        'WEBHOOK_TOKEN': WEBHOOK_TOKEN, 'PYTHONWARNINGS': 'ignore'
+    })
+    if args.provider_slots:
+        os.environ['PROVIDER_SLOTS'] = str(args.provider_slots)
+
+    # Repertoire temporaire : logs/, outputs/, journal/ du test hors du depot
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    sys.path.insert(0, str(ROOT))
+    import app
+    from werkzeug.serving import make_server
+    app.PROMPT_PATH = ROOT / app.PROMPT_PATH
+    app.boilerplate_lines.path = Path(workdir.name) / app.BOILERPLATE_FILE
+    app.RATE_LIMIT_429_WAIT = 1  # pas d'attente de 30s sur les 429 simules
+    app.RETRY_BASE_DELAY = 0.2
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    serve(make_server('127.0.0.1', app_port, app.app, threaded=True))
+
+    print(f"Faux LLM {args.llm_ms:.0f} ms (sigma {args.llm_jitter}), erreurs {args.error_rate:.0%}, "
+          f"{app.PROVIDER_SLOTS} creneau(x) provider")
+    runs = {}
+    threads = []
+    if args.scenario in ('all', 'webhook'):
+        threads.append(threading.Thread(target=lambda: runs.__setitem__(
+            'webhook', run_webhook(f'http://127.0.0.1:{app_port}', args))))
+    if args.scenario in ('all', 'email'):
+        threads.append(threading.Thread(target=lambda: runs.__setitem__(
+            'email', run_email(app, mailbox, smtp_received, args))))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for name in ('webhook', 'email'):
+        if name in runs:
+            report(name, *runs[name], args.pages)
+    stats = FakeLLMHandler.stats
+    print(f"\nFaux LLM : {stats['calls']} appels, {stats['http_429']} x 429, {stats['http_500']} x 500")
+    os.chdir(ROOT)
+    # Le listener de logs asynchrone ecrit encore dans workdir jusqu'a l'arret
+    if getattr(app, 'log_listener', None):
+        app.log_listener.stop()
+        atexit.unregister(app.log_listener.stop)
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Latence des traitements avec et sans le pipeline de logs asynchrone.
+
+Lance process_tickets (providers simules) dans deux processus, LOG_ASYNC=false
+puis LOG_ASYNC=true, et compare la latence par requete. --emit-delay-ms simule
+un disque lent (ou un volume reseau) en retardant chaque ecriture de log.
+
+Usage :
+    python tools/log_bench.py [--requests 20] [--pages 10] [--emit-delay-ms 2]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHILD = r'''
+import sys, time, json, statistics
+sys.path.insert(0, {root!r})
+import app
+import fitz
+
+app.RATE_LIMIT_DELAY = 0
+app.PREFLIGHT = False
+app.MODEL_TIERING = False
+app.ANTHROPIC_API_KEY = 'bench'
+app.OPENAI_API_KEY = ''
+app.RETRY_BASE_DELAY = 0
+
+emit = app.handler.emit
+def slow_emit(record):
+    time.sleep({emit_delay} / 1000)
+    emit(record)
+app.handler.emit = slow_emit
+
+calls = [0]
+def provider(content, model=None, timeout=120):
+    calls[0] += 1
+    time.sleep({provider_ms} / 1000)
+    if calls[0] % 2:
+        return "reponse non JSON"  # un retry sur deux : volume de logs realiste
+    return {{'exploitable': True, 'confidence': 0.9, 'raison_non_exploitable': '', 'ecritures': [
+        {{'date': '01/01/2026', 'compte': '62510000', 'libelle': 'Repas', 'debit': 10, 'credit': 0}},
+        {{'date': '01/01/2026', 'compte': '51200000', 'libelle': 'Repas', 'debit': 0, 'credit': 10}}]}}
+app.call_anthropic = provider
+
+def batch(n, seed):
+    doc = fitz.open()
+    for i in range(n):
+        page = doc.new_page(width=300, height=400)
+        page.insert_text((30, 60), f"TICKET {{seed}}-{{i}} RESTAURANT TOTAL TTC {{10 + i}},00 EUR " + "x" * 40)
+    data = doc.tobytes()
+    doc.close()
+    return [{{'filename': f'bench_{{seed}}.pdf', 'bytes': data}}]
+
+latencies = []
+for r in range({requests}):
+    files = batch({pages}, r)
+    start = time.perf_counter()
+    app.process_tickets(files)
+    latencies.append(time.perf_counter() - start)
+latencies.sort()
+print(json.dumps({{
+    'p50': statistics.median(latencies),
+    'p95': latencies[int(0.95 * (len(latencies) - 1))],
+    'mean': statistics.mean(latencies)
+}}))
+'''
+
+
+def run(mode_async, args, workdir):
+    env = dict(os.environ, LOG_ASYNC='true' if mode_async else 'false', PYTHONWARNINGS='ignore',
+               EMAIL_ADDRESS='', EMAIL_PASSWORD='')
+    code = CHILD.format(root=str(ROOT), emit_delay=args.emit_delay_ms, provider_ms=args.provider_ms,
+                        requests=args.requests, pages=args.pages)
+    out = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latence avec / sans logs asynchrones")
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--provider-ms', type=float, default=5)
+    parser.add_argument('--emit-delay-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requetes x {args.pages} pages, provider {args.provider_ms} ms, "
+          f"ecriture de log +{args.emit_delay_ms} ms")
+    # Repertoire temporaire : logs/, outputs/ et journal/ du bench hors du depot
+    with tempfile.TemporaryDirectory() as workdir:
+        for label, mode_async in (('synchrone ', False), ('asynchrone', True)):
+            res = run(mode_async, args, workdir)
+            print(f"  {label} : p50 {res['p50'] * 1000:7.1f} ms  p95 {res['p95'] * 1000:7.1f} ms  "
+                  f"moyenne {res['mean'] * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Verification du pool Ollama contre des serveurs simules.
+
+Demarre deux faux serveurs Ollama (/api/generate, /api/tags) et reserve un
+port sans serveur (endpoint mort), puis verifie :
+  - warmup : prompt vide + keep_alive sur chaque serveur, endpoint mort en quarantaine ;
+  - sonde /api/tags : Ollama disponible tant qu'un serveur repond ;
+  - repartition au moins charge (least outstanding) des appels concurrents ;
+  - keep_alive present dans chaque requete /api/generate ;
+  - endpoint mort evite pendant la quarantaine, retente a son expiration
+    puis remis en quarantaine plus longue.
+
+Sort avec un code non nul a la premiere verification en echec.
+
+Usage :
+    python tools/ollama_pool_check.py [--calls 8] [--latency-ms 400]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+TICKET = {'exploitable': False, 'raison_non_exploitable': 'stub', 'confidence': 1.0, 'ecritures': []}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    latency = 0.4
+    requests = None  # liste partagee par serveur (voir make_stub)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.lock:
+            self.requests.append(('GET', self.path, None))
+        self.reply({'models': [{'name': 'stub'}]})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.lock:
+            self.requests.append(('POST', self.path, payload))
+        if payload.get('prompt'):
+            time.sleep(self.latency)
+        self.reply({'model': payload.get('model'), 'response': json.dumps(TICKET), 'done': True})
+
+
+def make_stub():
+    """Serveur Ollama simule : (url, requetes recues)"""
+    received = []
+    handler = type('StubHandler', (StubOllamaHandler,), {'requests': received})
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}', received
+
+
+failures = []
+
+
+def check(label, condition, detail=''):
+    print(f"  [{'OK' if condition else 'ECHEC'}] {label}{' : ' + detail if detail else ''}")
+    if not condition:
+        failures.append(label)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verification du pool Ollama contre des serveurs simules")
+    parser.add_argument('--calls', type=int, default=8, help="appels concurrents (pair)")
+    parser.add_argument('--latency-ms', type=float, default=400)
+    args = parser.parse_args()
+
+    StubOllamaHandler.latency = args.latency_ms / 1000
+    (url_a, received_a), (url_b, received_b) = make_stub(), make_stub()
+    dead = f'http://127.0.0.1:{free_port()}'
+    os.environ.update({
+        'ANTHROPIC_API_KEY': '', 'OPENAI_API_KEY': '', 'OLLAMA_URLS': ','.join([url_a, url_b, dead]),
+        'OLLAMA_KEEP_ALIVE': '17m', 'PYTHONWARNINGS': 'ignore'
+    })
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    sys.path.insert(0, str(ROOT))
+    import app
+    app.PROMPT_PATH = ROOT / app.PROMPT_PATH
+    app.HEALTH_CHECK_TIMEOUT = 2
+
+    print("Warmup :")
+    warmed = {url: app.warm_ollama_endpoint(url) for url in app.OLLAMA_URLS}
+    check("serveurs vivants prechauffes", warmed[url_a] and warmed[url_b])
+    check("endpoint mort en echec", warmed[dead] is False)
+    for url, received in ((url_a, received_a), (url_b, received_b)):
+        warm = [p for method, path, p in received if path == '/api/generate']
+        check(f"prechauffage {url}", len(warm) == 1 and warm[0]['prompt'] == ''
+              and warm[0]['keep_alive'] == '17m', str(warm))
+    check("endpoint mort en quarantaine", app.ollama_pool[dead]['down_until'] > time.time())
+
+    print("Sonde /api/tags :")
+    app.probe_providers()
+    check("tags interroges", any(path == '/api/tags' for _, path, _ in received_a)
+          and any(path == '/api/tags' for _, path, _ in received_b))
+    check("Ollama disponible", app.provider_available('ollama'))
+
+    print(f"Repartition ({args.calls} appels concurrents) :")
+    for received in (received_a, received_b):
+        received.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(app.call_ollama('TOTAL TTC 12,50')))
+               for _ in range(args.calls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    calls_a = [p for _, path, p in received_a if path == '/api/generate']
+    calls_b = [p for _, path, p in received_b if path == '/api/generate']
+    check("tous les appels aboutis", len(results) == args.calls)
+    check("repartition au moins charge", abs(len(calls_a) - len(calls_b)) <= 1,
+          f"{len(calls_a)} / {len(calls_b)}")
+    check("endpoint mort evite", len(calls_a) + len(calls_b) == args.calls)
+    check("keep_alive dans chaque requete", all(p.get('keep_alive') == '17m' for p in calls_a + calls_b))
+    check("compteurs liberes", all(st['outstanding'] == 0 for st in app.ollama_pool.values()))
+
+    print("Quarantaine :")
+    failures_before = app.ollama_pool[dead]['failures']
+    app.ollama_pool[dead]['down_until'] = 0.0  # fin de quarantaine
+    try:
+        app.call_ollama('TOTAL TTC 12,50')
+        retried = False
+    except Exception as e:
+        retried = 'non accessible' in str(e)
+    st = app.ollama_pool[dead]
+    check("endpoint retente a l'expiration", retried)
+    check("quarantaine prolongee", st['failures'] == failures_before + 1
+          and st['down_until'] - time.time() > app.OLLAMA_FAILURE_COOLDOWN * failures_before,
+          f"{st['failures']} echec(s), {st['down_until'] - time.time():.0f}s")
+    status = app.ollama_pool_status()
+    check("etat /api/status", status[dead]['healthy'] is False and status[url_a]['healthy'])
+
+    os.chdir(ROOT)
+    workdir.cleanup()
+    if failures:
+        sys.exit(f"{len(failures)} verification(s) en echec")
+    print("Pool Ollama conforme")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Rapport de precision du controle qualite (preflight) sur un jeu etiquete.
+
+Arborescence attendue :
+    <dossier>/ok/*.pdf   justificatifs exploitables (ne doivent pas etre rejetes)
+    <dossier>/ko/*.pdf   pages blanches / illisibles (doivent etre rejetees)
+
+Usage :
+    python tools/preflight_report.py samples/ [--min-ink 0.002] [--min-contrast 12]
+                                              [--min-sharpness 0.08] [--min-side 60]
+                                              [--strict]
+
+Sans --strict, seules les pages trop petites ou blanches sont rejetees (comme
+en production par defaut) ; --strict evalue aussi les seuils contraste / nettete.
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def main():
+    # Dossiers de travail crees par app (outputs/, journal/, logs/) hors du depot
+    cwd = Path.cwd()
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    try:
+        report(cwd)
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+
+
+def report(cwd):
+    import app
+    parser = argparse.ArgumentParser(description="Precision du preflight sur un jeu etiquete")
+    parser.add_argument('samples', type=Path)
+    parser.add_argument('--min-ink', type=float, default=app.PREFLIGHT_MIN_INK)
+    parser.add_argument('--min-contrast', type=float, default=app.PREFLIGHT_MIN_CONTRAST)
+    parser.add_argument('--min-sharpness', type=float, default=app.PREFLIGHT_MIN_SHARPNESS)
+    parser.add_argument('--min-side', type=float, default=app.PREFLIGHT_MIN_SIDE_PT)
+    parser.add_argument('--strict', action='store_true', default=app.PREFLIGHT_STRICT,
+                        help="rejeter aussi sur contraste / nettete")
+    args = parser.parse_args()
+
+    app.PREFLIGHT_MIN_INK = args.min_ink
+    app.PREFLIGHT_MIN_CONTRAST = args.min_contrast
+    app.PREFLIGHT_MIN_SHARPNESS = args.min_sharpness
+    app.PREFLIGHT_MIN_SIDE_PT = args.min_side
+    app.PREFLIGHT_STRICT = args.strict
+
+    samples = cwd / args.samples
+    counts = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+    errors = []
+    for label in ('ok', 'ko'):
+        for path in sorted((samples / label).glob('*.pdf')):
+            raison, signals = app.preflight_check(path.read_bytes())
+            rejected = raison is not None
+            if label == 'ko':
+                counts['tp' if rejected else 'fn'] += 1
+            else:
+                counts['fp' if rejected else 'tn'] += 1
+            if rejected != (label == 'ko'):
+                errors.append((label, path.name, raison, signals))
+
+    tp, fp, fn, tn = counts['tp'], counts['fp'], counts['fn'], counts['tn']
+    print(f"Seuils : ink={args.min_ink} contrast={args.min_contrast} "
+          f"sharpness={args.min_sharpness} side={args.min_side} strict={args.strict}")
+    print(f"Rejets corrects (TP) : {tp}   Rejets a tort (FP) : {fp}")
+    print(f"Rates (FN)           : {fn}   Acceptes (TN)      : {tn}")
+    print(f"Precision : {tp / (tp + fp):.1%}" if tp + fp else "Precision : n/a (aucun rejet)")
+    print(f"Rappel    : {tp / (tp + fn):.1%}" if tp + fn else "Rappel    : n/a (aucun exemple ko)")
+
+    if errors:
+        print("\nErreurs :")
+        for label, name, raison, signals in errors:
+            print(f"  [{label}] {name} -> {raison or 'accepte'}")
+            for sig in signals:
+                print(f"      {sig}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Rejeu d'une capture de trafic (TRAFFIC_CAPTURE=true) pour la planification de capacite.
+
+Chaque page capturee est reconstruite sans son contenu : PDF de meme nombre
+de pages et de taille comparable, avec ou sans couche texte, identique quand
+l'empreinte l'etait (doublons et reutilisations rejoues), page blanche si le
+preflight l'avait rejetee. Les lots arrivent au meme rythme qu'en production
+et process_tickets est appele avec leur classe et leur source. Les providers
+sont remplaces par des stubs qui rejouent, page par page, la sequence de
+tentatives enregistree : latence, 200 / 429 / 5xx / timeout / JSON invalide.
+
+--speed accelere tout le scenario (arrivees, latences, attentes de retry,
+budgets de lot) : 5 = cinq fois plus vite. Le temps local de chaque lot
+(mesure a part, providers instantanes) n'est pas accelere : il est retire
+avant de ramener la duree rejouee au temps reel. --provider-slots et --latency-scale
+simulent un nouveau reglage de concurrence ou un provider plus rapide / lent.
+
+Usage :
+    python tools/replay.py captures/capture_*.jsonl [--speed 1 5 10]
+                           [--provider-slots 4] [--latency-scale 0.5] [--limit 50]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter, deque
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Parametres de temps de app.py mis a l'echelle de --speed
+SCALED = ('RATE_LIMIT_DELAY', 'RATE_LIMIT_429_WAIT', 'RETRY_BASE_DELAY', 'MIN_ATTEMPT_SECONDS')
+
+
+def load_capture(paths, limit):
+    """Lots dans l'ordre d'arrivee : (batch_start, job_class, source, unites triees)"""
+    batches = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    page = json.loads(line)
+                    batches.setdefault(page['batch'], []).append(page)
+    ordered = sorted(batches.values(), key=lambda pages: pages[0]['batch_start'])
+    if limit:
+        ordered = ordered[:limit]
+    return [
+        {
+            'start': pages[0]['batch_start'], 'job_class': pages[0]['job_class'], 'source': pages[0]['source'],
+            'units': sorted(pages, key=lambda p: p['unit']),
+            'recorded': max(p['ts'] + p['seconds'] for p in pages) - pages[0]['batch_start']
+        }
+        for pages in ordered
+    ]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class PageFactory:
+    """PDF de substitution par empreinte : meme empreinte -> memes octets"""
+
+    def __init__(self):
+        self.cache = {}
+
+    def build(self, unit):
+        # Cle sur l'empreinte seule : un doublon (enregistre sans tentative) doit
+        # reprendre les octets de la premiere occurrence, sinon il est re-analyse
+        if unit['hash'] not in self.cache:
+            fast = any(a['tier'] == 'fast' for a in unit['attempts'])
+            self.cache[unit['hash']] = self._render(unit, fast)
+        return self.cache[unit['hash']]
+
+    def _render(self, unit, fast):
+        import fitz
+        rng = random.Random(unit['hash'])
+        doc = fitz.open()
+        for n in range(max(1, unit.get('pages') or 1)):
+            page = doc.new_page(width=300, height=420)
+            if unit.get('preflight'):
+                continue  # page blanche : rejetee par le preflight comme a l'origine
+            scan = n == 0 and unit.get('has_text') is False
+            # Scan : texte dessine sur une page brouillon puis insere comme image
+            draft = fitz.open() if scan else None
+            target = draft.new_page(width=300, height=420) if scan else page
+            # Fournisseur connu seulement si la page etait passee par le petit modele
+            lines = [f"{'PARKING ' if fast else ''}REJEU {unit['hash']} PAGE {n + 1}",
+                     f"{rng.randint(1, 28):02d}/01/2026"]
+            lines += ["ARTICLE " + "X" * rng.randint(2, 18) + f"  {rng.uniform(1, 40):.2f}"
+                      for _ in range(rng.randint(2, 9))]
+            lines.append(f"TOTAL TTC {rng.uniform(5, 300):.2f} EUR  TVA 20%")
+            y = 40 + rng.randint(0, 40)
+            for text in lines:
+                target.insert_text((20 + rng.randint(0, 30), y), text, fontsize=11)
+                y += 20
+            if scan:
+                page.insert_image(page.rect, stream=target.get_pixmap(dpi=150).tobytes('jpeg', jpg_quality=70))
+                draft.close()
+        # Taille comparable a l'original (piece jointe non compressible)
+        padding = min(unit.get('bytes', 0), 4 * 1024 * 1024) - len(doc.tobytes())
+        if padding > 0:
+            doc.embfile_add('padding.bin', rng.randbytes(padding))
+        data = doc.tobytes()
+        doc.close()
+        return data
+
+
+class StubProviders:
+    """Rejoue la sequence de tentatives de chaque page (cle : nom du fichier en cours)"""
+
+    def __init__(self, app, speed, latency_scale):
+        self.app = app
+        self.speed = speed
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.sequences = {}
+        self.statuses = Counter()
+        self.default_latency = 1.0
+
+    def load(self, filename, attempts):
+        self.sequences[filename] = deque(attempts)
+
+    def next_attempt(self):
+        filename = getattr(self.app.log_context, 'page', None)
+        with self.lock:
+            sequence = self.sequences.get(filename)
+            attempt = sequence.popleft() if sequence else {'latency': self.default_latency, 'status': 'ok'}
+            self.statuses[attempt['status']] += 1
+        return attempt
+
+    def call(self, name):
+        def provider(content, *args, **kwargs):
+            import requests
+            attempt = self.next_attempt()
+            time.sleep(attempt['latency'] * self.latency_scale / self.speed)
+            status = attempt['status']
+            if status in ('ok', 'escalated'):
+                return {
+                    'exploitable': True, 'raison_non_exploitable': '',
+                    'confidence': 0.95 if status == 'ok' else 0.3,
+                    'ecritures': [
+                        {'date': '15/01/2026', 'compte': '62510000', 'libelle': 'Rejeu', 'debit': 10.0, 'credit': 0},
+                        {'date': '15/01/2026', 'compte': '44566000', 'libelle': 'Rejeu', 'debit': 2.0, 'credit': 0},
+                        {'date': '15/01/2026', 'compte': '51200000', 'libelle': 'Rejeu', 'debit': 0, 'credit': 12.0}
+                    ]
+                }
+            if status == 'json':
+                return "reponse non JSON"
+            if status == 'invalid':
+                return {'exploitable': True}
+            if status == 'timeout':
+                raise requests.exceptions.Timeout(f"{name}: timeout rejoue")
+            if status == 'connection':
+                raise requests.exceptions.ConnectionError(f"{name}: connexion rejouee")
+            if status.isdigit():
+                raise Exception(f"{name} HTTP {status}")
+            raise Exception(f"{name}: erreur rejouee")
+        return provider
+
+
+def run(app, batches, speed, args, sequential=False):
+    factory = PageFactory()
+    stubs = StubProviders(app, speed, args.latency_scale)
+    ok_latencies = [a['latency'] for b in batches for u in b['units'] for a in u['attempts'] if a['status'] == 'ok']
+    if ok_latencies:
+        stubs.default_latency = statistics.median(ok_latencies)
+    app.call_anthropic = stubs.call('Anthropic')
+    app.call_openai = stubs.call('OpenAI')
+    app.call_ollama = stubs.call('Ollama')
+
+    providers = {a['provider'] for b in batches for u in b['units'] for a in u['attempts']}
+    app.ANTHROPIC_API_KEY = 'replay' if 'anthropic' in providers else ''
+    app.OPENAI_API_KEY = 'replay' if 'openai' in providers else ''
+    for name in app.provider_health:
+        app.record_provider_health(name, None)
+    app.duplicate_history = app.PageHashIndex(max_age=app.DUPLICATE_HISTORY_MINUTES * 60)
+    app.job_scheduler = app.JobScheduler(args.provider_slots or app.PROVIDER_SLOTS, app.SCHEDULER_SOURCE_WEIGHTS)
+
+    jobs = []
+    for b, batch in enumerate(batches):
+        files = []
+        for unit in batch['units']:
+            filename = f"r{b}_{unit['unit']}.pdf"
+            stubs.load(filename, unit['attempts'])
+            files.append({'filename': filename, 'bytes': factory.build(unit)})
+        jobs.append((batch, files))
+
+    results = []
+    lock = threading.Lock()
+
+    def submit(batch, files):
+        start = time.perf_counter()
+        try:
+            summary = app.process_tickets(
+                files, job_class=batch['job_class'], source=batch['source'],
+                budget_seconds=app.BATCH_BUDGET_SECONDS.get(batch['job_class'], 0) / speed or None
+            )['summary']
+            outcome = (True, summary['budget']['expired_pages'])
+        except Exception as e:
+            print(f"  lot en echec : {e}")
+            outcome = (False, 0)
+        with lock:
+            results.append((time.perf_counter() - start, batch, *outcome))
+
+    origin = batches[0]['start']
+    t0 = time.perf_counter()
+    threads = []
+    for batch, files in jobs:
+        delay = (batch['start'] - origin) / speed - (time.perf_counter() - t0)
+        if delay > 0:
+            time.sleep(delay)
+        if sequential:
+            submit(batch, files)
+            continue
+        thread = threading.Thread(target=submit, args=(batch, files))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - t0
+    return results, wall, stubs.statuses, app.job_scheduler.report()
+
+
+def measure_local(app, batches, args):
+    """Temps local par lot (tampon, fusion PDF, Excel), non accelere par --speed :
+    lots traites un a un, providers instantanes, sans attente de retry"""
+    for name in SCALED:
+        setattr(app, name, 0)
+    results = run(app, batches, float('inf'), args, sequential=True)[0]
+    return {id(batch): lat for lat, batch, _, _ in results}
+
+
+def report(speed, batches, results, wall, statuses, scheduler, local):
+    pages = sum(len(b['units']) for b in batches)
+    replayed = [lat for lat, _, ok, _ in results if ok]
+    overhead = [local.get(id(batch), 0.0) for _, batch, ok, _ in results if ok]
+    # Seule la part hors temps local est ramenee au temps reel
+    latencies = [max(0.0, lat - own) * speed + own for lat, own in zip(replayed, overhead)]
+    recorded = [b['recorded'] for b in batches]
+    failures = sum(1 for r in results if not r[2])
+    expired = sum(r[3] for r in results)
+    print(f"\nx{speed:g} : {len(batches)} lots / {pages} pages rejoues en {wall:.1f}s "
+          f"({pages / wall:.2f} pages/s)")
+    if latencies:
+        print(f"  duree par lot rejouee                  : p50 {percentile(replayed, 50):7.1f}s  "
+              f"p90 {percentile(replayed, 90):7.1f}s  p99 {percentile(replayed, 99):7.1f}s  "
+              f"max {max(replayed):7.1f}s")
+        print(f"  temps local par lot (non accelere)     : p50 {percentile(overhead, 50):7.1f}s  "
+              f"p90 {percentile(overhead, 90):7.1f}s  p99 {percentile(overhead, 99):7.1f}s  "
+              f"max {max(overhead):7.1f}s")
+        print(f"  duree par lot (ramenee au temps reel)  : p50 {percentile(latencies, 50):7.1f}s  "
+              f"p90 {percentile(latencies, 90):7.1f}s  p99 {percentile(latencies, 99):7.1f}s  "
+              f"max {max(latencies):7.1f}s")
+    print(f"  duree par lot enregistree              : p50 {percentile(recorded, 50):7.1f}s  "
+          f"p90 {percentile(recorded, 90):7.1f}s  p99 {percentile(recorded, 99):7.1f}s  "
+          f"max {max(recorded):7.1f}s")
+    print("  appels providers : " + ', '.join(f"{k} {v}" for k, v in sorted(statuses.items())))
+    print(f"  lots en echec {failures}, pages hors delai {expired}")
+    for cls, st in scheduler['classes'].items():
+        if st['granted']:
+            print(f"  ordonnanceur {cls:<11} : {st['granted']} creneaux, attente moy {st['avg_wait'] * speed:.1f}s "
+                  f"max {st['max_wait'] * speed:.1f}s, file max {st['max_queued']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rejeu d'une capture de trafic")
+    parser.add_argument('captures', nargs='+', type=Path)
+    parser.add_argument('--speed', type=float, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--provider-slots', type=int, default=None, help="surcharge PROVIDER_SLOTS")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplie les latences enregistrees")
+    parser.add_argument('--limit', type=int, default=0, help="nombre maximal de lots")
+    args = parser.parse_args()
+
+    batches = load_capture([p.resolve() for p in args.captures], args.limit)
+    if not batches:
+        sys.exit("Capture vide")
+    calls = Counter(a['status'] for b in batches for u in b['units'] for a in u['attempts'])
+    print(f"Capture : {len(batches)} lots, {sum(len(b['units']) for b in batches)} pages, "
+          f"{sum(1 for b in batches for u in b['units'] if u.get('has_text'))} avec couche texte, "
+          f"tentatives " + ', '.join(f"{k} {v}" for k, v in sorted(calls.items())))
+
+    # Sorties du rejeu (outputs/, journal/, logs/) dans un repertoire temporaire
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    os.environ.update({'EMAIL_ADDRESS': '', 'EMAIL_PASSWORD': '', 'TRAFFIC_CAPTURE': 'false',
+                       'LEDGER_ENABLED': 'false'})
+    import app
+    app.PROMPT_PATH = ROOT / app.PROMPT_PATH
+    app.boilerplate_lines.path = Path(workdir.name) / app.BOILERPLATE_FILE
+    app.logger.setLevel(logging.WARNING)
+    print(f"Creneaux providers : {args.provider_slots or app.PROVIDER_SLOTS}, "
+          f"latences x{args.latency_scale:g}")
+
+    originals = {name: getattr(app, name) for name in SCALED}
+    local = measure_local(app, batches, args)
+    for speed in args.speed:
+        for name, value in originals.items():
+            setattr(app, name, value / speed)
+        report(speed, batches, *run(app, batches, speed, args), local)
+    for name, value in originals.items():
+        setattr(app, name, value)
+
+    os.chdir(ROOT)
+    if getattr(app, 'log_listener', None):
+        app.log_listener.stop()
+        import atexit
+        atexit.unregister(app.log_listener.stop)
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Benchmark du demarrage a froid : temps d'import et temps jusqu'a la 1re reponse.
+
+Compare le demarrage actuel (imports lourds differes) a un demarrage "eager"
+qui importe d'abord requests, openpyxl, PyPDF2, reportlab et PyMuPDF, comme
+le faisait l'ancien en-tete de app.py. Au lancement, la variante eager refait
+aussi l'ancienne sonde Ollama bloquante (GET /api/tags, timeout 3s) avant que
+le serveur n'ecoute : quelques ms si le port est ferme, jusqu'a 3s si l'hote
+ne repond pas (--probe-url vers une adresse non routable pour ce cas).
+Mesure aussi le cout reporte sur le premier traitement (tampon + Excel) quand
+le warmup est desactive.
+
+Usage :
+    python tools/startup_bench.py [--runs 5] [--port 5055] [--probe-url http://localhost:11434]
+"""
+
+import os
+import sys
+import time
+import base64
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+EAGER_IMPORTS = (
+    "import requests, openpyxl, openpyxl.styles, PyPDF2, fitz; "
+    "import reportlab.pdfgen.canvas, reportlab.lib.colors, reportlab.lib.pagesizes; "
+)
+
+# Ancien __main__ : sonde Ollama synchrone avant app.run
+EAGER_PROBE = (
+    "import requests\n"
+    "try:\n"
+    "    requests.get({url!r} + '/api/tags', timeout=3)\n"
+    "except Exception:\n"
+    "    pass\n"
+)
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); {eager}import app; "
+    "print(time.perf_counter() - t)"
+)
+
+FIRST_USE_SNIPPET = (
+    "{eager}import time, base64, app; "
+    "pdf = base64.b64decode({pdf!r}); "
+    "t = time.perf_counter(); "
+    "app.stamp_pdf_with_s(pdf); "
+    "w = app.SageExcelWriter(); "
+    "w.add({{'date': '01/01/2026', 'compte': '62510000', 'debit': 1, 'credit': 0}}); w.finish(); "
+    "print(time.perf_counter() - t)"
+)
+
+
+def sample_pdf():
+    """Ticket d'une page genere dans le processus parent (hors mesure)"""
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=400)
+    page.insert_text((30, 60), "CAFE DU COMMERCE  TOTAL TTC 12,50 EUR")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def child_env(**extra):
+    env = dict(os.environ)
+    # Pas de releve email ni de sondes vers de vrais providers pendant la mesure
+    env.update({'EMAIL_ADDRESS': '', 'EMAIL_PASSWORD': '', 'PYTHONWARNINGS': 'ignore'})
+    env.update(extra)
+    return env
+
+
+def run_python(code, **env):
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=ROOT, env=child_env(**env),
+        capture_output=True, text=True, check=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def free_port(preferred):
+    with socket.socket() as s:
+        if s.connect_ex(('127.0.0.1', preferred)) != 0:
+            return preferred
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_response(eager, port, warmup, probe_url):
+    """Lance le serveur et mesure le delai jusqu'au premier 200 sur /login"""
+    launcher = (
+        f"{EAGER_IMPORTS if eager else ''}\n"
+        f"{EAGER_PROBE.format(url=probe_url) if eager else ''}"
+        "import runpy; runpy.run_path('app.py', run_name='__main__')"
+    )
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-c', launcher], cwd=ROOT,
+        env=child_env(PORT=str(port), STARTUP_WARMUP='true' if warmup else 'false'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = start + 60
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError("le serveur n'a pas repondu en 60s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def summary(samples):
+    return f"median {statistics.median(samples) * 1000:7.0f} ms  (min {min(samples) * 1000:.0f}, max {max(samples) * 1000:.0f})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps d'import et de premiere reponse")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--probe-url', default=os.environ.get('OLLAMA_URL', 'http://localhost:11434'),
+                        help="Ollama sonde par la variante eager (ancien demarrage)")
+    args = parser.parse_args()
+
+    print(f"Import de app.py ({args.runs} essais)")
+    for label, eager in (('eager', True), ('lazy ', False)):
+        samples = [run_python(IMPORT_SNIPPET.format(eager=EAGER_IMPORTS if eager else '')) for _ in range(args.runs)]
+        print(f"  {label} : {summary(samples)}")
+
+    print(f"Lancement -> 1re reponse HTTP ({args.runs} essais ; eager = imports + sonde Ollama "
+          f"bloquante sur {args.probe_url})")
+    port = free_port(args.port)
+    for label, eager, warmup in (('eager + sonde  ', True, False),
+                                 ('lazy           ', False, False),
+                                 ('lazy + warmup  ', False, True)):
+        samples = [time_to_first_response(eager, port, warmup, args.probe_url) for _ in range(args.runs)]
+        print(f"  {label}: {summary(samples)}")
+
+    print("Premier traitement apres import (tampon + Excel, sans warmup)")
+    pdf = base64.b64encode(sample_pdf()).decode()
+    for label, eager in (('eager', True), ('lazy ', False)):
+        code = FIRST_USE_SNIPPET.format(eager=EAGER_IMPORTS if eager else '', pdf=pdf)
+        samples = [run_python(code) for _ in range(args.runs)]
+        print(f"  {label} : {summary(samples)}")
+
+
+if __name__ == '__main__':
+    main()
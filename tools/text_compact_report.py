@@ -0,0 +1,217 @@
+"""
+Tokens economises par la reduction du texte (compact_ticket_text) et precision
+d'extraction avant / apres sur un jeu etiquete.
+
+Jeu etiquete : fichier JSONL, une ligne par ticket, dans l'ordre de reception
+(les gabarits sont appris au fil de l'eau, comme en production) :
+    {"text": "..." ou "pdf": "chemin.pdf", "date": "15/01/2026", "ttc": 23.5, "tva": 2.14,
+     "compte": "62560000"}
+Sans --labels, un jeu synthetique (enseignes, mentions legales, programmes de
+fidelite) est genere.
+
+Precision mesuree de deux facons :
+  - hors ligne (defaut) : extraction par regles (date, total TTC, TVA, compte
+    deduit des mots-cles de nature) sur le texte brut puis sur le texte reduit.
+    Date / TTC / TVA sont toujours gardes (rangs 0-1) ; le compte depend des
+    lignes de nature sans montant, celles que la reduction peut retirer ;
+  - --live : analyse reelle par le provider configure (cles API dans l'env),
+    texte brut puis texte reduit, avec les tokens d'entree factures.
+
+Usage :
+    python tools/text_compact_report.py [--labels jeu.jsonl] [--tickets 200]
+                                        [--budget 800] [--live]
+"""
+
+import os
+import re
+import sys
+import json
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Enseigne neutre : la nature de la depense (qui determine le compte) n'est
+# portee que par une ligne sans montant, celle que la reduction peut retirer
+VENDORS = [
+    ("LE COMPTOIR DU PORT", "12 QUAI DES ORFEVRES 75001 PARIS", 0.10, '62560000',
+     "RESTAURATION SUR PLACE", ["FORMULE MIDI", "CAFE", "DESSERT", "EAU 50CL"]),
+    ("RELAIS A6 NEMOURS", "AIRE DE NEMOURS 77140", 0.20, '62520000',
+     "PRODUIT : GAZOLE", ["POMPE"]),
+    ("RESIDENCE LYON CENTRE", "28 RUE DE LA REPUBLIQUE 69002 LYON", 0.10, '62560100',
+     "HEBERGEMENT - NUITEE", ["CHAMBRE", "PETIT DEJEUNER", "TAXE SEJOUR"]),
+    ("CARREFOUR CITY", "5 AVENUE JEAN JAURES 31000 TOULOUSE", 0.055, '60680000',
+     "ALIMENTATION GENERALE", ["EAU MINERALE", "SANDWICH", "FRUITS"]),
+    ("INDIGO GARE", "PLACE DE LA GARE 33000 BORDEAUX", 0.20, '62780000',
+     "STATIONNEMENT HORAIRE", ["TICKET"]),
+]
+# Mots-cles de nature -> compte de charge (cf. prompts/comptable.md), dans l'ordre
+NATURE_KEYWORDS = [
+    ('62520000', r'gazole|sp9[58]|carburant|diesel'),
+    ('62560100', r'hebergement|nuitee|hotel'),
+    ('62560000', r'restaura|repas|brasserie'),
+    ('62780000', r'stationnement|parking'),
+    ('60680000', r'alimentation|fournitures'),
+]
+FOOTERS = [
+    "MERCI DE VOTRE VISITE A BIENTOT",
+    "CONSERVEZ CE TICKET IL VOUS SERA DEMANDE EN CAS D'ECHANGE",
+    "CARTE FIDELITE : CUMULEZ 1 POINT PAR EURO DEPENSE",
+    "RENDEZ-VOUS SUR NOTRE SITE POUR DONNER VOTRE AVIS",
+    "SAS AU CAPITAL DE 10 000 EUR - RCS PARIS 123 456 789",
+    "TICKET NON VALABLE COMME FACTURE SUR DEMANDE",
+    "***********************************",
+    "VOTRE SATISFACTION EST NOTRE PRIORITE",
+]
+
+
+def synthetic_set(count, seed):
+    rng = random.Random(seed)
+    tickets = []
+    for n in range(count):
+        name, address, rate, compte, nature, items = rng.choice(VENDORS)
+        date = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2026"
+        lines = [name, address, f"SIRET {rng.randint(100, 999)} {rng.randint(100, 999)} 00012",
+                 f"TEL 0{rng.randint(1, 5)} {rng.randint(10, 99)} {rng.randint(10, 99)} 00 00",
+                 "-" * 34, f"{date}  {rng.randint(8, 21):02d}:{rng.randint(0, 59):02d}   CAISSE {rng.randint(1, 6)}",
+                 nature]
+        ttc = 0.0
+        for item in rng.sample(items, k=rng.randint(1, len(items))):
+            price = round(rng.uniform(2, 60), 2)
+            ttc += price
+            lines.append(f"{item:<24}{price:>8.2f}".replace('.', ','))
+        ttc = round(ttc, 2)
+        tva = round(ttc - ttc / (1 + rate), 2)
+        lines += ["-" * 34, f"TOTAL TTC          {ttc:.2f} EUR".replace('.', ','),
+                  f"DONT TVA {rate * 100:g}%       {tva:.2f}".replace('.', ','),
+                  f"CB SANS CONTACT    {ttc:.2f}".replace('.', ','),
+                  f"TRANSACTION N {rng.randint(100000, 999999)}"]
+        lines += rng.sample(FOOTERS, k=rng.randint(3, 6))
+        # Mise en page type OCR / extraction : espaces et lignes vides en exces
+        text = '\n\n'.join(re.sub(' ', '   ', line) if rng.random() < 0.3 else line for line in lines)
+        tickets.append({'text': text, 'date': date, 'ttc': ttc, 'tva': tva, 'compte': compte})
+    return tickets
+
+
+def load_labels(path, app):
+    tickets = []
+    for line in path.read_text(encoding='utf-8').splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if 'pdf' in item:
+            item['text'] = app.extract_text_from_pdf((path.parent / item['pdf']).read_bytes())
+        tickets.append(item)
+    return tickets
+
+
+AMOUNT = r'(\d+(?:[ .]\d{3})*[.,]\d{2})'
+
+
+def parse_amount(value):
+    return float(value.replace(' ', '').replace('.', '').replace(',', '.')) if ',' in value \
+        else float(value.replace(' ', ''))
+
+
+def rule_extract(text):
+    """Extraction de reference par regles : date, total TTC, TVA, compte (nature)"""
+    text = re.sub(r'[ \t]+', ' ', text)
+    date = re.search(r'\b(\d{1,2}/\d{1,2}/\d{4})\b', text)
+    ttc = re.search(r'total(?: ttc)?[^\n]*?' + AMOUNT, text, re.IGNORECASE)
+    tva = re.search(r'tva[^\n]*?' + AMOUNT, text, re.IGNORECASE)
+    compte = next((c for c, pattern in NATURE_KEYWORDS if re.search(pattern, text, re.IGNORECASE)), None)
+    return {
+        'compte': compte,
+        'date': date.group(1) if date else None,
+        'ttc': parse_amount(ttc.group(1)) if ttc else None,
+        'tva': parse_amount(tva.group(1)) if tva else None
+    }
+
+
+def live_extract(app, text):
+    """Analyse reelle d'un PDF texte : date et TTC (credit banque) des ecritures"""
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=80 + 12 * text.count('\n'))
+    page.insert_text((20, 30), text, fontsize=8)
+    pdf = doc.tobytes()
+    doc.close()
+    result = app.analyze_ticket_with_retry(pdf, 'eval.pdf')
+    ecritures = result.get('ecritures') or []
+    banque = next((e for e in ecritures if str(e.get('compte', '')).startswith('512')), None)
+    tva = next((e for e in ecritures if str(e.get('compte', '')).startswith('4456')), None)
+    charge = next((e for e in ecritures if not str(e.get('compte', '')).startswith(('4456', '512'))), None)
+    return {
+        'compte': str(charge['compte']) if charge else None,
+        'date': ecritures[0].get('date') if ecritures else None,
+        'ttc': float(banque['credit']) if banque else None,
+        'tva': float(tva['debit']) if tva else None
+    }
+
+
+def accuracy(predictions, tickets):
+    scores = {}
+    for field in ('date', 'ttc', 'tva', 'compte'):
+        labelled = [(p, t) for p, t in zip(predictions, tickets) if t.get(field) is not None]
+        if not labelled:
+            continue
+        good = sum(1 for p, t in labelled if p[field] is not None and (
+            p[field] == t[field] if field in ('date', 'compte') else abs(p[field] - float(t[field])) <= 0.01))
+        scores[field] = good / len(labelled)
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens economises et precision avant / apres reduction du texte")
+    parser.add_argument('--labels', type=Path, help="jeu etiquete JSONL (defaut : jeu synthetique)")
+    parser.add_argument('--tickets', type=int, default=200, help="taille du jeu synthetique")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--budget', type=int, default=None, help="surcharge TEXT_TOKEN_BUDGET")
+    parser.add_argument('--live', action='store_true', help="analyse par le provider configure")
+    args = parser.parse_args()
+
+    # Gabarits appris dans un fichier temporaire : l'apprentissage de prod n'est pas touche
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    import app
+    app.PROMPT_PATH = ROOT / app.PROMPT_PATH
+    app.boilerplate_lines = app.BoilerplateLines(Path(workdir.name) / 'boilerplate_lines.json')
+    if args.budget is not None:
+        app.TEXT_TOKEN_BUDGET = args.budget
+
+    tickets = load_labels(args.labels, app) if args.labels else synthetic_set(args.tickets, args.seed)
+    compact = [app.compact_ticket_text(t['text']) for t in tickets]
+    report = app.text_compact_report()
+    print(f"{len(tickets)} tickets, budget {app.TEXT_TOKEN_BUDGET or 'illimite'} tokens/page")
+    print(f"  tokens estimes : {report['tokens_in']} -> {report['tokens_out']} "
+          f"(-{report['tokens_saved']}, {report['saved_ratio']:.1%})")
+    print(f"  lignes retirees : {report['lines_dropped']}")
+
+    print("Precision hors ligne (regles) :")
+    raw_scores = accuracy([rule_extract(t['text']) for t in tickets], tickets)
+    compact_scores = accuracy([rule_extract(c) for c in compact], tickets)
+    for field in raw_scores:
+        print(f"  {field:<6} brut {raw_scores[field]:6.1%}   reduit {compact_scores[field]:6.1%}")
+
+    if args.live:
+        print("Precision en ligne (provider configure) :")
+        runs = {}
+        for label, enabled in (('brut', False), ('reduit', True)):
+            app.TEXT_COMPACT = enabled
+            before = sum(t['input_tokens'] for k, t in app.tier_report().items() if k != 'escalations')
+            predictions = [live_extract(app, t['text']) for t in tickets]
+            after = sum(t['input_tokens'] for k, t in app.tier_report().items() if k != 'escalations')
+            runs[label] = (accuracy(predictions, tickets), after - before)
+        for field in runs['brut'][0]:
+            print(f"  {field:<6} brut {runs['brut'][0][field]:6.1%}   reduit {runs['reduit'][0][field]:6.1%}")
+        print(f"  tokens d'entree factures : brut {runs['brut'][1]}  reduit {runs['reduit'][1]}")
+
+    os.chdir(ROOT)
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()